@@ -0,0 +1,126 @@
+"""
+Benchmark the reverse lookups of ExternalKeyMapping (i.e. the mappings of an
+object), with and without the (content_type, object_id) index.
+
+    python benchmarks/reverse_lookups.py --rows 1000000 --lookups 2000
+
+By default an SQLite database in a temporary directory is used. To benchmark
+another database, provide its Django settings as JSON, i.e.:
+
+    python benchmarks/reverse_lookups.py --database \
+        '{"ENGINE": "django.db.backends.postgresql", "NAME": "bench"}'
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+
+def setup(database):
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+    from django.conf import settings
+    settings.configure(
+        DATABASES={'default': database},
+        INSTALLED_APPS=[
+            'django.contrib.contenttypes',
+            'nsync',
+        ],
+    )
+    import django
+    django.setup()
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+
+
+def populate(rows, objects):
+    from django.contrib.contenttypes.models import ContentType
+    from nsync.models import ExternalKeyMapping, ExternalSystem
+
+    systems = [ExternalSystem.objects.create(name='System{}'.format(i))
+               for i in range(3)]
+    content_types = list(ContentType.objects.all())
+    batch = []
+    for i in range(rows):
+        batch.append(ExternalKeyMapping(
+            external_system=systems[i % len(systems)],
+            external_key='Key{}'.format(i),
+            content_type=content_types[i % len(content_types)],
+            object_id=random.randrange(objects)))
+        if len(batch) == 10000:
+            ExternalKeyMapping.objects.bulk_create(batch)
+            batch = []
+    ExternalKeyMapping.objects.bulk_create(batch)
+    return content_types
+
+
+def lookup(content_type, object_id):
+    """The query of DeleteIfOnlyReferenceModelAction"""
+    from nsync.models import ExternalKeyMapping
+    return ExternalKeyMapping.objects.filter(
+        content_type=content_type,
+        object_id=object_id,
+        external_key='Key0',
+    ).values_list('external_system_id', flat=True)[:2]
+
+
+def measure(content_types, objects, lookups):
+    targets = [(random.choice(content_types), random.randrange(objects))
+               for _ in range(lookups)]
+    start = time.perf_counter()
+    for content_type, object_id in targets:
+        list(lookup(content_type, object_id))
+    elapsed = time.perf_counter() - start
+    return elapsed, lookup(*targets[0]).explain()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--rows', type=int, default=200000,
+                        help='The number of mappings. Default: 200000')
+    parser.add_argument('--objects', type=int, default=100000,
+                        help='The number of distinct object ids. '
+                             'Default: 100000')
+    parser.add_argument('--lookups', type=int, default=1000,
+                        help='The number of lookups to time. Default: 1000')
+    parser.add_argument('--database', default=None,
+                        help='The Django database settings, as JSON')
+    args = parser.parse_args()
+
+    directory = tempfile.TemporaryDirectory()
+    database = json.loads(args.database) if args.database else {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(directory.name, 'benchmark.sqlite3'),
+    }
+    setup(database)
+
+    from django.db import connection
+    from nsync.models import ExternalKeyMapping
+
+    print('Creating {} mappings...'.format(args.rows))
+    content_types = populate(args.rows, args.objects)
+    index = [i for i in ExternalKeyMapping._meta.indexes
+             if i.name == 'nsync_mapping_object_idx'][0]
+
+    results = []
+    with connection.schema_editor() as editor:
+        editor.remove_index(ExternalKeyMapping, index)
+    results.append(('Before (no index)',) +
+                   measure(content_types, args.objects, args.lookups))
+    with connection.schema_editor() as editor:
+        editor.add_index(ExternalKeyMapping, index)
+    results.append(('After (content_type, object_id) index',) +
+                   measure(content_types, args.objects, args.lookups))
+
+    for name, elapsed, plan in results:
+        print('{}: {} lookups in {:.3f}s ({:.3f}ms each)'.format(
+            name, args.lookups, elapsed, 1000.0 * elapsed / args.lookups))
+        print('  Plan: {}'.format(plan.replace('\n', '\n        ')))
+    directory.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -18,21 +18,21 @@ KEYWORDS = []
 CLASSIFIERS = [
     'Development Status :: 3 - Alpha',
     'Framework :: Django',
-    'Framework :: Django :: 1.7',
-    'Framework :: Django :: 1.8',
-    'Framework :: Django :: 2.0',
+    'Framework :: Django :: 4.1',
+    'Framework :: Django :: 4.2',
     'Intended Audience :: Developers',
     'License :: OSI Approved :: MIT License',
     'Natural Language :: English',
     'Programming Language :: Python :: 3',
-    'Programming Language :: Python :: 3.3',
-    'Programming Language :: Python :: 3.4',
-    'Programming Language :: Python :: 3.5',
-    'Programming Language :: Python :: 3.6',
+    'Programming Language :: Python :: 3.8',
+    'Programming Language :: Python :: 3.9',
+    'Programming Language :: Python :: 3.10',
+    'Programming Language :: Python :: 3.11',
 ]
-INSTALL_REQUIRES = ['Django>=1.8']
+INSTALL_REQUIRES = ['Django>=4.1']
+PYTHON_REQUIRES = '>=3.8'
 TEST_SUITE = 'runtests.run_tests'
-TESTS_REQUIRE = ['Django>=1.8']
+TESTS_REQUIRE = ['Django>=4.1']
 
 ###############################################################################
 
@@ -85,6 +85,7 @@ setup(
     zip_safe=False,
     classifiers=CLASSIFIERS,
     install_requires=INSTALL_REQUIRES,
+    python_requires=PYTHON_REQUIRES,
     tests_require=TESTS_REQUIRE,
     test_suite=TEST_SUITE,
 )
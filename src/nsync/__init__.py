@@ -12,4 +12,13 @@ __email__ = 'andrew.john.dodd@gmail.com'
 __license__ = 'MIT'
 __copyright__ = 'Copyright (c) 2015 Andrew Dodd'
 
-# No imports yet, not sure what exactly to import
+
+async def sync_async(model, external_system, rows, **kwargs):
+    """
+    Synchronise rows from asynchronous code, see nsync.asynchronous.
+
+    The import is deferred, as this package is imported before the Django
+    application registry is ready.
+    """
+    from .asynchronous import sync_async as _sync_async
+    return await _sync_async(model, external_system, rows, **kwargs)
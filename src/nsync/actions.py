@@ -4,11 +4,14 @@ from django.core.exceptions import (
     ObjectDoesNotExist,
     FieldDoesNotExist)
 from django.contrib.contenttypes.fields import ContentType
+from django.db import connections, router
 from django.db.models.query_utils import Q
 from .models import ExternalKeyMapping
 from collections import defaultdict
+from functools import lru_cache
 import logging
 from .logging import StyleAdapter
+from .signals import current_changes
 
 """
 NSync actions for updating Django models
@@ -62,8 +65,12 @@ class UnknownActionType(Exception):
             self.field_name,
             self.model_name)
 
+_match_ons = {}
+
+
 class ObjectSelector:
     OPERATORS = set(['|', '&', '~'])
+    __slots__ = ('match_on', 'fields')
 
     def __init__(self, match_on, available_fields):
         for field_name in match_on:
@@ -75,7 +82,9 @@ class ObjectSelector:
                     'field_name({}) must be in fields({})'.format(
                         field_name, available_fields))
 
-        self.match_on = match_on
+        # The actions of a file share the same (immutable) match on tuples
+        match_on = tuple(match_on)
+        self.match_on = _match_ons.setdefault(match_on, match_on)
         self.fields = available_fields
 
     def get_by(self):
@@ -133,6 +142,10 @@ class ModelAction:
     for finding the target objects.
     """
     REFERRED_TO_DELIMITER = '=>'
+    # The actions are kept for every row of the input, so have no __dict__.
+    # The rejects & row are where to record the input row if the action fails
+    # (see reject()).
+    __slots__ = ('model', 'match_on', 'fields', 'rejects', 'row')
 
     def __init__(self, model, match_on, fields={}):
         """
@@ -154,12 +167,14 @@ class ModelAction:
         self.model = model
         self.match_on = match_on
         self.fields = fields
+        self.rejects = None
+        self.row = None
 
     def __str__(self):
         return '{} - Model:{} - MatchFields:{} - Fields:{}'.format(
             self.__class__.__name__,
             self.model.__name__,
-            self.match_on.match_on,
+            list(self.match_on.match_on),
             self.fields)
 
     @property
@@ -168,12 +183,54 @@ class ModelAction:
 
     def get_object(self):
         """Finds the object that matches the provided matching information"""
-        return self.model.objects.get(self.match_on.get_by())
+        return self.queryset().get(self.match_on.get_by())
+
+    def queryset(self):
+        """
+        The objects of the model. For the models that opt in (see
+        _loaded_fields()) only the columns used by the action are loaded.
+
+        Saving an object loaded this way only writes the loaded columns.
+        """
+        fields = _loaded_fields(self.model, tuple(self.match_on.match_on),
+                                tuple(self.fields))
+        if fields is None:
+            return self.model.objects.all()
+        return self.model.objects.only(*fields)
+
+    def content_type(self, model=None):
+        """The (cached) ContentType of the model, by default the action's"""
+        return ContentType.objects.get_for_model(model or self.model)
+
+    def get_linked_object(self, mapping):
+        """
+        Finds the object referred to by the mapping, loading the same
+        columns as get_object().
+
+        :param mapping: The ExternalKeyMapping for the external key
+        :return: The object, or None if there is no such object
+        """
+        if mapping.object_id is None:
+            return None
+        if mapping.content_type_id != self.content_type().id:
+            return mapping.content_object
+        return self.queryset().filter(pk=mapping.object_id).first()
 
     def execute(self):
         """Does nothing"""
         pass
 
+    def reject(self, reason, *args):
+        """
+        Record the input row of the action as rejected, if the action was
+        built with somewhere to record it (i.e. a RejectsWriter).
+
+        :param reason: The reason the row was rejected, as a format string
+        :param args: The arguments for the reason format string
+        """
+        if self.rejects is not None:
+            self.rejects.write(self.row, reason.format(*args))
+
     def update_from_fields(self, object, force=False):
         """
         Update the provided object with the fields.
@@ -193,7 +250,8 @@ class ModelAction:
         # filtering against many fields is possible
         referential_attributes = defaultdict(dict)
         for attribute, value in self.fields.items():
-            if self.REFERRED_TO_DELIMITER in attribute and value != '':
+            if self.REFERRED_TO_DELIMITER in attribute and \
+                    value != '' and value is not None:
                 ref_attr = attribute.split(self.REFERRED_TO_DELIMITER)
                 referential_attributes[ref_attr[0]][ref_attr[1]] = value
             else:
@@ -268,7 +326,7 @@ class ModelAction:
                         else:
                             target = field.related_model.objects.get(**get_by)
                             set_value(object, own_attribute, target)
-                            logger.debug(object)
+                            logger.debug('{}', object)
 
                     except ObjectDoesNotExist as e:
                         logger.warning(
@@ -278,6 +336,9 @@ class ModelAction:
                             object.__class__.__name__,
                             object,
                             field.verbose_name)
+                        self.reject('Could not find {} with {} for {}',
+                                    field.related_model.__name__, get_by,
+                                    field.verbose_name)
                     except MultipleObjectsReturned as e:
                         logger.warning(
                             'Found multiple {} objects with {} for {}[{}].{}',
@@ -286,17 +347,23 @@ class ModelAction:
                             object.__class__.__name__,
                             object,
                             field.verbose_name)
+                        self.reject('Found multiple {} objects with {} for {}',
+                                    field.related_model.__name__, get_by,
+                                    field.verbose_name)
             except FieldDoesNotExist as e:
                 logger.warning( 'Attibute "{}" does not exist on {}[{}]',
                     attribute,
                     object.__class__.__name__,
                     object)
+                self.reject('Attribute "{}" does not exist', attribute)
 
             except DissimilarActionTypesError as e:
                 logger.warning('{}', e)
+                self.reject('{}', e)
 
             except UnknownActionType as e:
                 logger.warning('{}', e)
+                self.reject('{}', e)
 
 
 class CreateModelAction(ModelAction):
@@ -306,6 +373,7 @@ class CreateModelAction(ModelAction):
     Note, this will not create another object if a matching one is
     found, nor will it update a matched object.
     """
+    __slots__ = ()
 
     def execute(self):
         try:
@@ -313,9 +381,22 @@ class CreateModelAction(ModelAction):
         except ObjectDoesNotExist as e:
             pass
         except MultipleObjectsReturned as e:
-            logger.warning('Mulitple objects found - {} Error:{}', str(self), e)
+            logger.warning('Mulitple objects found - {} Error:{}', self, e)
+            self.reject('Multiple objects found - {}', e)
             return None
 
+        return self.execute_with(None)
+
+    def execute_with(self, obj):
+        """
+        Execute with the matching object already found (i.e. by a
+        MergeJoinSyncPolicy).
+
+        :param obj: The matching object, or None if there isn't one
+        :return: The matching or created object
+        """
+        if obj is not None:
+            return obj
 
         obj=self.model()
         # NB: Create uses force to override defaults
@@ -333,6 +414,7 @@ class CreateModelWithReferenceAction(CreateModelAction):
     Action to create a model object if it does not exist, and to create or
     update an external reference to the object.
     """
+    __slots__ = ('external_system', 'external_key')
 
     def __init__(self, external_system, model,
                  external_key, match_on, fields={}):
@@ -363,13 +445,12 @@ class CreateModelWithReferenceAction(CreateModelAction):
                 external_system=self.external_system,
                 external_key=self.external_key)
 
-        model_obj=mapping.content_object
+        model_obj=self.get_linked_object(mapping)
         if model_obj is None:
             model_obj=super(CreateModelWithReferenceAction, self).execute()
 
         if model_obj:
-            mapping.content_type=ContentType.objects.get_for_model(
-                self.model)
+            mapping.content_type=self.content_type()
             mapping.content_object=model_obj
             mapping.object_id=model_obj.id
             mapping.save()
@@ -382,6 +463,7 @@ class UpdateModelAction(ModelAction):
     Action to update the fields of a model object, but not create an
     object.
     """
+    __slots__ = ('force_update',)
 
     def __init__(self, model, match_on, fields={}, force_update=False):
         """
@@ -408,26 +490,56 @@ class UpdateModelAction(ModelAction):
     def execute(self):
         try:
             obj=self.get_object()
+        except ObjectDoesNotExist:
+            self.reject('No object found to update')
+            return None
+        except MultipleObjectsReturned as e:
+            logger.warning('Mulitple objects found - {} Error:{}', self, e)
+            self.reject('Multiple objects found - {}', e)
+            return None
+
+        return self.execute_with(obj)
+
+    def execute_with(self, obj, skip_unchanged=False):
+        """
+        Execute with the matching object already found (i.e. by a
+        MergeJoinSyncPolicy).
+
+        :param obj: The matching object, or None if there isn't one
+        :param skip_unchanged: (Optional) Do not save the object if none of
+            its fields were changed. Default: False
+        :return: The updated object, or None
+        """
+        if obj is None:
+            return None
+
+        try:
+            before=self.concrete_values(obj) if skip_unchanged else None
             self.update_from_fields(obj, self.force_update)
+            if skip_unchanged and before == self.concrete_values(obj):
+                return obj
 
             with transaction.atomic():
                 obj.save()
 
             return obj
-        except ObjectDoesNotExist:
-            return None
-        except MultipleObjectsReturned as e:
-            logger.warning('Mulitple objects found - {} Error:{}', str(self), e)
-            return None
         except IntegrityError as e:
-            logger.warning('Integrity issue - {} Error:{}', str(self), e)
+            logger.warning('Integrity issue - {} Error:{}', self, e)
+            self.reject('Integrity issue - {}', e)
             return None
 
+    @staticmethod
+    def concrete_values(obj):
+        deferred = obj.get_deferred_fields()
+        return [getattr(obj, f.attname) for f in obj._meta.concrete_fields
+                if f.attname not in deferred]
+
 class UpdateModelWithReferenceAction(UpdateModelAction):
     """
     Action to create a model object if it does not exist, and to create or
     update an external reference to the object.
     """
+    __slots__ = ('external_system', 'external_key')
 
     def __init__(self, external_system, model, external_key, match_on,
                  fields={}, force_update=False):
@@ -459,7 +571,7 @@ class UpdateModelWithReferenceAction(UpdateModelAction):
                 external_system=self.external_system,
                 external_key=self.external_key)
 
-        linked_object=mapping.content_object
+        linked_object=self.get_linked_object(mapping)
 
         matched_object=None
         try:
@@ -467,7 +579,8 @@ class UpdateModelWithReferenceAction(UpdateModelAction):
         except ObjectDoesNotExist:
             pass
         except MultipleObjectsReturned as e:
-            logger.warning('Mulitple objects found - {} Error:{}', str(self), e)
+            logger.warning('Mulitple objects found - {} Error:{}', self, e)
+            self.reject('Multiple objects found - {}', e)
             return None
 
         # If both matched and linked objects exist but are different,
@@ -483,6 +596,7 @@ class UpdateModelWithReferenceAction(UpdateModelAction):
             model_obj=matched_object
         else:
             # No object to update
+            self.reject('No object found to update')
             return None
 
         if model_obj:
@@ -491,12 +605,12 @@ class UpdateModelWithReferenceAction(UpdateModelAction):
                 with transaction.atomic():
                     model_obj.save()
             except IntegrityError as e:
-                logger.warning('Integrity issue - {} Error:{}', str(self), e)
+                logger.warning('Integrity issue - {} Error:{}', self, e)
+                self.reject('Integrity issue - {}', e)
                 return None
 
         if model_obj:
-            mapping.content_type=ContentType.objects.get_for_model(
-                self.model)
+            mapping.content_type=self.content_type()
             mapping.content_object=model_obj
             mapping.object_id=model_obj.id
             mapping.save()
@@ -504,6 +618,356 @@ class UpdateModelWithReferenceAction(UpdateModelAction):
         return model_obj
 
 
+class UpsertModelAction(ModelAction):
+    """
+    Action to create a model object, or forcibly update it if it exists, in a
+    single statement (i.e. INSERT ... ON CONFLICT DO UPDATE).
+
+    This is the equivalent of a forced create & update ("cu*") pair of
+    actions, for when the match_on fields are a unique constraint of the
+    model. These actions are intended to be executed in batches, via
+    execute_batch(), so that a whole batch is a single statement.
+
+    NB: As the objects are not saved individually, their save() methods are
+    not called and no pre_save/post_save signals are sent.
+    """
+    __slots__ = ('unique_fields',)
+    batch_size = 500
+
+    def __init__(self, model, match_on, fields={}):
+        super(UpsertModelAction, self).__init__(model, match_on, fields)
+        self.unique_fields = self.match_fields(match_on)
+
+    @staticmethod
+    def match_fields(match_on):
+        return tuple(sorted(set(match_on) - ObjectSelector.OPERATORS))
+
+    @staticmethod
+    def supports(model, match_on, field_names):
+        """
+        Check if an upsert can be used for the provided row layout.
+
+        :param model: The model class
+        :param match_on (list): The names of the fields to match on
+        :param field_names: The names of the fields in the row
+        :return: True if the match_on fields are a unique constraint of the
+            model and all of the fields are plain (non-relational) columns
+        """
+        return _supports_upsert(model, tuple(match_on), tuple(field_names))
+
+    @property
+    def type(self):
+        return 'create'
+
+    @property
+    def batch_key(self):
+        return (self.__class__, self.model, self.unique_fields,
+                tuple(sorted(self.fields)))
+
+    def execute(self):
+        self.execute_batch([self])
+
+    def build_object(self):
+        obj = self.model()
+        for attribute, value in self.fields.items():
+            if value == '' and self.model._meta.get_field(attribute).null:
+                value = None
+            setattr(obj, attribute, value)
+        return obj
+
+    def lookup_values(self):
+        """The (normalised) unique field values, to compare against the DB"""
+        return tuple(self.model._meta.get_field(f).to_python(
+            None if self.fields[f] == '' else self.fields[f])
+            for f in self.unique_fields)
+
+    @classmethod
+    def execute_batch(cls, actions):
+        """
+        Upsert the objects for a batch of actions with the same batch_key.
+
+        :param actions: The list of actions
+        :return: Nothing
+        """
+        for i in range(0, len(actions), cls.batch_size):
+            cls.upsert(actions[i:i + cls.batch_size])
+
+    @classmethod
+    def upsert(cls, actions):
+        if not actions:
+            return
+        # The same object cannot be affected twice by one statement, so only
+        # the last action for each object is kept
+        latest = {}
+        for action in actions:
+            latest[action.lookup_values()] = action
+        actions = list(latest.values())
+
+        first = actions[0]
+        update_fields = [f for f in sorted(first.fields)
+                         if f not in first.unique_fields]
+        objects = [action.build_object() for action in actions]
+        # No signals are sent for bulk operations, so the changes are
+        # recorded here (at the cost of finding the pks)
+        changes = current_changes()
+        if changes is not None:
+            values = list(latest)
+            existing = cls.find_pks(first.model, first.unique_fields, values)
+        try:
+            with transaction.atomic():
+                if update_fields:
+                    first.model.objects.bulk_create(
+                        objects,
+                        update_conflicts=True,
+                        unique_fields=list(first.unique_fields),
+                        update_fields=update_fields)
+                else:
+                    first.model.objects.bulk_create(objects,
+                                                    ignore_conflicts=True)
+                if changes is not None:
+                    cls.record_changes(changes, first.model, existing,
+                                       update_fields, cls.find_pks(
+                                           first.model, first.unique_fields,
+                                           values))
+        except IntegrityError as e:
+            logger.warning('Integrity issue - {} Error:{}', str(first), e)
+            for action in actions:
+                action.reject('Integrity issue - {}', e)
+
+    @staticmethod
+    def record_changes(changes, model, existing, update_fields, found):
+        for value, pk in found.items():
+            if value not in existing:
+                changes.record(model, 'created', pk)
+            elif update_fields:
+                changes.record(model, 'updated', pk)
+
+    @classmethod
+    def find_pks(cls, model, unique_fields, values):
+        """
+        Find the primary keys of the objects with the unique field values.
+
+        :return: A dict of unique field values to primary key
+        """
+        if len(unique_fields) == 1:
+            query = Q(**{unique_fields[0] + '__in': [v[0] for v in values]})
+        else:
+            query = Q()
+            for value in values:
+                query |= Q(**dict(zip(unique_fields, value)))
+        found = model.objects.filter(query).values_list('pk', *unique_fields)
+        return dict((tuple(row[1:]), row[0]) for row in found)
+
+
+class UpsertModelWithReferenceAction(UpsertModelAction):
+    """
+    Action to upsert a model object, and to create or update an external
+    reference to the object.
+
+    If the external reference already links to a different object than the
+    one with the unique field values, the row is instead performed by the
+    CreateModelWithReferenceAction & UpdateModelWithReferenceAction pair, to
+    keep their behaviour of updating the linked object.
+    """
+    __slots__ = ('external_system', 'external_key')
+
+    def __init__(self, external_system, model, external_key, match_on,
+                 fields={}):
+        super(UpsertModelWithReferenceAction, self).__init__(
+            model, match_on, fields)
+        self.external_system = external_system
+        self.external_key = external_key
+
+    @property
+    def batch_key(self):
+        return super(UpsertModelWithReferenceAction, self).batch_key + (
+            self.external_system.pk,)
+
+    def fallback_actions(self):
+        actions = [
+            CreateModelWithReferenceAction(
+                self.external_system, self.model, self.external_key,
+                list(self.match_on.match_on), self.fields),
+            UpdateModelWithReferenceAction(
+                self.external_system, self.model, self.external_key,
+                list(self.match_on.match_on), self.fields, True)]
+        for action in actions:
+            action.rejects = self.rejects
+            action.row = self.row
+        return actions
+
+    @classmethod
+    def upsert(cls, actions):
+        # The mappings are read before, and written after, each statement, so
+        # a repeated external key starts a new statement, which sees (and
+        # relinks or updates) the mapping of the earlier action
+        batch = []
+        keys = set()
+        for action in actions:
+            if action.external_key in keys:
+                cls.upsert_distinct(batch)
+                batch = []
+                keys = set()
+            batch.append(action)
+            keys.add(action.external_key)
+        cls.upsert_distinct(batch)
+
+    @classmethod
+    def upsert_distinct(cls, actions):
+        """Upsert the actions, which all have different external keys"""
+        while actions:
+            relinked = cls.find_relinked(actions)
+            # The actions are executed in order, so the upserts before an
+            # action that must fall back are executed first, and the
+            # mappings of the rest are found again afterwards
+            split = next((i for (i, action) in enumerate(actions)
+                          if action.external_key in relinked), len(actions))
+            cls.upsert_and_map(actions[:split])
+            if split < len(actions):
+                for fallback in actions[split].fallback_actions():
+                    fallback.execute()
+            actions = actions[split + 1:]
+
+    @classmethod
+    def find_relinked(cls, actions):
+        """
+        The external keys of the actions with a mapping to another (existing)
+        object than the one matched, which must fall back to the actions that
+        relink or update it.
+        """
+        first = actions[0]
+        content_type = first.content_type()
+        values = [action.lookup_values() for action in actions]
+        existing = cls.find_pks(first.model, first.unique_fields, values)
+        mappings = dict(
+            (m[0], m[1:]) for m in ExternalKeyMapping.objects.filter(
+                external_system=first.external_system,
+                external_key__in=[a.external_key for a in actions])
+            .values_list('external_key', 'content_type_id', 'object_id'))
+
+        relinked = {}
+        for action, value in zip(actions, values):
+            mapping = mappings.get(action.external_key)
+            if mapping and mapping != (content_type.id, existing.get(value)):
+                relinked[action.external_key] = mapping
+        linked = set()
+        for content_type_id, object_ids in _group_ids(relinked.values()):
+            linked_model = ContentType.objects.get_for_id(
+                content_type_id).model_class()
+            if linked_model is not None:
+                linked.update((content_type_id, pk) for pk in
+                              linked_model.objects.filter(pk__in=object_ids)
+                              .values_list('pk', flat=True))
+        return set(key for (key, mapping) in relinked.items()
+                   if mapping in linked)
+
+    @classmethod
+    def upsert_and_map(cls, actions):
+        """Upsert the objects, and (re)map the external keys to them"""
+        if not actions:
+            return
+        first = actions[0]
+        super(UpsertModelWithReferenceAction, cls).upsert(actions)
+
+        found = cls.find_pks(first.model, first.unique_fields,
+                             [action.lookup_values() for action in actions])
+        new_mappings = [
+            ExternalKeyMapping(external_system=action.external_system,
+                               external_key=action.external_key,
+                               content_type=first.content_type(),
+                               object_id=found[action.lookup_values()])
+            for action in actions if action.lookup_values() in found]
+        ExternalKeyMapping.objects.bulk_create(
+            list(dict((m.external_key, m) for m in new_mappings).values()),
+            update_conflicts=True,
+            unique_fields=['external_system', 'external_key'],
+            update_fields=['content_type', 'object_id'])
+
+
+def _group_ids(content_type_and_ids):
+    grouped = defaultdict(list)
+    for content_type_id, object_id in content_type_and_ids:
+        grouped[content_type_id].append(object_id)
+    return grouped.items()
+
+
+@lru_cache(maxsize=None)
+def _loaded_fields(model, match_on, field_names):
+    """
+    The names of the columns to load for an action, i.e. the primary key, the
+    fields set automatically on save, and the concrete fields of the match on
+    and the provided fields.
+
+    As only the loaded columns are saved, a write made by a save() override
+    or a pre_save handler to another column would be lost. So all of the
+    columns are loaded (None is returned) unless the model opts in, with
+    nsync_load_used_fields_only = True, and every provided field is a
+    concrete field (i.e. not a property setter, which may set any column).
+    """
+    if not getattr(model, 'nsync_load_used_fields_only', False):
+        return None
+
+    opts = model._meta
+    names = [opts.pk.name]
+    # Fields set automatically on save must be loaded to be written
+    names.extend(f.name for f in opts.concrete_fields
+                 if getattr(f, 'auto_now', False))
+    for name in match_on:
+        if name in ObjectSelector.OPERATORS:
+            continue
+        try:
+            field = opts.get_field(name.split('__')[0])
+        except FieldDoesNotExist:
+            continue
+        if field.concrete and field.name not in names:
+            names.append(field.name)
+    for name in field_names:
+        name = name.split(ModelAction.REFERRED_TO_DELIMITER)[0]
+        try:
+            field = opts.get_field(name)
+        except FieldDoesNotExist:
+            return None
+        if not field.concrete:
+            return None
+        if field.name not in names:
+            names.append(field.name)
+    return tuple(names)
+
+
+@lru_cache(maxsize=None)
+def _supports_upsert(model, match_on, field_names):
+    if VERSION < (4, 1):
+        return False
+    match_fields = UpsertModelAction.match_fields(match_on)
+    if not match_fields or \
+            ObjectSelector.OPERATORS.intersection(match_on) - {'&'}:
+        return False
+
+    # The rows without fields to update only ignore the conflicts
+    features = connections[router.db_for_write(model)].features
+    if set(field_names) - set(match_fields):
+        if not features.supports_update_conflicts_with_target:
+            return False
+    elif not features.supports_ignore_conflicts:
+        return False
+
+    opts = model._meta
+    for name in field_names:
+        try:
+            field = opts.get_field(name)
+        except FieldDoesNotExist:
+            return False
+        if not field.concrete or field.is_relation or field.primary_key:
+            return False
+
+    unique_sets = [set([f.name]) for f in opts.local_concrete_fields
+                   if f.unique and not f.primary_key]
+    unique_sets.extend(set(fields) for fields in opts.unique_together)
+    for constraint in opts.total_unique_constraints:
+        unique_sets.append(set(constraint.fields))
+    return set(match_fields) in unique_sets
+
+
 class DeleteIfOnlyReferenceModelAction(ModelAction):
     """
     This action only deletes the pointed to object if the key mapping
@@ -512,11 +976,14 @@ class DeleteIfOnlyReferenceModelAction(ModelAction):
     I.e. if there are two references from different external systems to the
     same object, then the object will not be deleted.
     """
+    __slots__ = ('delete_action', 'external_key', 'external_system')
 
     def __init__(self, external_system, external_key, delete_action):
         self.delete_action=delete_action
         self.external_key=external_key
         self.external_system=external_system
+        self.rejects=None
+        self.row=None
 
     @property
     def type(self):
@@ -526,25 +993,28 @@ class DeleteIfOnlyReferenceModelAction(ModelAction):
         try:
             obj=self.delete_action.get_object()
 
-            key_mapping=ExternalKeyMapping.objects.get(
+            # A reverse lookup, by the (content_type, object_id) index
+            system_ids=list(ExternalKeyMapping.objects.filter(
+                content_type=self.content_type(self.delete_action.model),
                 object_id=obj.id,
-                content_type=ContentType.objects.get_for_model(
-                    self.delete_action.model),
-                external_key=self.external_key)
+                external_key=self.external_key,
+            ).values_list('external_system_id', flat=True)[:2])
 
-            if key_mapping.external_system == self.external_system:
+            if system_ids == [self.external_system.id]:
                 self.delete_action.execute()
             else:
-                # The key mapping is not 'this' systems key mapping
+                # There is no key mapping, it is not 'this' systems key
+                # mapping or there are multiple key mappings
                 pass
         except MultipleObjectsReturned:
-            # There are multiple key mappings or multiple target objects, we shouldn't delete the object
+            # There are multiple target objects, we shouldn't delete the object
             return
         except ObjectDoesNotExist:
             return
 
 
 class DeleteModelAction(ModelAction):
+    __slots__ = ()
 
     @property
     def type(self):
@@ -558,7 +1028,8 @@ class DeleteModelAction(ModelAction):
         except ObjectDoesNotExist:
             pass
         except MultipleObjectsReturned as e:
-            logger.warning('Mulitple objects found - {} Error:{}', str(self), e)
+            logger.warning('Mulitple objects found - {} Error:{}', self, e)
+            self.reject('Multiple objects found - {}', e)
             return None
 
 
@@ -566,10 +1037,13 @@ class DeleteExternalReferenceAction:
     """
     A model action to remove the ExternalKeyMapping object for a model object.
     """
+    __slots__ = ('external_system', 'external_key', 'rejects', 'row')
 
     def __init__(self, external_system, external_key):
         self.external_system=external_system
         self.external_key=external_key
+        self.rejects=None
+        self.row=None
 
     @property
     def type(self):
@@ -638,17 +1112,20 @@ class ActionFactory:
     one will be able to delete the object).
     """
 
-    def __init__(self, model, external_system=None):
+    def __init__(self, model, external_system=None, use_upsert=False):
         """
         Create an actions factory for a given Django Model.
 
         :param model: The model to use for the actions
         :param external_system: (Optional) The external system object to
             create links against
+        :param use_upsert: (Optional) Build a single UpsertModelAction for
+            forced create & update requests, where possible. Default: False
         :return: A new actions factory
         """
         self.model=model
         self.external_system=external_system
+        self.use_upsert=use_upsert
 
     def is_externally_mappable(self, external_key):
         """
@@ -699,6 +1176,20 @@ class ActionFactory:
             elif sync_actions.force:
                 actions.append(action)
 
+        if self.use_upsert and sync_actions.create and \
+                sync_actions.update and sync_actions.force and \
+                UpsertModelAction.supports(self.model, match_on, fields):
+            if self.is_externally_mappable(external_system_key):
+                action=UpsertModelWithReferenceAction(self.external_system,
+                                                      self.model,
+                                                      external_system_key,
+                                                      match_on,
+                                                      fields)
+            else:
+                action=UpsertModelAction(self.model, match_on, fields)
+            actions.append(action)
+            return actions
+
         if sync_actions.create:
             if self.is_externally_mappable(external_system_key):
                 action=CreateModelWithReferenceAction(self.external_system,
@@ -730,7 +1221,11 @@ class SyncActions:
     """
     A holder object for the actions that can be requested against a model
     object concurrently.
+
+    The decoded SyncActions are shared by the rows with the same action flags
+    (see CsvSyncActionsDecoder), so they must not be modified.
     """
+    __slots__ = ('create', 'update', 'delete', 'force')
 
     def __init__(self, create=False, update=False, delete=False, force=False):
         if delete and create:
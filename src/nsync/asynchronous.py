@@ -0,0 +1,197 @@
+"""
+NSync asyncio ingestion API
+
+This module allows rows to be synchronised from asynchronous code (i.e. an
+ASGI application receiving change events), without having to write them to a
+file and run one of the commands.
+
+The rows are collected into batches, which are executed in Django's
+thread-sensitive executor so that the event loop is never blocked by the
+database work. Only a limited number of batches are allowed to be waiting
+for execution, which applies backpressure to the producer of the rows. A
+partial batch is executed once its first row has waited for max_wait
+seconds, so that the rows of a slow producer are not held back.
+"""
+import asyncio
+
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:  # pragma: no cover
+    sync_to_async = None
+
+from .context import RunContext
+from .engine import SyncEngine
+
+
+def engine_for(model, external_system, ordered=True, use_transaction=True,
+               feed=None, create_external_system=True):
+    """
+    The SyncEngine to execute the batches of a sync with. It is kept for all
+    of the batches, so its RunContext and action factories are reused.
+
+    :param model: The model class to synchronise to
+    :param external_system: The ExternalSystem object, or its name
+    :param ordered: (Optional) Perform the creates, then the updates and
+        finally the deletes. Default: True
+    :param use_transaction: (Optional) Wrap each batch in a DB transaction.
+        Default: True
+    :param feed: (Optional) The ChangeFeed to publish the batches' changes
+        to, once committed. Default: None
+    :param create_external_system: (Optional) If the external system is
+        provided by name, create it if it does not exist. Default: True
+    :return: The SyncEngine
+    """
+    return SyncEngine(model, external_system, ordered=ordered,
+                      use_transaction=use_transaction, feed=feed,
+                      context=RunContext(create_external_system))
+
+
+def sync_batch(model, external_system, rows, ordered=True,
+               use_transaction=True, feed=None, engine=None):
+    """
+    Synchronously build and execute the actions for a batch of rows.
+
+    :param model: The model class to synchronise to
+    :param external_system: The ExternalSystem object
+    :param rows: The list of rows, in the same layout as the CSV input
+    :param ordered: (Optional) Perform the creates, then the updates and
+        finally the deletes. Default: True
+    :param use_transaction: (Optional) Wrap the batch in a DB transaction.
+        Default: True
+    :param feed: (Optional) The ChangeFeed to publish the batch's changes to,
+        once committed. Default: None
+    :param engine: (Optional) The SyncEngine to execute the batch with (see
+        engine_for()), whose options are used instead. Default: A new one
+    :return: Nothing
+    """
+    if engine is None:
+        engine = engine_for(model, external_system, ordered, use_transaction,
+                            feed)
+    engine.sync_rows(rows)
+
+
+async def _rows_of(rows):
+    if hasattr(rows, '__aiter__'):
+        iterator = rows.__aiter__()
+        try:
+            async for row in iterator:
+                yield row
+        finally:
+            # i.e. the sync failed, so the producer is stopped too
+            if hasattr(iterator, 'aclose'):
+                await iterator.aclose()
+    else:
+        for row in rows:
+            yield row
+
+
+async def _next_row(iterator):
+    return await iterator.__anext__()
+
+
+async def sync_async(model, external_system, rows, batch_size=1000,
+                     max_pending=2, max_wait=1.0, create_external_system=True,
+                     **options):
+    """
+    Synchronise rows from an (asynchronous) iterable.
+
+    :param model: The model class to synchronise to
+    :param external_system: The ExternalSystem object, or its name
+    :param rows: An async iterable (or plain iterable) of row dicts, in the
+        same layout as the CSV input (i.e. with action_flags & match_on). An
+        async generator is closed if the sync fails
+    :param batch_size: (Optional) The number of rows executed together (and in
+        one transaction). Default: 1000
+    :param max_pending: (Optional) The number of full batches that can wait
+        for execution before the rows stop being consumed. Default: 2
+    :param max_wait: (Optional) The seconds the first row of a partial batch
+        waits for more rows before the batch is executed anyway, or None to
+        only execute full batches (and the last). Default: 1.0
+    :param create_external_system: (Optional) If the external system is
+        provided by name, create it if it does not exist. Default: True
+    :param options: Passed through to engine_for()
+    :return: The number of rows synchronised
+    """
+    if sync_to_async is None:
+        raise ImportError('asgiref is required for the asyncio API')
+    if batch_size < 1:
+        raise ValueError('batch_size({}) must be positive'.format(batch_size))
+
+    run_sync = sync_to_async(sync_batch, thread_sensitive=True)
+
+    # One engine for all of the batches, so that its caches are reused
+    engine = await sync_to_async(engine_for, thread_sensitive=True)(
+        model, external_system,
+        create_external_system=create_external_system, **options)
+
+    queue = asyncio.Queue(maxsize=max(1, max_pending))
+
+    async def consume():
+        while True:
+            batch = await queue.get()
+            if batch is None:
+                return
+            await run_sync(model, engine.external_system, batch,
+                           engine=engine)
+
+    consumer = asyncio.ensure_future(consume())
+    count = 0
+    batch = []
+
+    async def put(item):
+        # Stop feeding the queue (and propagate the error) if the consumer
+        # has failed, rather than waiting on it forever
+        putter = asyncio.ensure_future(queue.put(item))
+        done, _ = await asyncio.wait([putter, consumer],
+                                     return_when=asyncio.FIRST_COMPLETED)
+        if putter not in done:
+            putter.cancel()
+            consumer.result()
+            raise RuntimeError('Batch consumer stopped unexpectedly')
+
+    loop = asyncio.get_running_loop()
+    iterator = _rows_of(rows)
+    next_row = None
+    deadline = None
+    try:
+        while True:
+            # The next row is awaited in a task, so that it is not cancelled
+            # (i.e. losing the row) when a partial batch is flushed instead
+            if next_row is None:
+                next_row = asyncio.ensure_future(_next_row(iterator))
+            timeout = None
+            if batch and max_wait is not None:
+                timeout = max(0, deadline - loop.time())
+            done, _ = await asyncio.wait([next_row], timeout=timeout)
+            if not done:
+                await put(batch)
+                batch = []
+                continue
+
+            try:
+                row = next_row.result()
+            except StopAsyncIteration:
+                break
+            next_row = None
+            if not batch:
+                deadline = loop.time() + (max_wait or 0)
+            batch.append(row)
+            count += 1
+            if len(batch) >= batch_size:
+                await put(batch)
+                batch = []
+
+        if batch:
+            await put(batch)
+        await put(None)
+        await consumer
+    except BaseException:
+        if next_row is not None:
+            # The rows can only be closed once the next row is not awaited
+            next_row.cancel()
+            await asyncio.wait([next_row])
+        consumer.cancel()
+        await iterator.aclose()
+        raise
+
+    return count
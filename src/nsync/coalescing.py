@@ -0,0 +1,201 @@
+"""
+NSync row coalescing
+
+Input files often contain several rows for the same object (and the same
+object can appear across several files). This module merges the rows that
+are superseded by later rows into them, before any actions are built.
+"""
+from operator import itemgetter
+
+from .actions import ObjectSelector, SyncActions
+from .management.commands.utils import (
+    CsvSyncActionsDecoder,
+    CsvSyncActionsEncoder)
+from .sorting import ExternalSorter
+
+# Entry layout: (group key, sequence, factory index, row)
+_GROUP, _SEQUENCE = 0, 1
+
+
+class RowCoalescer:
+    """
+    Coalesces the rows that target the same object, the later write wins.
+
+    A row is superseded, and merged into the later row, if the later row for
+    the same model:
+
+    - has the same external key (for the same external system); OR
+    - has the same match on fields, with the same values
+
+    The action flags of the rows are combined, and the non-empty values of
+    the later row override those of the earlier row. The merged row takes
+    the place of the later row, so the rows are produced in their original
+    order.
+
+    Rows are not merged if the result would not be the same object or
+    action, i.e. if they have different external keys (or external systems),
+    or if the combined action flags would delete as well as create or update.
+    Those rows are kept, so that each external key is still mapped and a
+    delete is still executed in its place.
+
+    The rows are sorted by an ExternalSorter, so inputs that are larger than
+    memory are spilled to disk.
+    """
+
+    def __init__(self, max_in_memory=None, directory=None):
+        self.max_in_memory = max_in_memory
+        self.directory = directory
+        self.factories = []
+        self.sorter = self.make_sorter(itemgetter(_GROUP, _SEQUENCE))
+        self.count = 0
+
+    def make_sorter(self, key):
+        return ExternalSorter(key, self.max_in_memory, self.directory)
+
+    def index_of(self, factory):
+        for i, known in enumerate(self.factories):
+            if known is factory:
+                return i
+        self.factories.append(factory)
+        return len(self.factories) - 1
+
+    def add(self, factory, row):
+        """
+        Add a row to be coalesced.
+
+        :param factory: The CsvActionFactory the row will be built with
+        :param row: The raw row values
+        :return: Nothing
+        """
+        sequence = self.count
+        self.count += 1
+        self.sorter.add((self.external_key_for(factory, row, sequence),
+                         sequence,
+                         self.index_of(factory),
+                         row))
+
+    @staticmethod
+    def external_key_for(factory, row, sequence):
+        external_key = RowCoalescer.mapped_key(factory, row)
+        if external_key is not None:
+            return (0, factory.model._meta.label,
+                    factory.external_system.pk, external_key)
+        return (1, sequence)
+
+    @staticmethod
+    def match_key_for(factory, row, sequence):
+        match_on = row.get(factory.match_on_label)
+        if match_on:
+            fields = factory.split_match_on(match_on)
+            if not ObjectSelector.OPERATORS.intersection(fields) - {'&'}:
+                fields = sorted(set(fields) - {'&'})
+                return (0, factory.model._meta.label, tuple(fields),
+                        tuple(str(row.get(f)) for f in fields))
+        return (1, sequence)
+
+    @staticmethod
+    def mapped_key(factory, row):
+        """The row's external key, or None if it is not externally mapped"""
+        external_key = factory.clean_external_key(
+            row.get(factory.external_key_label))
+        if factory.is_externally_mappable(external_key):
+            return external_key
+        return None
+
+    @staticmethod
+    def merged_actions(factory, earlier, later):
+        """The combined SyncActions of two rows, or None if they conflict"""
+        try:
+            first = CsvSyncActionsDecoder.decode(
+                earlier.get(factory.action_flags_label))
+            second = CsvSyncActionsDecoder.decode(
+                later.get(factory.action_flags_label))
+            return SyncActions(first.create or second.create,
+                               first.update or second.update,
+                               first.delete or second.delete,
+                               first.force or second.force)
+        except ValueError:
+            return None
+
+    def merge(self, earlier_entry, later_entry):
+        """
+        Merge an earlier row into a later row.
+
+        :return: The entry for the merged row, or None if the rows cannot be
+            merged
+        """
+        (_, _, earlier_index, earlier) = earlier_entry
+        (group, sequence, later_index, later) = later_entry
+        earlier_factory = self.factories[earlier_index]
+        factory = self.factories[later_index]
+
+        earlier_key = self.mapped_key(earlier_factory, earlier)
+        later_key = self.mapped_key(factory, later)
+        if earlier_key is not None or later_key is not None:
+            if earlier_factory is not factory:
+                return None
+            if earlier_key is not None and later_key is not None and \
+                    earlier_key != later_key:
+                return None
+
+        sync_actions = self.merged_actions(factory, earlier, later)
+        if sync_actions is None:
+            return None
+
+        row = dict(earlier)
+        for name, value in later.items():
+            if name not in row or (value != '' and value is not None):
+                row[name] = value
+        if later_key is None:
+            row[factory.external_key_label] = earlier.get(
+                factory.external_key_label)
+        row[factory.match_on_label] = later[factory.match_on_label]
+        row[factory.action_flags_label] = CsvSyncActionsEncoder.encode(
+            sync_actions)
+        return (group, sequence, later_index, row)
+
+    def merge_runs(self, entries):
+        """
+        Merge each entry into the next entry with an equal group key, where
+        possible. The entries must be sorted by group key & sequence.
+        """
+        previous = None
+        for entry in entries:
+            if previous is not None:
+                merged = None
+                if previous[_GROUP] == entry[_GROUP]:
+                    merged = self.merge(previous, entry)
+                if merged is not None:
+                    entry = merged
+                else:
+                    yield previous
+            previous = entry
+        if previous is not None:
+            yield previous
+
+    def __iter__(self):
+        """
+        Produce the coalesced rows, in their original order.
+
+        :return: A generator of (factory, row) tuples
+        """
+        # The rows are merged by external key, then the merged rows by their
+        # match values, and finally put back in order
+        by_match = self.make_sorter(itemgetter(_GROUP, _SEQUENCE))
+        for (_, sequence, index, row) in self.merge_runs(self.sorter):
+            by_match.add((self.match_key_for(self.factories[index], row,
+                                             sequence),
+                          sequence, index, row))
+
+        by_sequence = self.make_sorter(itemgetter(_SEQUENCE))
+        for entry in self.merge_runs(by_match):
+            by_sequence.add(entry)
+
+        for (_, _, index, row) in by_sequence:
+            yield self.factories[index], row
+
+    def actions(self):
+        """Build the actions for the coalesced rows, in their original order"""
+        for factory, row in self:
+            for action in factory.from_dict(row):
+                yield action
@@ -0,0 +1,40 @@
+"""
+NSync run context
+
+A run (i.e. one syncfiles invocation) can synchronise many files for the same
+external systems and models. The RunContext is shared by all of the files of
+a run, so that the external systems and models are only found once per run,
+rather than once per file.
+
+The content types, decoded action flags and the columns to load per kind of
+action are already cached by the actions themselves, so are not kept here.
+"""
+from .management.commands.utils import ExternalSystemHelper, ModelFinder
+
+
+class RunContext:
+    def __init__(self, create_external_system=True):
+        """
+        :param create_external_system: (Optional) Create the external systems
+            that do not exist. Default: True
+        """
+        self.create_external_system = create_external_system
+        self.external_systems = {}
+        self.models = {}
+
+    def external_system(self, name):
+        """The ExternalSystem with the name, found (or created) once"""
+        external_system = self.external_systems.get(name)
+        if external_system is None:
+            external_system = ExternalSystemHelper.find(
+                name, self.create_external_system)
+            self.external_systems[name] = external_system
+        return external_system
+
+    def model(self, app_label, model_name):
+        """The model class, found once"""
+        key = (app_label, model_name)
+        model = self.models.get(key)
+        if model is None:
+            model = self.models[key] = ModelFinder.find(app_label, model_name)
+        return model
@@ -0,0 +1,247 @@
+"""
+NSync delta generation
+
+A daily full file is usually almost identical to the previous one. This
+module keeps a digest of the previous input on disk (one line per key, sorted
+by the key, with a hash of the rows for that key) and compares the current
+input to it with a streaming sorted merge. Only the new, changed and
+disappeared rows are passed on to be synchronised.
+
+The input is sorted with an ExternalSorter and the digest is streamed, so
+memory use stays bounded for large inputs.
+"""
+import hashlib
+import json
+import os
+
+from .actions import ObjectSelector
+from .sorting import ExternalSorter
+
+
+class DeltaFilter:
+    """
+    Filters the rows for a model & external system down to the delta since the
+    previous (committed) run.
+
+    Rows are keyed by their external key or, if they do not have one, by
+    their match on fields & values. For each key in the input:
+
+    - If it is new, or the hash of its rows has changed, its rows are passed
+      on (in their original order)
+    - If it is unchanged, its rows are dropped
+
+    For each key in the previous digest that is not in the input, an
+    (unforced) delete row is generated, with the previous match on values.
+    NB: As for any unforced delete, the object is only deleted if it has an
+    external key mapping, and it is the only mapping to the object.
+
+    The keys whose rows are rejected keep their previous digest entry (or
+    none), so their rows are synchronised again by the next run.
+    """
+
+    def __init__(self, state_path, factory, max_in_memory=None,
+                 directory=None):
+        """
+        :param state_path: The path of the digest of the previous run
+        :param factory: The CsvActionFactory the rows will be built with
+        :param max_in_memory: (Optional) See ExternalSorter
+        :param directory: (Optional) The directory for temporary files
+        """
+        self.state_path = state_path
+        self.new_state_path = state_path + '.new'
+        self.factory = factory
+        self.max_in_memory = max_in_memory
+        self.directory = directory
+        self.sorter = self.make_sorter()
+        self.count = 0
+        self.rejected = set()
+
+    @classmethod
+    def for_factory(cls, directory, factory, **kwargs):
+        """
+        Create the filter with a digest file named after the target, i.e.
+        System_app.Model.jsonl (or app.Model.jsonl without an external
+        system).
+        """
+        name = '{}.jsonl'.format(factory.model._meta.label)
+        if factory.external_system is not None:
+            name = '{}_{}'.format(factory.external_system.name, name)
+        return cls(os.path.join(directory, name), factory, **kwargs)
+
+    def make_sorter(self):
+        return ExternalSorter(lambda entry: (entry[0], entry[1]),
+                              self.max_in_memory, self.directory)
+
+    def add(self, row):
+        """Add a row of the current input"""
+        self.sorter.add((self.key_for(row), self.count, row))
+        self.count += 1
+
+    def add_all(self, rows):
+        for row in rows:
+            self.add(row)
+
+    def key_for(self, row):
+        factory = self.factory
+        external_key = factory.clean_external_key(
+            row.get(factory.external_key_label))
+        if factory.is_externally_mappable(external_key):
+            return json.dumps(['external', external_key])
+
+        match_on = self.match_on_of(row)
+        if ObjectSelector.OPERATORS.intersection(match_on):
+            # Without a simple key, the row is only the 'same' as itself
+            return json.dumps(['row', self.hash_of([row])])
+        return json.dumps(['match', match_on,
+                           [str(row.get(f)) for f in match_on]])
+
+    def match_on_of(self, row):
+        match_on = row.get(self.factory.match_on_label)
+        if not match_on:
+            return []
+        return self.factory.split_match_on(match_on)
+
+    @staticmethod
+    def hash_of(rows):
+        digest = hashlib.sha1()
+        for row in rows:
+            digest.update(json.dumps(row, sort_keys=True,
+                                     default=str).encode('utf-8'))
+        return digest.hexdigest()
+
+    def delete_row_for(self, row):
+        """The row to delete the object of the provided row"""
+        factory = self.factory
+        delete_row = {factory.action_flags_label: 'd',
+                      factory.match_on_label: row.get(factory.match_on_label)}
+        for field_name in self.match_on_of(row):
+            if field_name not in ObjectSelector.OPERATORS:
+                delete_row[field_name] = row.get(field_name)
+        external_key = row.get(factory.external_key_label)
+        if external_key is not None:
+            delete_row[factory.external_key_label] = external_key
+        return delete_row
+
+    def groups(self):
+        """Produce (key, [(sequence, row), ...]) for the sorted input"""
+        key, group = None, []
+        for (entry_key, sequence, row) in self.sorter:
+            if group and entry_key != key:
+                yield key, group
+                group = []
+            key = entry_key
+            group.append((sequence, row))
+        if group:
+            yield key, group
+
+    def previous(self):
+        """Produce the entries of the previous digest, in key order"""
+        if not os.path.exists(self.state_path):
+            return
+        with open(self.state_path) as state:
+            for line in state:
+                yield json.loads(line)
+
+    def rows(self):
+        """
+        Produce the delta rows, and write the new digest (to be committed).
+
+        The factory's rejects are replaced so that the keys of the rejected
+        rows are recorded, so the actions of the rows must be built with it.
+
+        :return: A generator of the new & changed rows (in their original
+            order), followed by the delete rows for the disappeared keys
+        """
+        self.factory.rejects = RejectedKeys(self, self.factory.rejects)
+
+        # The delete rows are sequenced after all of the input rows
+        output = ExternalSorter(lambda entry: entry[0], self.max_in_memory,
+                                self.directory)
+        delete_sequence = self.count
+        previous = self.previous()
+        old = next(previous, None)
+
+        with open(self.new_state_path, 'w') as new_state:
+            for key, group in self.groups():
+                while old is not None and old[0] < key:
+                    output.add((delete_sequence, old[2]))
+                    delete_sequence += 1
+                    old = next(previous, None)
+
+                rows = [row for _, row in group]
+                digest = self.hash_of(rows)
+                if old is None or old[0] != key or old[1] != digest:
+                    output.extend(group)
+                if old is not None and old[0] == key:
+                    old = next(previous, None)
+
+                new_state.write(json.dumps(
+                    [key, digest, self.delete_row_for(rows[-1])]) + '\n')
+
+            while old is not None:
+                output.add((delete_sequence, old[2]))
+                delete_sequence += 1
+                old = next(previous, None)
+
+        for _, row in output:
+            yield row
+
+    def commit(self):
+        """
+        Replace the previous digest with the one for this run, except for the
+        entries of the rejected keys.
+        """
+        if os.path.exists(self.new_state_path):
+            if self.rejected:
+                self.keep_previous(self.rejected)
+            os.replace(self.new_state_path, self.state_path)
+
+    def keep_previous(self, keys):
+        """Replace the new digest's entries of the keys with the previous"""
+        kept_path = self.state_path + '.kept'
+        previous = self.previous()
+        old = next(previous, None)
+        with open(self.new_state_path) as new_state, \
+                open(kept_path, 'w') as kept:
+            for line in new_state:
+                key = json.loads(line)[0]
+                while old is not None and old[0] < key:
+                    # i.e. the rejected delete of a disappeared key
+                    if old[0] in keys:
+                        kept.write(json.dumps(old) + '\n')
+                    old = next(previous, None)
+
+                if key not in keys:
+                    kept.write(line)
+                elif old is not None and old[0] == key:
+                    kept.write(json.dumps(old) + '\n')
+                if old is not None and old[0] == key:
+                    old = next(previous, None)
+
+            while old is not None:
+                if old[0] in keys:
+                    kept.write(json.dumps(old) + '\n')
+                old = next(previous, None)
+        os.replace(kept_path, self.new_state_path)
+
+    def discard(self):
+        """Keep the previous digest, i.e. if the sync failed"""
+        if os.path.exists(self.new_state_path):
+            os.remove(self.new_state_path)
+
+
+class RejectedKeys:
+    """
+    Records the keys of the rejected rows of a DeltaFilter, and passes the
+    rows on to the RejectsWriter (if any).
+    """
+
+    def __init__(self, delta, rejects=None):
+        self.delta = delta
+        self.rejects = rejects
+
+    def write(self, row, reason):
+        if row is not None:
+            self.delta.rejected.add(self.delta.key_for(row))
+        if self.rejects is not None:
+            self.rejects.write(row, reason)
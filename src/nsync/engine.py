@@ -0,0 +1,290 @@
+"""
+NSync sync engine
+
+The SyncEngine builds and executes the actions for rows, with the same
+options as the syncfile and syncfiles commands (which are thin wrappers
+around it). It can be used directly, i.e. from a task queue or a long-lived
+service, to run many small synchronisations without writing the rows to a
+file or parsing any command arguments:
+
+    engine = SyncEngine(Person, 'CRM', ordered=True)
+    engine.sync_rows(rows)
+
+The engine's RunContext, and its action factories, are kept between calls,
+so the external systems, models and the other lookups are only resolved
+once.
+"""
+from .context import RunContext
+from .coalescing import RowCoalescer
+from .delta import DeltaFilter
+from .logging import WarningCounter
+from .management.commands.utils import CsvActionFactory
+from .policies import (
+    BasicSyncPolicy,
+    BatchedSignalsSyncPolicy,
+    ChangeFeedSyncPolicy,
+    ConcurrentSyncPolicy,
+    MergeJoinSyncPolicy,
+    OrderedSyncPolicy,
+    PartitionedSyncPolicy,
+    SnapshotSyncPolicy,
+    TransactionSyncPolicy)
+
+
+class SyncEngine:
+    """
+    Builds the actions for the rows added to it, then executes them together.
+
+    The rows can be for the engine's model and external system, or (i.e. for
+    syncfiles) for any others.
+    """
+
+    def __init__(self, model=None, external_system=None, ordered=False,
+                 use_transaction=True, partitions=1, coalesce=False,
+                 upsert=False, snapshot=False, delta_state=None,
+                 merge_join=False, concurrent=False, batch_signals=False,
+                 feed=None, rejects=None, progress=None, profiler=None,
+                 context=None):
+        """
+        See the options of the syncfile command for the details.
+
+        :param model: (Optional) The model to synchronise the rows to
+        :param external_system: (Optional) The ExternalSystem, or its name
+        :param ordered: (Optional) Execute the creates, then the updates and
+            finally the deletes. Default: False
+        :param use_transaction: (Optional) Wrap the actions in a DB
+            transaction. Default: True
+        :param partitions: (Optional) Execute the actions in this many
+            parallel partitions. Default: 1
+        :param coalesce: (Optional) Drop the superseded rows. Default: False
+        :param upsert: (Optional) Upsert the forced create & update rows.
+            Default: False
+        :param snapshot: (Optional) Treat the rows as a full snapshot of the
+            external system. Default: False
+        :param delta_state: (Optional) The directory to keep the digest of the
+            input in, to only synchronise the changes. Default: None
+        :param merge_join: (Optional) Use the MergeJoinSyncPolicy.
+            Default: False
+        :param concurrent: (Optional) Use the ConcurrentSyncPolicy.
+            Default: False
+        :param batch_signals: (Optional) Send chunk_synced signals rather than
+            the per object signals. Default: False
+        :param feed: (Optional) The ChangeFeed to publish the changes to.
+            Default: None
+        :param rejects: (Optional) The RejectsWriter for the failed rows.
+            Default: None
+        :param progress: (Optional) The ProgressReporter. Default: None
+        :param profiler: (Optional) The Profiler. Default: None
+        :param context: (Optional) The RunContext. Default: A new one
+        """
+        if snapshot and delta_state:
+            raise ValueError('A snapshot cannot be synchronised as a delta')
+        conflicts = self.conflicting_policies(partitions, concurrent,
+                                              merge_join)
+        if conflicts:
+            raise ValueError(conflicts)
+
+        self.context = context or RunContext()
+        if isinstance(external_system, str):
+            external_system = self.context.external_system(external_system)
+        self.model = model
+        self.external_system = external_system
+        self.ordered = ordered
+        self.use_transaction = use_transaction
+        self.partitions = partitions
+        self.coalesce = coalesce
+        self.upsert = upsert
+        self.snapshot = snapshot
+        self.delta_state = delta_state
+        self.merge_join = merge_join
+        self.concurrent = concurrent
+        self.batch_signals = batch_signals
+        self.feed = feed
+        self.rejects = rejects
+        self.progress = progress
+        self.profiler = profiler
+        self.factories = {}
+        self.reset()
+
+    @staticmethod
+    def conflicting_policies(partitions=1, concurrent=False,
+                             merge_join=False):
+        """
+        The error for the policies that cannot be used together, if any.
+
+        :return: The error message, or None
+        """
+        requested = [name for (name, used) in (
+            ('partitions', partitions > 1),
+            ('concurrent', concurrent),
+            ('merge_join', merge_join)) if used]
+        if len(requested) > 1:
+            return 'Only one of partitions (above 1), concurrent and ' \
+                   'merge_join can be used, not {}'.format(
+                       ' and '.join(requested))
+        return None
+
+    def reset(self):
+        """Forget the rows added since the last execute()"""
+        self.actions = []
+        self.deltas = {}
+        self.coalescer = RowCoalescer() if self.coalesce else None
+
+    def factory(self, model=None, external_system=None, rejects=None):
+        """
+        The (shared) CsvActionFactory for the target.
+
+        The factories are only kept per target, as a new RejectsWriter may be
+        used for every file (i.e. by the watcher); the factory's rejects are
+        set to the ones provided on every call instead.
+        """
+        model = model or self.model
+        external_system = external_system or self.external_system
+        if model is None:
+            raise ValueError('No model to synchronise to')
+
+        key = (model, getattr(external_system, 'pk', None))
+        factory = self.factories.get(key)
+        if factory is None:
+            factory = CsvActionFactory(model, external_system,
+                                       use_upsert=self.upsert)
+            self.factories[key] = factory
+        factory.rejects = rejects or self.rejects
+        return factory
+
+    def add_rows(self, rows, model=None, external_system=None, rejects=None):
+        """
+        Add rows to be synchronised by the next execute().
+
+        :param rows: An iterable of row dicts, in the same layout as the CSV
+            input. The rows are not modified.
+        :param model: (Optional) The model, if not the engine's
+        :param external_system: (Optional) The ExternalSystem, if not the
+            engine's
+        :param rejects: (Optional) The RejectsWriter, if not the engine's
+        :return: Nothing
+        """
+        factory = self.factory(model, external_system, rejects)
+        self.add(factory, (dict(row) for row in rows))
+
+    def add_reader(self, reader, model=None, external_system=None,
+                   rejects=None):
+        """
+        Add the rows of a reader (i.e. a CsvRowReader) to be synchronised by
+        the next execute(). See add_rows().
+        """
+        factory = self.factory(model, external_system, rejects)
+        if self.delta_state or self.coalescer:
+            self.add(factory, reader.rows())
+        else:
+            # i.e. a columnar reader builds its actions in batches
+            self.actions.extend(reader.actions(factory))
+
+    def add(self, factory, rows):
+        if self.delta_state:
+            # All of the rows for the same target share one digest
+            target = (getattr(factory.external_system, 'pk', None),
+                      factory.model)
+            if target not in self.deltas:
+                self.deltas[target] = DeltaFilter.for_factory(
+                    self.delta_state, factory)
+            self.deltas[target].add_all(rows)
+        elif self.coalescer:
+            for row in rows:
+                self.coalescer.add(factory, row)
+        else:
+            for row in rows:
+                self.actions.extend(factory.from_dict(row))
+
+    def collect_actions(self):
+        """The actions for all of the rows added since the last execute()"""
+        actions = self.actions
+        for delta in self.deltas.values():
+            for row in delta.rows():
+                if self.coalescer:
+                    self.coalescer.add(delta.factory, row)
+                else:
+                    actions.extend(delta.factory.from_dict(row))
+
+        if self.coalescer:
+            actions.extend(self.coalescer.actions())
+        return actions
+
+    def policy_for(self, actions):
+        """The (wrapped) policy to execute the actions with"""
+        use_transaction = self.use_transaction
+
+        if self.partitions > 1:
+            # Each partition has its own transaction
+            policy = PartitionedSyncPolicy(actions, self.partitions,
+                                           self.ordered)
+            use_transaction = False
+        elif self.concurrent:
+            # Each chunk has its own transaction
+            policy = ConcurrentSyncPolicy(actions, self.ordered)
+            use_transaction = False
+        elif self.merge_join:
+            # Always executes the actions in phases
+            policy = MergeJoinSyncPolicy(actions)
+        elif self.ordered:
+            policy = OrderedSyncPolicy(actions)
+        else:
+            policy = BasicSyncPolicy(actions)
+
+        if self.progress:
+            self.progress.observe(policy)
+
+        if self.snapshot:
+            # Within the transaction, so the recorded keys are too
+            policy = SnapshotSyncPolicy(policy, actions)
+
+        if self.batch_signals:
+            policy = BatchedSignalsSyncPolicy(policy, self.feed)
+        elif self.feed:
+            policy = ChangeFeedSyncPolicy(policy, self.feed)
+
+        if use_transaction:
+            policy = TransactionSyncPolicy(policy)
+        return policy
+
+    def execute(self, actions=None):
+        """
+        Execute the actions for the rows added since the last execute().
+
+        :param actions: (Optional) The actions to execute instead
+        :return: The number of actions executed
+        """
+        if actions is None:
+            actions = self.collect_actions()
+        deltas = self.deltas
+        self.reset()
+
+        if self.profiler:
+            self.profiler.phase('building the actions')
+
+        # The warnings are counted per run, so every run logs its examples
+        counter = WarningCounter()
+        try:
+            with counter.counting():
+                self.policy_for(actions).execute()
+            if self.profiler:
+                self.profiler.phase('executing the actions')
+        except BaseException:
+            for delta in deltas.values():
+                delta.discard()
+            raise
+        else:
+            for delta in deltas.values():
+                delta.commit()
+        finally:
+            counter.summarise()
+        return len(actions)
+
+    def sync_rows(self, rows, model=None, external_system=None):
+        """
+        Synchronise the rows (see add_rows()), in one go.
+
+        :return: The number of actions executed
+        """
+        self.add_rows(rows, model, external_system)
+        return self.execute()
@@ -1,4 +1,10 @@
 import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+_counting = threading.local()
+
 
 # https://docs.python.org/3/howto/logging-cookbook.html#using-custom-message-objects
 class Message(object):
@@ -10,11 +16,81 @@ class Message(object):
         return self.fmt.format(*self.args)
 
 
+def current_counter():
+    """The WarningCounter counting the warnings of this thread, if any"""
+    return getattr(_counting, 'counter', None)
+
+
+class WarningCounter(object):
+    """
+    Counts the warnings of each category (i.e. each logger & message format),
+    so that a bad input does not produce a warning for every row.
+
+    The warnings are only counted within counting() (i.e. for a SyncEngine
+    run), otherwise they are all logged. Only the first example_limit
+    warnings of a category are logged in full, the rest are only counted, and
+    reported by summarise().
+    """
+    example_limit = 10
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = OrderedDict()
+
+    def record(self, logger, fmt):
+        """
+        Count a warning.
+
+        :return: True if the warning should be logged in full
+        """
+        with self.lock:
+            key = (logger, fmt)
+            count = self.counts.get(key, 0) + 1
+            self.counts[key] = count
+            return count <= self.example_limit
+
+    def reset(self):
+        with self.lock:
+            self.counts = OrderedDict()
+
+    @contextmanager
+    def counting(self):
+        """Count the warnings of this thread in this WarningCounter"""
+        previous = current_counter()
+        _counting.counter = self
+        try:
+            yield self
+        finally:
+            _counting.counter = previous
+
+    def summarise(self):
+        """
+        Log the number of warnings of each category that were not logged in
+        full, and reset the counts.
+
+        :return: The counts of the warnings, by (logger name, format)
+        """
+        with self.lock:
+            counts, self.counts = self.counts, OrderedDict()
+
+        for (logger, fmt), count in counts.items():
+            if count > self.example_limit:
+                logger.warning(
+                    '%d warnings like "%s" (only the first %d were logged)',
+                    count, fmt, self.example_limit)
+        return OrderedDict(((logger.name, fmt), count)
+                           for (logger, fmt), count in counts.items())
+
+
 class StyleAdapter(logging.LoggerAdapter):
     def __init__(self, logger, extra=None):
         super(StyleAdapter, self).__init__(logger, extra or {})
 
     def log(self, level, msg, *args, **kwargs):
         if self.isEnabledFor(level):
+            counter = current_counter()
+            if level == logging.WARNING and counter is not None and \
+                    not counter.record(self.logger, msg):
+                return
             msg, kwargs = self.process(msg, kwargs)
             self.logger._log(level, Message(msg, args), (), **kwargs)
@@ -0,0 +1,77 @@
+from django.core.management.base import BaseCommand, CommandError
+import os
+
+from .utils import CsvActionFactory, ModelFinder, RowReaderFinder
+from nsync.models import ExternalSystem
+from nsync.plan import compile_plan
+
+
+class Command(BaseCommand):
+    help = 'Validate a file and compile it into an action plan, to be ' \
+           'synchronised with syncfile --plan'
+
+    def add_arguments(self, parser):
+        # Mandatory
+        parser.add_argument(
+            'ext_system_name',
+            help='The name of the external system to use for storing '
+                 'sync information in relation to')
+        parser.add_argument(
+            'app_label',
+            default=None,
+            help='The name of the application the model is part of')
+        parser.add_argument(
+            'model_name',
+            help='The name of the model to synchronise to')
+        parser.add_argument(
+            'file_name',
+            help='The file to compile')
+        parser.add_argument(
+            'plan_file',
+            help='The action plan file to write')
+
+        # Optional
+        parser.add_argument(
+            '--format',
+            choices=sorted(RowReaderFinder.FORMATS),
+            default=None,
+            help='The format of the file. Default: Determined from the file '
+                 'extension, otherwise csv')
+        parser.add_argument(
+            '--chunk_size',
+            type=int,
+            default=10000,
+            help='The number of rows in each chunk of the plan. '
+                 'Default: 10000')
+
+    def handle(self, *args, **options):
+        model = ModelFinder.find(options['app_label'], options['model_name'])
+        # Only its name is recorded, so the system need not exist (yet)
+        external_system = ExternalSystem(name=options['ext_system_name'])
+
+        filename = options['file_name']
+        if not os.path.exists(filename):
+            raise CommandError("Filename '{}' not found".format(filename))
+
+        file_format = RowReaderFinder.find_format(filename,
+                                                  options.get('format'))
+        mode = RowReaderFinder.FORMATS[file_format].mode
+        with open(filename, mode) as f:
+            reader = RowReaderFinder.find(f, file_format)
+            writer = compile_plan(reader.rows(), options['plan_file'],
+                                  CsvActionFactory(model, external_system),
+                                  os.path.basename(filename),
+                                  options['chunk_size'])
+
+        for name in writer.unknown_columns:
+            self.stderr.write('Column {} is not a field of {}, it is set as '
+                              'an attribute'.format(name, model._meta.label))
+        if writer.errors:
+            for (row, error) in writer.errors[:20]:
+                self.stderr.write('Row {}: {}'.format(row, error))
+            raise CommandError('{} of {} rows are invalid, no plan was '
+                               'written'.format(len(writer.errors),
+                                                writer.rows_read))
+
+        self.stdout.write('Compiled {} rows into {}'.format(
+            writer.footer['rows'], options['plan_file']))
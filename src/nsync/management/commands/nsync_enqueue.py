@@ -0,0 +1,73 @@
+from django.core.management.base import BaseCommand, CommandError
+import os
+
+from .utils import ExternalSystemHelper, ModelFinder, RowReaderFinder
+from nsync.workqueue import enqueue
+
+
+class Command(BaseCommand):
+    help = 'Split a file into chunks, to be synchronised by nsync_worker(s)'
+
+    def add_arguments(self, parser):
+        # Mandatory
+        parser.add_argument(
+            'ext_system_name',
+            help='The name of the external system to use for storing '
+                 'sync information in relation to')
+        parser.add_argument(
+            'app_label',
+            default=None,
+            help='The name of the application the model is part of')
+        parser.add_argument(
+            'model_name',
+            help='The name of the model to synchronise to')
+        parser.add_argument(
+            'file_name',
+            help='The file to synchronise from')
+
+        # Optional
+        parser.add_argument(
+            '--create_external_system',
+            type=bool,
+            default=True,
+            help='The name of the external system to use for storing '
+                 'sync information in relation to')
+        parser.add_argument(
+            '--format',
+            choices=sorted(RowReaderFinder.FORMATS),
+            default=None,
+            help='The format of the file. Default: Determined from the file '
+                 'extension, otherwise csv')
+        parser.add_argument(
+            '--chunk_size',
+            type=int,
+            default=1000,
+            help='The number of rows in each chunk. Default: 1000')
+        parser.add_argument(
+            '--upsert',
+            action='store_true',
+            default=False,
+            help='Perform forced create & update (cu*) rows as a single '
+                 'INSERT ... ON CONFLICT statement per batch of rows, when '
+                 'match_on is a unique constraint')
+
+    def handle(self, *args, **options):
+        external_system = ExternalSystemHelper.find(
+            options['ext_system_name'], options['create_external_system'])
+        model = ModelFinder.find(options['app_label'], options['model_name'])
+
+        filename = options['file_name']
+        if not os.path.exists(filename):
+            raise CommandError("Filename '{}' not found".format(filename))
+
+        file_format = RowReaderFinder.find_format(filename,
+                                                  options.get('format'))
+        mode = RowReaderFinder.FORMATS[file_format].mode
+        with open(filename, mode) as f:
+            reader = RowReaderFinder.find(f, file_format)
+            job = enqueue(external_system, model, reader.rows(),
+                          options['chunk_size'], filename,
+                          options.get('upsert', False))
+
+        self.stdout.write('Queued job {} with {} chunks'.format(
+            job.pk, job.chunks.count()))
@@ -0,0 +1,125 @@
+from django.core.management.base import BaseCommand, CommandError
+import os
+import re
+
+from .syncfiles import DEFAULT_FILE_REGEX
+from nsync.context import RunContext
+from nsync.engine import SyncEngine
+from nsync.signals import ChangeFeed
+from nsync.watch import DirectoryWatcher
+
+
+class Command(BaseCommand):
+    help = 'Synchronise the files that arrive in a directory, as they arrive'
+
+    def add_arguments(self, parser):
+        # Mandatory
+        parser.add_argument(
+            'directory',
+            help='The directory to watch')
+        # Optional
+        parser.add_argument(
+            '--file_name_regex',
+            type=str,
+            default=DEFAULT_FILE_REGEX,
+            help='The regular expression to obtain the system name, app name '
+                 'and model name from each file')
+        parser.add_argument(
+            '--create_external_system',
+            type=bool,
+            default=True,
+            help='If true, the command will create a matching external '
+                 'system object if one cannot be found')
+        parser.add_argument(
+            '--smart_ordering',
+            type=bool,
+            default=True,
+            help='Perform all of the Create actions of each file, then the '
+                 'Update actions, and finally the Delete actions. '
+                 'Default: True')
+        parser.add_argument(
+            '--as_transaction',
+            type=bool,
+            default=True,
+            help='Wrap the actions of each file in a DB transaction. '
+                 'Default:True')
+        parser.add_argument(
+            '--upsert',
+            action='store_true',
+            default=False,
+            help='Perform forced create & update (cu*) rows as a single '
+                 'INSERT ... ON CONFLICT statement per batch of rows, when '
+                 'match_on is a unique constraint')
+        parser.add_argument(
+            '--batch_signals',
+            action='store_true',
+            default=False,
+            help='Send one nsync chunk_synced signal per model with the '
+                 'changed pks, rather than the per object signals')
+        parser.add_argument(
+            '--changes_file',
+            default=None,
+            metavar='PATH',
+            help='Write the pks of the objects created, updated and deleted '
+                 'to a JSON Lines file')
+        parser.add_argument(
+            '--rejects',
+            default=None,
+            metavar='DIRECTORY',
+            help='Write the rows that could not be synchronised to a CSV '
+                 'file per input file (with the same name) in the directory')
+        parser.add_argument(
+            '--done',
+            default=None,
+            metavar='DIRECTORY',
+            help='Where to move the synchronised files. '
+                 'Default: <directory>/done')
+        parser.add_argument(
+            '--failed',
+            default=None,
+            metavar='DIRECTORY',
+            help='Where to move the files that could not be synchronised, '
+                 'with a .error file for each. Default: <directory>/failed')
+        parser.add_argument(
+            '--poll',
+            type=float,
+            default=DirectoryWatcher.poll,
+            metavar='SECONDS',
+            help='How often to check the directory for new files. A file is '
+                 'synchronised once it is unchanged between two checks (or '
+                 'immediately with inotify). Default: {}'.format(
+                     DirectoryWatcher.poll))
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            default=False,
+            help='Synchronise the files already in the directory, then exit')
+
+    def handle(self, *args, **options):
+        directory = options['directory']
+        if not os.path.isdir(directory):
+            raise CommandError("Directory '{}' not found".format(directory))
+
+        feed = None
+        if options.get('changes_file'):
+            feed = ChangeFeed(options['changes_file'])
+        engine = SyncEngine(
+            ordered=options['smart_ordering'],
+            use_transaction=options['as_transaction'],
+            upsert=options.get('upsert', False),
+            batch_signals=options.get('batch_signals', False),
+            feed=feed,
+            context=RunContext(options['create_external_system']))
+        watcher = DirectoryWatcher(directory,
+                                   engine,
+                                   re.compile(options['file_name_regex']),
+                                   options.get('done'),
+                                   options.get('failed'),
+                                   options.get('rejects'),
+                                   options['poll'])
+        try:
+            watcher.run(options.get('once', False))
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write('Synchronised {} files ({} failed)'.format(
+            watcher.processed, watcher.failures))
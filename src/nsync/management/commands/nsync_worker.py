@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand
+
+from nsync.workqueue import Worker
+
+
+class Command(BaseCommand):
+    help = 'Execute the chunks queued by nsync_enqueue'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--name',
+            default=None,
+            help='The name of the worker, recorded on the chunks it claims. '
+                 'Default: hostname:pid')
+        parser.add_argument(
+            '--lease',
+            type=float,
+            default=Worker.lease,
+            metavar='SECONDS',
+            help='How long a claimed chunk is leased for, after which '
+                 'another worker can claim it. Default: {}'.format(
+                     Worker.lease))
+        parser.add_argument(
+            '--max_attempts',
+            type=int,
+            default=Worker.max_attempts,
+            help='The number of times a chunk is tried before its job is '
+                 'failed. Default: {}'.format(Worker.max_attempts))
+        parser.add_argument(
+            '--poll',
+            type=float,
+            default=5.0,
+            metavar='SECONDS',
+            help='How long to wait when there is no chunk to claim. '
+                 'Default: 5')
+        parser.add_argument(
+            '--exit_when_done',
+            action='store_true',
+            default=False,
+            help='Exit once there are no pending jobs, rather than waiting '
+                 'for more')
+        parser.add_argument(
+            '--max_chunks',
+            type=int,
+            default=None,
+            help='Exit after executing this many chunks')
+
+    def handle(self, *args, **options):
+        worker = Worker(options.get('name'), options['lease'],
+                        options['max_attempts'])
+        try:
+            worker.run(options['poll'], options['exit_when_done'],
+                       options.get('max_chunks'))
+        except KeyboardInterrupt:
+            # The lease on an interrupted chunk simply expires
+            pass
+        self.stdout.write('Worker {} executed {} chunks ({} failed)'.format(
+            worker.name, worker.executed, worker.failed))
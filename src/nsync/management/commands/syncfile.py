@@ -1,9 +1,18 @@
 from django.core.management.base import BaseCommand, CommandError
 import os
-import csv
 
-from .utils import ExternalSystemHelper, ModelFinder, CsvActionFactory
-from nsync.policies import BasicSyncPolicy, TransactionSyncPolicy
+from .utils import (
+    ExternalSystemHelper,
+    ModelFinder,
+    ProfilerFinder,
+    ProgressFinder,
+    CsvRowReader,
+    RowReaderFinder)
+from nsync.engine import SyncEngine
+from nsync.plan import PlanRowReader
+from nsync.profiling import Profiler
+from nsync.rejects import RejectsWriter
+from nsync.signals import ChangeFeed
 
 
 class Command(BaseCommand):
@@ -38,8 +47,126 @@ class Command(BaseCommand):
             type=bool,
             default=True,
             help='Wrap all of the actions in a DB transaction Default:True')
+        parser.add_argument(
+            '--format',
+            choices=sorted(RowReaderFinder.FORMATS),
+            default=None,
+            help='The format of the file. Default: Determined from the file '
+                 'extension, otherwise csv')
+        parser.add_argument(
+            '--plan',
+            action='store_true',
+            default=False,
+            help='The file is an action plan compiled by nsync_compile, '
+                 'which is synchronised without parsing or validating the '
+                 'rows again')
+        parser.add_argument(
+            '--partitions',
+            type=int,
+            default=1,
+            help='Execute the actions in this many parallel partitions, each '
+                 'with its own DB connection and transaction. Default: 1')
+        parser.add_argument(
+            '--delta_state',
+            default=None,
+            help='A directory to keep a digest of the input in. Only the '
+                 'rows that are new or changed since the previous run (and '
+                 'delete rows for the ones that disappeared) are synchronised')
+        parser.add_argument(
+            '--snapshot',
+            action='store_true',
+            default=False,
+            help='Treat the input as a full snapshot of the external system. '
+                 'After the sync, the key mappings for external keys that '
+                 'were not in the input are deleted, along with the objects '
+                 'they solely reference')
+        parser.add_argument(
+            '--upsert',
+            action='store_true',
+            default=False,
+            help='Perform forced create & update (cu*) rows as a single '
+                 'INSERT ... ON CONFLICT statement per batch of rows, when '
+                 'match_on is a unique constraint. NB: The objects\' save() '
+                 'methods are not called and no save signals are sent')
+        parser.add_argument(
+            '--coalesce',
+            action='store_true',
+            default=False,
+            help='Drop the rows that are superseded by a later row for the '
+                 'same external key or match values (last write wins)')
+        parser.add_argument(
+            '--merge_join',
+            action='store_true',
+            default=False,
+            help='Find the objects for the create & update rows by sorting '
+                 'the rows and streaming the existing objects in the same '
+                 'order, rather than with a query per row. Updates that do '
+                 'not change an object are not saved')
+        parser.add_argument(
+            '--rejects',
+            default=None,
+            metavar='PATH',
+            help='Write the rows that could not be synchronised to a CSV '
+                 '(or, for a JSON Lines input, a JSON Lines) file, with the '
+                 'reason for each. The file can be corrected '
+                 'and synchronised again')
+        parser.add_argument(
+            '--progress',
+            type=float,
+            default=None,
+            metavar='SECONDS',
+            help='Report the progress to stderr at this interval')
+        parser.add_argument(
+            '--progress_file',
+            default=None,
+            metavar='PATH',
+            help='Write the progress as JSON to this file (at the '
+                 '--progress interval, or every 10 seconds)')
+        parser.add_argument(
+            '--concurrent',
+            action='store_true',
+            default=False,
+            help='Allow other syncs of the same models to run at the same '
+                 'time, by locking the affected objects (in a consistent '
+                 'order) per chunk of rows and retrying chunks that lose a '
+                 'race. Each chunk is committed separately')
+        parser.add_argument(
+            '--batch_signals',
+            action='store_true',
+            default=False,
+            help='Do not send the per object signals (i.e. post_save) for '
+                 'the changes, instead send one nsync chunk_synced signal '
+                 'per model with the changed pks, once committed')
+        parser.add_argument(
+            '--changes_file',
+            default=None,
+            metavar='PATH',
+            help='Write the pks of the objects created, updated and deleted '
+                 'to a JSON Lines file (a line per model, per committed '
+                 'chunk)')
+        parser.add_argument(
+            '--profile',
+            choices=Profiler.MODES,
+            default=None,
+            help='Profile the run. "cpu" writes cProfile stats to the '
+                 '--profile_file, "memory" reports the top allocation sites '
+                 'after each phase to stderr')
+        parser.add_argument(
+            '--profile_file',
+            default=None,
+            metavar='PATH',
+            help='The file to write the CPU profile stats to '
+                 '(default: nsync.pstats)')
 
     def handle(self, *args, **options):
+        if options.get('snapshot') and options.get('delta_state'):
+            raise CommandError('A snapshot cannot be synchronised as a delta')
+        conflicts = SyncEngine.conflicting_policies(
+            options.get('partitions', 1), options.get('concurrent', False),
+            options.get('merge_join', False))
+        if conflicts:
+            raise CommandError(conflicts)
+
         external_system = ExternalSystemHelper.find(
             options['ext_system_name'], options['create_external_system'])
         model = ModelFinder.find(options['app_label'], options['model_name'])
@@ -48,27 +175,95 @@ class Command(BaseCommand):
         if not os.path.exists(filename):
             raise CommandError("Filename '{}' not found".format(filename))
 
-        with open(filename) as f:
-            # TODO - Review - This indirection is only due to issues in
-            # getting the mocks in the tests to work
-            SyncFileAction.sync(external_system,
-                                model,
-                                f,
-                                options['as_transaction'])
+        file_format = None
+        if options.get('plan'):
+            mode = PlanRowReader.mode
+        else:
+            file_format = RowReaderFinder.find_format(filename,
+                                                      options.get('format'))
+            mode = RowReaderFinder.FORMATS[file_format].mode
+        rejects = None
+        if options.get('rejects'):
+            rejects = RejectsWriter(options['rejects'],
+                                    RejectsWriter.format_for(file_format))
+        progress = ProgressFinder.find(self.stderr, options)
+        if progress:
+            progress.start()
+        profiler = ProfilerFinder.find(self.stderr, options)
+        if profiler:
+            profiler.start()
+        feed = None
+        if options.get('changes_file'):
+            feed = ChangeFeed(options['changes_file'])
+        try:
+            with open(filename, mode) as f:
+                if options.get('plan'):
+                    try:
+                        reader = PlanRowReader(f)
+                        reader.check(model, external_system)
+                    except ValueError as e:
+                        raise CommandError('{}: {}'.format(filename, e))
+                else:
+                    reader = RowReaderFinder.find(f, file_format)
+                try:
+                    # TODO - Review - This indirection is only due to issues
+                    # in getting the mocks in the tests to work
+                    SyncFileAction.sync(
+                        external_system,
+                        model,
+                        f,
+                        options['as_transaction'],
+                        reader=reader,
+                        partitions=options.get('partitions', 1),
+                        coalesce=options.get('coalesce', False),
+                        upsert=options.get('upsert', False),
+                        snapshot=options.get('snapshot', False),
+                        delta_state=options.get('delta_state'),
+                        merge_join=options.get('merge_join', False),
+                        rejects=rejects,
+                        progress=progress,
+                        profiler=profiler,
+                        batch_signals=options.get('batch_signals', False),
+                        feed=feed,
+                        concurrent=options.get('concurrent', False))
+                finally:
+                    reader.close()
+        finally:
+            if profiler:
+                profiler.stop()
+            if rejects:
+                rejects.close()
+            if progress:
+                progress.stop()
 
 
 class SyncFileAction:
     @staticmethod
-    def sync(external_system, model, file, use_transaction):
-        reader = csv.DictReader(file)
-        builder = CsvActionFactory(model, external_system)
-        actions = []
-        for d in reader:
-            actions.extend(builder.from_dict(d))
-
-        policy = BasicSyncPolicy(actions)
-
-        if use_transaction:
-            policy = TransactionSyncPolicy(policy)
+    def sync(external_system, model, file, use_transaction, *, reader=None,
+             partitions=1, coalesce=False, upsert=False, snapshot=False,
+             delta_state=None, merge_join=False, rejects=None, progress=None,
+             profiler=None, batch_signals=False, feed=None,
+             concurrent=False):
+        # The options are keyword only, as there are too many to be passed
+        # in order safely
+        if reader is None:
+            reader = CsvRowReader(file)
+        if progress:
+            progress.watch(reader, file)
 
-        policy.execute()
+        engine = SyncEngine(model, external_system,
+                            use_transaction=use_transaction,
+                            partitions=partitions,
+                            coalesce=coalesce,
+                            upsert=upsert,
+                            snapshot=snapshot,
+                            delta_state=delta_state,
+                            merge_join=merge_join,
+                            concurrent=concurrent,
+                            batch_signals=batch_signals,
+                            feed=feed,
+                            rejects=rejects,
+                            progress=progress,
+                            profiler=profiler)
+        engine.add_reader(reader)
+        engine.execute()
@@ -1,22 +1,22 @@
 from django.core.management.base import BaseCommand, CommandError
 import os
-import csv
 import argparse
 import re
 from .utils import (
-    ExternalSystemHelper,
-    ModelFinder,
+    ProfilerFinder,
+    ProgressFinder,
     SupportedFileChecker,
-    CsvActionFactory)
-from nsync.policies import (
-    BasicSyncPolicy,
-    OrderedSyncPolicy,
-    TransactionSyncPolicy
-)
+    RowReaderFinder)
+from nsync.context import RunContext
+from nsync.engine import SyncEngine
+from nsync.profiling import Profiler
+from nsync.rejects import RejectsWriter
+from nsync.signals import ChangeFeed
 
 (DEFAULT_FILE_REGEX) = (r'(?P<external_system>[a-zA-Z0-9]+)_'
                         r'(?P<app_name>[a-zA-Z0-9]+)_'
-                        r'(?P<model_name>[a-zA-Z0-9]+).*\.csv')
+                        r'(?P<model_name>[a-zA-Z0-9]+).*'
+                        r'\.(csv|jsonl|ndjson|parquet|arrow|feather|ipc)')
 
 
 class Command(BaseCommand):
@@ -52,9 +52,108 @@ class Command(BaseCommand):
             type=bool,
             default=True,
             help='Wrap all of the actions in a DB transaction Default:True')
+        parser.add_argument(
+            '--partitions',
+            type=int,
+            default=1,
+            help='Execute the actions in this many parallel partitions, each '
+                 'with its own DB connection and transaction. Default: 1')
+        parser.add_argument(
+            '--delta_state',
+            default=None,
+            help='A directory to keep a digest of the input in. Only the '
+                 'rows that are new or changed since the previous run (and '
+                 'delete rows for the ones that disappeared) are synchronised')
+        parser.add_argument(
+            '--snapshot',
+            action='store_true',
+            default=False,
+            help='Treat the input as a full snapshot of the external system. '
+                 'After the sync, the key mappings for external keys that '
+                 'were not in the input are deleted, along with the objects '
+                 'they solely reference')
+        parser.add_argument(
+            '--upsert',
+            action='store_true',
+            default=False,
+            help='Perform forced create & update (cu*) rows as a single '
+                 'INSERT ... ON CONFLICT statement per batch of rows, when '
+                 'match_on is a unique constraint. NB: The objects\' save() '
+                 'methods are not called and no save signals are sent')
+        parser.add_argument(
+            '--coalesce',
+            action='store_true',
+            default=False,
+            help='Drop the rows that are superseded by a later row (in any '
+                 'of the files) for the same model and external key or '
+                 'match values (last write wins)')
+        parser.add_argument(
+            '--merge_join',
+            action='store_true',
+            default=False,
+            help='Find the objects for the create & update rows by sorting '
+                 'the rows and streaming the existing objects in the same '
+                 'order, rather than with a query per row. Updates that do '
+                 'not change an object are not saved')
+        parser.add_argument(
+            '--rejects',
+            default=None,
+            metavar='DIRECTORY',
+            help='Write the rows that could not be synchronised to a CSV '
+                 '(or JSON Lines) file per input file (with the same name) '
+                 'in the '
+                 'directory, with the reason for each. The files can be '
+                 'corrected and synchronised again')
+        parser.add_argument(
+            '--progress',
+            type=float,
+            default=None,
+            metavar='SECONDS',
+            help='Report the progress to stderr at this interval')
+        parser.add_argument(
+            '--progress_file',
+            default=None,
+            metavar='PATH',
+            help='Write the progress as JSON to this file (at the '
+                 '--progress interval, or every 10 seconds)')
+        parser.add_argument(
+            '--concurrent',
+            action='store_true',
+            default=False,
+            help='Allow other syncs of the same models to run at the same '
+                 'time, by locking the affected objects (in a consistent '
+                 'order) per chunk of rows and retrying chunks that lose a '
+                 'race. Each chunk is committed separately')
+        parser.add_argument(
+            '--batch_signals',
+            action='store_true',
+            default=False,
+            help='Do not send the per object signals (i.e. post_save) for '
+                 'the changes, instead send one nsync chunk_synced signal '
+                 'per model with the changed pks, once committed')
+        parser.add_argument(
+            '--changes_file',
+            default=None,
+            metavar='PATH',
+            help='Write the pks of the objects created, updated and deleted '
+                 'to a JSON Lines file (a line per model, per committed '
+                 'chunk)')
+        parser.add_argument(
+            '--profile',
+            choices=Profiler.MODES,
+            default=None,
+            help='Profile the run. "cpu" writes cProfile stats to the '
+                 '--profile_file, "memory" reports the top allocation sites '
+                 'after each phase to stderr')
+        parser.add_argument(
+            '--profile_file',
+            default=None,
+            metavar='PATH',
+            help='The file to write the CPU profile stats to '
+                 '(default: nsync.pstats)')
 
     def handle(self, *args, **options):
-        TestableCommand(**options).execute()
+        TestableCommand(report_stream=self.stderr, **options).execute()
 
 
 class TestableCommand:
@@ -63,24 +162,63 @@ class TestableCommand:
         self.pattern = re.compile(options['file_name_regex'])
         self.create_external_system = options['create_external_system']
         self.ordered = options['smart_ordering']
-        self.use_transaction = options['as_transaction']
+        self.snapshot = options.get('snapshot', False)
+        self.delta_state = options.get('delta_state')
+        if self.snapshot and self.delta_state:
+            raise CommandError('A snapshot cannot be synchronised as a delta')
+        conflicts = SyncEngine.conflicting_policies(
+            options.get('partitions', 1), options.get('concurrent', False),
+            options.get('merge_join', False))
+        if conflicts:
+            raise CommandError(conflicts)
+        feed = None
+        if options.get('changes_file'):
+            feed = ChangeFeed(options['changes_file'])
+        self.rejects_directory = options.get('rejects')
+        self.rejects = []
+        self.progress = ProgressFinder.find(options.get('report_stream'),
+                                            options)
+        self.profiler = ProfilerFinder.find(options.get('report_stream'),
+                                            options)
+        # Shares the lookups for the same systems & models across the files
+        self.context = RunContext(self.create_external_system)
+        self.engine = SyncEngine(
+            ordered=self.ordered,
+            use_transaction=options['as_transaction'],
+            partitions=options.get('partitions', 1),
+            coalesce=options.get('coalesce', False),
+            upsert=options.get('upsert', False),
+            snapshot=self.snapshot,
+            delta_state=self.delta_state,
+            merge_join=options.get('merge_join', False),
+            concurrent=options.get('concurrent', False),
+            batch_signals=options.get('batch_signals', False),
+            feed=feed,
+            progress=self.progress,
+            profiler=self.profiler,
+            context=self.context)
 
     def execute(self):
-        actions = self.collect_all_actions()
-
-        if self.ordered:
-            policy = OrderedSyncPolicy(actions)
-        else:
-            policy = BasicSyncPolicy(actions)
+        if self.progress:
+            self.progress.start()
+        if self.profiler:
+            self.profiler.start()
+        try:
+            self.execute_actions(self.collect_all_actions())
+        finally:
+            if self.profiler:
+                self.profiler.stop()
+            if self.progress:
+                self.progress.stop()
 
-        if self.use_transaction:
-            policy = TransactionSyncPolicy(policy)
-
-        policy.execute()
+    def execute_actions(self, actions):
+        try:
+            self.engine.execute(actions)
+        finally:
+            for rejects in self.rejects:
+                rejects.close()
 
     def collect_all_actions(self):
-        actions = []
-
         for f in self.files:
             if not SupportedFileChecker.is_valid(f):
                 raise CommandError('Unsupported file:{}'.format(f))
@@ -88,15 +226,29 @@ class TestableCommand:
             basename = os.path.basename(f.name)
             (system, app, model) = TargetExtractor(self.pattern).extract(
                 basename)
-            external_system = ExternalSystemHelper.find(
-                system, self.create_external_system)
-            model = ModelFinder.find(app, model)
-
-            reader = csv.DictReader(f)
-            builder = CsvActionFactory(model, external_system)
-            for d in reader:
-                actions.extend(builder.from_dict(d))
-        return actions
+            external_system = self.context.external_system(system)
+            model = self.context.model(app, model)
+
+            reader = RowReaderFinder.find(f)
+            if self.progress:
+                self.progress.watch(reader, f)
+            self.engine.add_reader(reader, model, external_system,
+                                   self.rejects_for(basename))
+
+        return self.engine.collect_actions()
+
+    def rejects_for(self, basename):
+        """The RejectsWriter for an input file, if rejects are wanted"""
+        if not self.rejects_directory:
+            return None
+        # Keep the name the pattern matches, with the rejects' extension
+        file_format = RejectsWriter.format_for(
+            RowReaderFinder.find_format(basename))
+        name = '{}.{}'.format(os.path.splitext(basename)[0], file_format)
+        rejects = RejectsWriter(os.path.join(self.rejects_directory, name),
+                                file_format)
+        self.rejects.append(rejects)
+        return rejects
 
 
 class TargetExtractor:
@@ -1,9 +1,23 @@
 from django.core.management.base import CommandError  # TODO replace error
 from django.apps.registry import apps
 import csv
+import json
+import numbers
+import os
+from itertools import repeat
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # pragma: no cover
+    pyarrow = None
 
 from nsync.models import ExternalSystem
 from nsync.actions import ActionFactory, SyncActions
+from nsync.profiling import Profiler
+from nsync.progress import ProgressReporter
+from nsync.rejects import RejectsWriter
 
 
 class SupportedFileChecker:
@@ -24,6 +38,37 @@ class ModelFinder:
         return apps.get_model(app_label, model_name)
 
 
+class ProgressFinder:
+    @staticmethod
+    def find(stderr, options):
+        """
+        The ProgressReporter for the --progress & --progress_file options.
+
+        :return: The ProgressReporter, or None if progress is not reported
+        """
+        progress = options.get('progress')
+        progress_file = options.get('progress_file')
+        if not progress and not progress_file:
+            return None
+        return ProgressReporter(progress or 10.0,
+                                stderr if progress else None,
+                                progress_file)
+
+
+class ProfilerFinder:
+    @staticmethod
+    def find(stderr, options):
+        """
+        The Profiler for the --profile & --profile_file options.
+
+        :return: The Profiler, or None if the run is not profiled
+        """
+        if not options.get('profile'):
+            return None
+        return Profiler(options['profile'], options.get('profile_file'),
+                        stderr)
+
+
 class ExternalSystemHelper:
     @staticmethod
     def find(name, create=True):
@@ -47,21 +92,259 @@ class CsvActionFactory(ActionFactory):
     external_key_label = 'external_key'
     match_on_label = 'match_on'
     match_on_delimiter = ' '
+    reject_reason_label = RejectsWriter.reason_label
+
+    def __init__(self, model, external_system=None, use_upsert=False,
+                 rejects=None):
+        """
+        :param rejects: (Optional) The RejectsWriter to record the rows of
+            the failed actions to. Default: None
+        """
+        super(CsvActionFactory, self).__init__(model, external_system,
+                                               use_upsert)
+        self.rejects = rejects
 
     def from_dict(self, raw_values):
         if not raw_values:
             return []
 
+        # A rejects file can be synchronised again as is
+        raw_values.pop(self.reject_reason_label, None)
+        row = self.input_row(raw_values) if self.rejects else None
+
         action_flags = raw_values.pop(self.action_flags_label)
-        match_on = raw_values.pop(self.match_on_label)
-        match_on = match_on.split(
-            self.match_on_delimiter)
-        external_system_key = raw_values.pop(self.external_key_label, None)
+        match_on = self.split_match_on(raw_values.pop(self.match_on_label))
+        external_system_key = self.clean_external_key(
+            raw_values.pop(self.external_key_label, None))
 
         sync_actions = CsvSyncActionsDecoder.decode(action_flags)
 
-        return self.build(sync_actions, match_on,
-                          external_system_key, raw_values)
+        return self.track(self.build(sync_actions, match_on,
+                                     external_system_key, raw_values), row)
+
+    def from_columns(self, columns):
+        """
+        Build the actions for a batch of typed columns.
+
+        The action flags and match on values are decoded once per distinct
+        value in the batch, rather than once per row.
+
+        :param columns: A dict of column name to the list of values for the
+            rows in the batch
+        :return: The list of actions for all rows in the batch
+        """
+        columns = dict(columns)
+        columns.pop(self.reject_reason_label, None)
+        all_flags = columns.pop(self.action_flags_label)
+        all_match_on = columns.pop(self.match_on_label)
+        all_keys = columns.pop(self.external_key_label,
+                               [None] * len(all_flags))
+        names = list(columns)
+        values = [columns[name] for name in names]
+
+        # The values of the other columns, transposed into one tuple per row
+        all_values = zip(*values) if values else repeat((), len(all_flags))
+
+        decoded_flags = {}
+        decoded_match_on = {}
+        actions = []
+        for (action_flags, raw_match_on, external_key, row_values) in zip(
+                all_flags, all_match_on, all_keys, all_values):
+            sync_actions = decoded_flags.get(action_flags)
+            if sync_actions is None:
+                sync_actions = CsvSyncActionsDecoder.decode(action_flags)
+                decoded_flags[action_flags] = sync_actions
+
+            hashable = (raw_match_on if not isinstance(raw_match_on, list)
+                        else tuple(raw_match_on))
+            match_on = decoded_match_on.get(hashable)
+            if match_on is None:
+                match_on = self.split_match_on(raw_match_on)
+                decoded_match_on[hashable] = match_on
+
+            fields = dict(zip(names, row_values))
+            row = None
+            if self.rejects:
+                row = dict(fields)
+                row[self.action_flags_label] = action_flags
+                row[self.match_on_label] = raw_match_on
+                row[self.external_key_label] = external_key
+                row = self.input_row(row)
+            actions.extend(self.track(
+                self.build(sync_actions, match_on,
+                           self.clean_external_key(external_key), fields),
+                row))
+        return actions
+
+    def input_row(self, raw_values):
+        """A copy of the input row, as it would be written to a CSV file"""
+        row = dict(raw_values)
+        match_on = row.get(self.match_on_label)
+        if isinstance(match_on, (list, tuple)):
+            row[self.match_on_label] = self.match_on_delimiter.join(match_on)
+        return row
+
+    def track(self, actions, row):
+        """Record where the actions should record their row if rejected"""
+        if self.rejects is not None:
+            for action in actions:
+                action.rejects = self.rejects
+                action.row = row
+        return actions
+
+    def split_match_on(self, match_on):
+        """Typed inputs may already provide the match on fields as a list"""
+        if isinstance(match_on, (list, tuple)):
+            return list(match_on)
+        return match_on.split(self.match_on_delimiter)
+
+    @staticmethod
+    def clean_external_key(external_key):
+        """Typed inputs may provide integer keys, which are mapped as text"""
+        if isinstance(external_key, numbers.Integral) and \
+                not isinstance(external_key, bool):
+            return str(external_key)
+        return external_key
+
+
+class CsvRowReader:
+    """
+    Reads rows from a CSV file, as a dict of strings per row.
+
+    The number of rows read so far is kept in rows_read (i.e. for the
+    ProgressReporter).
+    """
+    mode = 'r'
+
+    def __init__(self, file):
+        self.file = file
+        self.rows_read = 0
+
+    def rows(self):
+        for row in csv.DictReader(self.file):
+            self.rows_read += 1
+            yield row
+
+    def actions(self, factory):
+        """
+        Generate the actions for the input, using the provided factory.
+
+        :param factory: The CsvActionFactory to build the actions with
+        :return: A generator of the actions
+        """
+        for row in self.rows():
+            for action in factory.from_dict(row):
+                yield action
+
+    def close(self):
+        """Release the resources of the reader (the file is not closed)"""
+        pass
+
+
+class JsonLinesRowReader(CsvRowReader):
+    """
+    Reads rows from a JSON Lines file, as a dict of typed values per row.
+
+    Each line is parsed as it is read, so the file is never held in memory.
+    Blank lines are ignored.
+    """
+
+    def rows(self):
+        for line in self.file:
+            if line.strip():
+                self.rows_read += 1
+                yield json.loads(line)
+
+
+class ColumnarRowReader(CsvRowReader):
+    """
+    Reads batches of typed columns from a Parquet or Arrow IPC file.
+
+    Requires pyarrow. Rather than producing rows, the batches are handed
+    directly to the action factory, so no per-row string parsing occurs.
+    """
+    mode = 'rb'
+    batch_size = 10000
+
+    def __init__(self, file, file_format='parquet'):
+        if pyarrow is None:
+            raise CommandError('pyarrow is required to read {} files'.format(
+                file_format))
+        # Text files (i.e. from the syncfiles arguments) expose their
+        # underlying binary stream
+        super(ColumnarRowReader, self).__init__(getattr(file, 'buffer', file))
+        self.file_format = file_format
+
+    def batches(self):
+        if self.file_format == 'parquet':
+            for batch in pyarrow.parquet.ParquetFile(self.file).iter_batches(
+                    batch_size=self.batch_size):
+                self.rows_read += batch.num_rows
+                yield batch.to_pydict()
+        else:
+            reader = pyarrow.ipc.open_file(self.file)
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                self.rows_read += batch.num_rows
+                yield batch.to_pydict()
+
+    def rows(self):
+        for columns in self.batches():
+            names = list(columns)
+            for values in zip(*(columns[name] for name in names)):
+                yield dict(zip(names, values))
+
+    def actions(self, factory):
+        for columns in self.batches():
+            for action in factory.from_columns(columns):
+                yield action
+
+
+class RowReaderFinder:
+    FORMATS = {
+        'csv': CsvRowReader,
+        'jsonl': JsonLinesRowReader,
+        'parquet': ColumnarRowReader,
+        'arrow': ColumnarRowReader,
+    }
+    EXTENSIONS = {
+        '.csv': 'csv',
+        '.jsonl': 'jsonl',
+        '.ndjson': 'jsonl',
+        '.parquet': 'parquet',
+        '.arrow': 'arrow',
+        '.feather': 'arrow',
+        '.ipc': 'arrow',
+    }
+
+    @staticmethod
+    def find_format(filename, file_format=None):
+        """Find the input format, by name or from the file extension"""
+        if file_format:
+            if file_format not in RowReaderFinder.FORMATS:
+                raise CommandError('Unsupported format "{}"'.format(
+                    file_format))
+            return file_format
+
+        extension = os.path.splitext(filename)[1].lower()
+        return RowReaderFinder.EXTENSIONS.get(extension, 'csv')
+
+    @staticmethod
+    def find(file, file_format=None):
+        """
+        Create the reader for the provided (open) file.
+
+        :param file: The file to read from
+        :param file_format: (Optional) One of the FORMATS, otherwise it is
+            determined from the file's extension (defaulting to CSV)
+        :return: The reader object
+        """
+        file_format = RowReaderFinder.find_format(
+            getattr(file, 'name', ''), file_format)
+        reader_class = RowReaderFinder.FORMATS[file_format]
+        if reader_class is ColumnarRowReader:
+            return ColumnarRowReader(file, file_format)
+        return reader_class(file)
 
 
 class CsvSyncActionsEncoder:
@@ -75,8 +358,27 @@ class CsvSyncActionsEncoder:
 
 
 class CsvSyncActionsDecoder:
+    # The SyncActions per flags string, which are shared by all of the rows
+    # with the same flags (so must not be modified)
+    interned = {}
+    max_interned = 1000
+
     @staticmethod
     def decode(action_flags):
+        try:
+            return CsvSyncActionsDecoder.interned[action_flags]
+        except (KeyError, TypeError):
+            pass
+
+        sync_actions = CsvSyncActionsDecoder.build(action_flags)
+        if isinstance(action_flags, str) and \
+                len(CsvSyncActionsDecoder.interned) < \
+                CsvSyncActionsDecoder.max_interned:
+            CsvSyncActionsDecoder.interned[action_flags] = sync_actions
+        return sync_actions
+
+    @staticmethod
+    def build(action_flags):
         create = False
         update = False
         delete = False
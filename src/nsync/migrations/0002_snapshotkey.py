@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-19 09:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nsync', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SnapshotKey',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('snapshot', models.CharField(help_text='The identifier of the synchronisation run.', max_length=32)),
+                ('external_key', models.CharField(help_text='An external key that was present in the snapshot.', max_length=80)),
+            ],
+            options={
+                'verbose_name': 'Snapshot Key',
+                'unique_together': {('snapshot', 'external_key')},
+            },
+        ),
+    ]
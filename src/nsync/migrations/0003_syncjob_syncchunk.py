@@ -0,0 +1,49 @@
+# Generated by Django 4.2.30 on 2026-10-19 09:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nsync', '0002_snapshotkey'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(help_text='The label (app_label.ModelName) of the model to synchronise to.', max_length=200)),
+                ('source', models.CharField(blank=True, help_text='The file the rows were read from.', max_length=255)),
+                ('use_upsert', models.BooleanField(default=False)),
+                ('phase', models.PositiveSmallIntegerField(default=0, help_text='The index of the phase being executed.')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('done', 'Done'), ('failed', 'Failed')], db_index=True, default='pending', max_length=10)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('external_system', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='nsync.externalsystem')),
+            ],
+            options={
+                'verbose_name': 'Sync Job',
+            },
+        ),
+        migrations.CreateModel(
+            name='SyncChunk',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sequence', models.PositiveIntegerField()),
+                ('rows', models.TextField(help_text='The rows of the chunk, as JSON.')),
+                ('phase', models.PositiveSmallIntegerField(default=0, help_text='The index of the next phase to execute for the chunk.')),
+                ('lease_owner', models.CharField(blank=True, max_length=100)),
+                ('lease_expires', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='nsync.syncjob')),
+            ],
+            options={
+                'verbose_name': 'Sync Chunk',
+                'indexes': [models.Index(fields=['job', 'phase'], name='nsync_chunk_phase_idx')],
+                'unique_together': {('job', 'sequence')},
+            },
+        ),
+    ]
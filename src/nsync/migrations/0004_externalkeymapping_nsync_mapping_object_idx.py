@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-19 09:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nsync', '0003_syncjob_syncchunk'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='externalkeymapping',
+            index=models.Index(fields=['content_type', 'object_id'], name='nsync_mapping_object_idx'),
+        ),
+    ]
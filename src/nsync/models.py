@@ -1,5 +1,9 @@
-from django.db import models
-from django.contrib.contenttypes.fields import GenericForeignKey
+from collections import defaultdict
+
+from django.db import connections, models
+from django.contrib.contenttypes.fields import (
+    GenericForeignKey,
+    GenericRelation)
 from django.contrib.contenttypes.models import ContentType
 
 
@@ -29,6 +33,66 @@ class ExternalSystem(models.Model):
         return self.description if self.description else self.name
 
 
+class ExternalKeyMappingManager(models.Manager):
+    # The most keys looked up per query (less if the backend limits the
+    # number of query parameters, i.e. SQLite)
+    resolve_batch_size = 5000
+
+    def resolve_many(self, system, keys, model=None):
+        """
+        Find the objects that the external keys of a system are mapped to.
+
+        The mappings are found in batches of keys, and the objects are then
+        found with a query per model (rather than per key).
+
+        :param system: The ExternalSystem, or its name
+        :param keys: The external keys
+        :param model: (Optional) Only resolve the keys mapped to objects of
+            this model. Default: None
+        :return: A dict of the external key to the object, for the keys that
+            are mapped to an (existing) object
+        """
+        keys = list(dict.fromkeys(keys))
+        mappings = self.get_queryset()
+        if isinstance(system, str):
+            mappings = mappings.filter(external_system__name=system)
+        else:
+            mappings = mappings.filter(external_system=system)
+        if model is not None:
+            mappings = mappings.filter(
+                content_type=ContentType.objects.db_manager(
+                    self.db).get_for_model(model))
+
+        batch_size = self.resolve_batch_size
+        max_params = connections[self.db].features.max_query_params
+        if max_params:
+            # Leave room for the other parameters of the query
+            batch_size = min(batch_size, max_params - 10)
+
+        ids_by_type = defaultdict(dict)
+        for start in range(0, len(keys), batch_size):
+            for key, content_type_id, object_id in mappings.filter(
+                    external_key__in=keys[start:start + batch_size]
+            ).values_list('external_key', 'content_type_id', 'object_id'):
+                ids_by_type[content_type_id][key] = object_id
+
+        resolved = {}
+        for content_type_id, ids in ids_by_type.items():
+            content_type = ContentType.objects.db_manager(
+                self.db).get_for_id(content_type_id)
+            model_class = content_type.model_class()
+            if model_class is None:
+                # i.e. the model no longer exists
+                continue
+            # in_bulk() also respects the query parameter limit
+            objects = model_class._default_manager.using(self.db).in_bulk(
+                set(ids.values()))
+            for key, object_id in ids.items():
+                if object_id in objects:
+                    resolved[key] = objects[object_id]
+        return resolved
+
+
 class ExternalKeyMapping(models.Model):
     """
     Key Mappings for objects in our system to objects in external systems
@@ -46,8 +110,15 @@ class ExternalKeyMapping(models.Model):
         max_length=80,
     )
 
+    objects = ExternalKeyMappingManager()
+
     class Meta:
         index_together = ('external_system', 'external_key')
+        indexes = [
+            # For the reverse lookups, i.e. the mappings of an object
+            models.Index(fields=['content_type', 'object_id'],
+                         name='nsync_mapping_object_idx'),
+        ]
         unique_together = ('external_system', 'external_key')
         verbose_name = 'External Key Mapping'
 
@@ -57,3 +128,150 @@ class ExternalKeyMapping(models.Model):
             self.external_key,
             self.content_type.model_class().__name__,
             self.object_id)
+
+
+class ExternalKeysMixin(models.Model):
+    """
+    An (optional) mixin for synchronised models, which relates them to their
+    ExternalKeyMappings and provides their external_keys, as a dict of the
+    external system name to the external key.
+
+    To avoid a query per object, prefetch the keys of a page of objects with
+    nsync.prefetch.prefetch_external_keys(), or with
+    prefetch_related('external_key_mappings__external_system').
+
+    NB: As with any GenericRelation, deleting an object also deletes its key
+    mappings.
+    """
+    external_key_mappings = GenericRelation(
+        'nsync.ExternalKeyMapping',
+        related_query_name='%(app_label)s_%(class)s')
+
+    class Meta:
+        abstract = True
+
+    @property
+    def external_keys(self):
+        keys = getattr(self, '_external_keys', None)
+        if keys is None:
+            keys = self._external_keys = dict(
+                (mapping.external_system.name, mapping.external_key) for
+                mapping in sorted(self.external_key_mappings.all(),
+                                  key=lambda mapping: mapping.pk))
+        return keys
+
+    @external_keys.setter
+    def external_keys(self, keys):
+        self._external_keys = keys
+
+
+class SnapshotKey(models.Model):
+    """
+    The external keys seen during a full snapshot synchronisation.
+
+    These are only kept for the duration of the synchronisation, so that the
+    absent key mappings can be found with set based queries.
+    """
+    # Indexed by (the prefix of) the unique_together index
+    snapshot = models.CharField(
+        help_text='The identifier of the synchronisation run.',
+        max_length=32,
+    )
+    external_key = models.CharField(
+        help_text='An external key that was present in the snapshot.',
+        max_length=80,
+    )
+
+    class Meta:
+        unique_together = ('snapshot', 'external_key')
+        verbose_name = 'Snapshot Key'
+
+    def __str__(self):
+        return '{}:{}'.format(self.snapshot, self.external_key)
+
+
+class SyncJob(models.Model):
+    """
+    A synchronisation of an input file, queued to be executed in chunks by
+    any number of workers.
+
+    The chunks are executed in PHASES (i.e. all of the creates, then all of
+    the updates and finally all of the deletes), and a phase only starts once
+    every chunk has finished the previous one.
+    """
+    PHASES = ('create', 'update', 'delete')
+
+    PENDING = 'pending'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = (
+        (PENDING, 'Pending'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    external_system = models.ForeignKey(ExternalSystem,
+                                        on_delete=models.CASCADE)
+    model = models.CharField(
+        help_text='The label (app_label.ModelName) of the model to '
+                  'synchronise to.',
+        max_length=200,
+    )
+    source = models.CharField(
+        blank=True,
+        help_text='The file the rows were read from.',
+        max_length=255,
+    )
+    use_upsert = models.BooleanField(default=False)
+    phase = models.PositiveSmallIntegerField(
+        default=0,
+        help_text='The index of the phase being executed.',
+    )
+    status = models.CharField(
+        choices=STATUSES,
+        db_index=True,
+        default=PENDING,
+        max_length=10,
+    )
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Sync Job'
+
+    def __str__(self):
+        return '{}:{}-{}'.format(self.pk, self.model, self.status)
+
+
+class SyncChunk(models.Model):
+    """
+    A chunk of the rows of a SyncJob.
+
+    A worker claims a chunk by taking a lease on it, executes the actions of
+    the job's current phase for the rows and then moves the chunk on to the
+    next phase. A chunk whose lease has expired (i.e. its worker died) can be
+    claimed by another worker.
+    """
+    job = models.ForeignKey(SyncJob, on_delete=models.CASCADE,
+                            related_name='chunks')
+    sequence = models.PositiveIntegerField()
+    rows = models.TextField(help_text='The rows of the chunk, as JSON.')
+    phase = models.PositiveSmallIntegerField(
+        default=0,
+        help_text='The index of the next phase to execute for the chunk.',
+    )
+    lease_owner = models.CharField(blank=True, max_length=100)
+    lease_expires = models.DateTimeField(blank=True, null=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            # For the claims, i.e. the chunks of a job's current phase
+            models.Index(fields=['job', 'phase'],
+                         name='nsync_chunk_phase_idx'),
+        ]
+        unique_together = ('job', 'sequence')
+        verbose_name = 'Sync Chunk'
+
+    def __str__(self):
+        return '{}:{}-{}'.format(self.job_id, self.sequence, self.phase)
@@ -0,0 +1,433 @@
+"""
+NSync action plans
+
+An input can be compiled (i.e. on a staging host) into an action plan, which
+is then synchronised (i.e. on the production host) without parsing or
+validating the input again:
+
+    python manage.py nsync_compile CRM app Person people.csv people.nsplan
+    python manage.py syncfile CRM app Person --plan people.nsplan
+
+Compiling builds the actions for every row, so a row that would fail to build
+(i.e. invalid action flags, or a match on field that is not in the row) is
+reported by the compile rather than by the sync. The plan records the model
+and external system it was compiled for, the action flags (normalised) and
+match on fields of each row, the model field each column resolves to and the
+typed values of the columns.
+
+The plan file is binary and versioned. It is made up of chunks of rows, and
+each chunk holds its columns one after the other, either as an array of typed
+values (integers, floats, booleans or UTF-8 text with offsets) or, for the
+columns with few distinct values (including the action flags and match on
+fields), as an array of indexes into a table of the values (a JSON section of
+its own). The layout of the chunks is described by a JSON footer, which only
+holds the offsets of the sections, so its size does not grow with the values:
+
+    MAGIC | version | chunk | chunk | ... | footer | footer length | MAGIC
+
+The plan is read through a memory map, one chunk at a time, so the file is
+never read into memory as a whole.
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from django.core.exceptions import FieldDoesNotExist
+
+from .actions import ModelAction
+from .management.commands.utils import (
+    CsvRowReader,
+    CsvSyncActionsDecoder,
+    CsvSyncActionsEncoder)
+
+MAGIC = b'NSYNCPLN'
+VERSION = 1
+_HEADER = struct.Struct('<8sH')
+_TRAILER = struct.Struct('<Q8s')
+
+
+class PlanWriter:
+    """
+    Compiles rows (in the same layout as the CSV input) into an action plan.
+    """
+    # The number of rows per chunk
+    chunk_size = 10000
+
+    def __init__(self, file, factory, source='', chunk_size=None):
+        """
+        :param file: The binary file to write the plan to
+        :param factory: The CsvActionFactory for the model & external system,
+            which validates the rows
+        :param source: (Optional) A description of the input (i.e. the file
+            name)
+        :param chunk_size: (Optional) The number of rows per chunk.
+            Default: 10000
+        """
+        self.file = file
+        self.factory = factory
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+        self.footer = {
+            'model': factory.model._meta.label,
+            'external_system': getattr(factory.external_system, 'name', None),
+            'source': source,
+            'rows': 0,
+            'fields': {},
+            'chunks': [],
+        }
+        self.rows_read = 0
+        self.errors = []
+        self.names = None
+        self.columns = None
+        self.file.write(_HEADER.pack(MAGIC, VERSION))
+
+    def add(self, row):
+        """
+        Validate the row and add it to the plan.
+
+        :param row: The row dict, which is not modified
+        :return: True if the row is valid, otherwise the error is recorded
+            in errors (as the row number and the message)
+        """
+        self.rows_read += 1
+        if not row:
+            return False
+
+        factory = self.factory
+        row = dict(row)
+        row.pop(factory.reject_reason_label, None)
+        try:
+            # The actions are discarded, they are only built to validate it
+            factory.from_dict(dict(row))
+            row[factory.action_flags_label] = CsvSyncActionsEncoder.encode(
+                CsvSyncActionsDecoder.decode(
+                    row[factory.action_flags_label]))
+            row[factory.match_on_label] = tuple(factory.split_match_on(
+                row[factory.match_on_label]))
+        except Exception as e:
+            self.errors.append((self.rows_read, '{}: {}'.format(
+                e.__class__.__name__, e)))
+            return False
+
+        names = tuple(row)
+        if names != self.names:
+            # A chunk's rows all have the same columns
+            self.flush()
+            self.names = names
+            self.columns = [[] for _ in names]
+            self.resolve(names)
+        for column, value in zip(self.columns, row.values()):
+            column.append(value)
+        if len(self.columns[0]) >= self.chunk_size:
+            self.flush()
+        return True
+
+    def add_all(self, rows):
+        for row in rows:
+            self.add(row)
+
+    def resolve(self, names):
+        """Record the model field that each (new) column resolves to"""
+        labels = (self.factory.action_flags_label,
+                  self.factory.match_on_label,
+                  self.factory.external_key_label)
+        opts = self.factory.model._meta
+        for name in names:
+            if name in labels or name in self.footer['fields']:
+                continue
+            attribute = name.split(ModelAction.REFERRED_TO_DELIMITER)[0]
+            try:
+                field = opts.get_field(attribute).name
+            except FieldDoesNotExist:
+                # i.e. a property, which is set as an attribute
+                field = None
+            self.footer['fields'][name] = field
+
+    @property
+    def unknown_columns(self):
+        """The columns that are not fields of the model"""
+        return sorted(name for name, field in self.footer['fields'].items()
+                      if field is None)
+
+    def flush(self):
+        if not self.columns or not self.columns[0]:
+            return
+        chunk = {'rows': len(self.columns[0]), 'columns': []}
+        for name, values in zip(self.names, self.columns):
+            column = {'name': name}
+            self.write_column(column, values,
+                              dictionary=name in (
+                                  self.factory.action_flags_label,
+                                  self.factory.match_on_label))
+            chunk['columns'].append(column)
+        self.footer['chunks'].append(chunk)
+        self.footer['rows'] += chunk['rows']
+        self.columns = [[] for _ in self.names]
+
+    def write_column(self, column, values, dictionary=False):
+        try:
+            # Keyed by type too, as i.e. 1 == 1.0 == True
+            distinct = {}
+            keys = []
+            for value in values:
+                if value is not None and \
+                        not isinstance(value, (str, int, float, tuple)):
+                    raise TypeError
+                keys.append(distinct.setdefault((type(value), value),
+                                                len(distinct)))
+        except TypeError:
+            # i.e. lists, which are not hashable
+            distinct = None
+
+        if distinct is not None and len(distinct) < 2 ** 16 and \
+                (dictionary or len(distinct) <= len(values) // 4):
+            indexes = array(_width(len(distinct)), keys)
+            column['type'] = 'dict'
+            column['width'] = indexes.typecode
+            column['values'] = self.write(_json(
+                [list(value) if isinstance(value, tuple) else value
+                 for (_, value) in distinct]).encode('utf-8'))
+            column['data'] = self.write(indexes)
+            return
+
+        kind = _kind_of(values)
+        column['type'] = kind
+        if None in values:
+            column['nulls'] = self.write(array(
+                'B', (value is None for value in values)))
+        if kind in ('int', 'float', 'bool'):
+            typecode = {'int': 'q', 'float': 'd', 'bool': 'B'}[kind]
+            default = {'int': 0, 'float': 0.0, 'bool': False}[kind]
+            column['data'] = self.write(array(typecode, (
+                default if value is None else value for value in values)))
+            return
+
+        encode = _text if kind == 'str' else _json
+        data = [b'' if value is None else encode(value).encode('utf-8')
+                for value in values]
+        offsets = [0]
+        for item in data:
+            offsets.append(offsets[-1] + len(item))
+        offsets = array('I' if offsets[-1] < 2 ** 32 else 'Q', offsets)
+        column['width'] = offsets.typecode
+        column['offsets'] = self.write(offsets)
+        column['data'] = self.write(b''.join(data))
+
+    def write(self, data):
+        """Write a section (8 byte aligned), returning its offset & length"""
+        offset = self.file.tell()
+        padding = -offset % 8
+        if padding:
+            self.file.write(b'\0' * padding)
+            offset += padding
+        if isinstance(data, array):
+            # Always little endian
+            if sys.byteorder == 'big':
+                data.byteswap()
+            data = data.tobytes()
+        self.file.write(data)
+        return [offset, len(data)]
+
+    def close(self):
+        """Write the last chunk and the footer"""
+        self.flush()
+        footer = json.dumps(self.footer).encode('utf-8')
+        self.file.write(footer)
+        self.file.write(_TRAILER.pack(len(footer), MAGIC))
+
+
+def _width(count):
+    return 'B' if count <= 2 ** 8 else 'H'
+
+
+def _kind_of(values):
+    """The type of a plain column, from the types of its values"""
+    types = set(type(value) for value in values if value is not None)
+    if types == {bool}:
+        return 'bool'
+    if types == {int} and all(-2 ** 63 <= value < 2 ** 63
+                              for value in values if value is not None):
+        return 'int'
+    if types == {float}:
+        return 'float'
+    if types.intersection((list, dict, tuple)) or \
+            len(types.intersection((str, int, float, bool))) > 1:
+        return 'json'
+    return 'str'
+
+
+def _text(value):
+    # Other types (i.e. dates from Parquet files) are kept as text, as they
+    # would be in a CSV file
+    return value if isinstance(value, str) else str(value)
+
+
+def _json(value):
+    return json.dumps(value, default=str)
+
+
+class PlanRowReader(CsvRowReader):
+    """
+    Reads the chunks of an action plan (see nsync_compile) as typed columns.
+
+    As with the ColumnarRowReader, the chunks are handed directly to the
+    action factory.
+    """
+    mode = 'rb'
+
+    def __init__(self, file):
+        # Text files expose their underlying binary stream
+        file = getattr(file, 'buffer', file)
+        super(PlanRowReader, self).__init__(file)
+        try:
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError):
+            # i.e. an in-memory (or empty) file
+            file.seek(0)
+            self.buffer = file.read()
+
+        try:
+            self.footer = self.read_footer()
+        except ValueError:
+            self.close()
+            raise
+
+    def read_footer(self):
+        if self.buffer[:len(MAGIC)] != MAGIC:
+            raise ValueError('Not an nsync action plan')
+        (magic, version) = _HEADER.unpack_from(self.buffer, 0)
+        if version != VERSION:
+            raise ValueError('Unsupported action plan version {} '
+                             '(expected {})'.format(version, VERSION))
+        end = len(self.buffer) - _TRAILER.size
+        if end < _HEADER.size or \
+                _TRAILER.unpack_from(self.buffer, end)[1] != MAGIC:
+            raise ValueError('The action plan is incomplete')
+        length = _TRAILER.unpack_from(self.buffer, end)[0]
+        return json.loads(
+            bytes(self.buffer[end - length:end]).decode('utf-8'))
+
+    def close(self):
+        """Release the memory map (the file is not closed)"""
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+    def check(self, model, external_system=None):
+        """
+        Check that the plan was compiled for the model & external system, and
+        that the model still has the fields that the columns resolved to.
+
+        :raises ValueError: If the plan does not fit
+        """
+        if self.footer['model'] != model._meta.label:
+            raise ValueError('The action plan is for {}, not {}'.format(
+                self.footer['model'], model._meta.label))
+        name = getattr(external_system, 'name', external_system)
+        if self.footer['external_system'] != name:
+            raise ValueError('The action plan is for the {} system, '
+                             'not {}'.format(self.footer['external_system'],
+                                             name))
+        for column, field in sorted(self.footer['fields'].items()):
+            if field is None:
+                continue
+            try:
+                model._meta.get_field(field)
+            except FieldDoesNotExist:
+                raise ValueError('The {} column was compiled for the {} '
+                                 'field, which {} no longer has'.format(
+                                     column, field, model._meta.label))
+
+    def batches(self):
+        for chunk in self.footer['chunks']:
+            columns = dict((column['name'], self.column(column, chunk['rows']))
+                           for column in chunk['columns'])
+            self.rows_read += chunk['rows']
+            # The file is read through the memory map, so its position is
+            # moved on for the ProgressReporter to measure the bytes read
+            self.file.seek(max(sum(column[section])
+                               for column in chunk['columns']
+                               for section in ('values', 'data', 'offsets',
+                                               'nulls')
+                               if section in column))
+            yield columns
+
+    def column(self, column, rows):
+        kind = column['type']
+        if kind == 'dict':
+            values = [tuple(value) if isinstance(value, list) else value
+                      for value in self.dictionary(column)]
+            return [values[i] for i in self.array(column['width'],
+                                                  column['data'])]
+
+        if kind in ('int', 'float', 'bool'):
+            values = self.array({'int': 'q', 'float': 'd', 'bool': 'B'}[kind],
+                                column['data']).tolist()
+            if kind == 'bool':
+                values = [bool(value) for value in values]
+        else:
+            offsets = self.array(column['width'], column['offsets'])
+            (start, length) = column['data']
+            data = bytes(self.buffer[start:start + length])
+            values = [data[offsets[i]:offsets[i + 1]].decode('utf-8')
+                      for i in range(rows)]
+            if kind == 'json':
+                values = [json.loads(value) if value else None
+                          for value in values]
+
+        if 'nulls' in column:
+            nulls = self.array('B', column['nulls'])
+            values = [None if null else value
+                      for (null, value) in zip(nulls, values)]
+        return values
+
+    def dictionary(self, column):
+        """The table of the values of a dictionary encoded column"""
+        (start, length) = column['values']
+        return json.loads(bytes(self.buffer[start:start + length])
+                          .decode('utf-8'))
+
+    def array(self, typecode, section):
+        (start, length) = section
+        values = array(typecode)
+        values.frombytes(self.buffer[start:start + length])
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values
+
+    def rows(self):
+        for columns in self.batches():
+            names = list(columns)
+            for values in zip(*(columns[name] for name in names)):
+                yield dict(zip(names, values))
+
+    def actions(self, factory):
+        for columns in self.batches():
+            for action in factory.from_columns(columns):
+                yield action
+
+
+def compile_plan(rows, path, factory, source='', chunk_size=None):
+    """
+    Compile the rows into an action plan file.
+
+    The file is only written (replacing any previous plan) if all of the rows
+    are valid.
+
+    :param rows: An iterable of row dicts
+    :param path: The path of the plan file
+    :param factory: The CsvActionFactory for the model & external system
+    :return: The PlanWriter, whose errors are the invalid rows
+    """
+    partial = path + '.partial'
+    with open(partial, 'wb') as f:
+        writer = PlanWriter(f, factory, source, chunk_size)
+        writer.add_all(rows)
+        writer.close()
+    if writer.errors:
+        os.remove(partial)
+    else:
+        os.replace(partial, path)
+    return writer
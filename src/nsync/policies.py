@@ -1,8 +1,70 @@
-from django.db import transaction
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import reduce
+from operator import or_
+import random
+import time
+import zlib
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
+from django.db import (
+    DEFAULT_DB_ALIAS,
+    IntegrityError,
+    OperationalError,
+    connections,
+    transaction)
+from django.db.models import Q
+
+from .actions import CreateModelAction, ObjectSelector, UpdateModelAction
+from .logging import current_counter
+from .models import ExternalKeyMapping
+from .signals import ChangeSet, current_changes
+from .snapshot import sweeps_for
+from .sorting import ExternalSorter
+
+
+def execute_actions(actions, progress=None):
+    """
+    Execute the actions in order.
+
+    Consecutive actions that support batching (i.e. they have an
+    execute_batch() class method) and share a batch_key are executed
+    together as a batch.
+
+    :param actions: The actions to execute
+    :param progress: (Optional) The ProgressReporter to count the executed
+        actions with. Default: None
+    :return: Nothing
+    """
+    batch = []
+    for action in actions:
+        batchable = getattr(type(action), 'execute_batch', None) is not None
+        if batch and not (batchable and
+                          action.batch_key == batch[0].batch_key):
+            _execute_batch(batch, progress)
+            batch = []
+        if batchable:
+            batch.append(action)
+        else:
+            action.execute()
+            if progress:
+                progress.executed(action.type)
+    if batch:
+        _execute_batch(batch, progress)
+
+
+def _execute_batch(batch, progress):
+    type(batch[0]).execute_batch(batch)
+    if progress:
+        progress.executed(batch[0].type, len(batch))
 
 
 class BasicSyncPolicy:
     """A synchronisation policy that simply executes each action in order."""
+    progress = None
+
     def __init__(self, actions):
         """
         Create a basic synchronisation policy.
@@ -13,8 +75,7 @@ class BasicSyncPolicy:
         self.actions = actions
 
     def execute(self):
-        for action in self.actions:
-            action.execute()
+        execute_actions(self.actions, self.progress)
 
 
 class TransactionSyncPolicy:
@@ -34,6 +95,86 @@ class TransactionSyncPolicy:
             self.policy.execute()
 
 
+class SnapshotSyncPolicy:
+    """
+    A synchronisation policy that treats the actions as a full snapshot.
+
+    The external keys of the snapshot are recorded by SnapshotSweep objects,
+    and after the wrapped policy is executed, the key mappings that were
+    absent from the snapshot (and their solely referenced objects) are
+    deleted by the sweeps.
+
+    The keys are recorded when this policy is executed, so within the
+    synchronisation's transaction (if any), and are discarded afterwards
+    even if the synchronisation fails.
+    """
+    def __init__(self, policy, actions):
+        """
+        :param policy: The policy to execute the snapshot's actions
+        :param actions: The actions built for the snapshot
+        """
+        self.policy = policy
+        self.actions = actions
+
+    def execute(self):
+        sweeps = sweeps_for(self.actions)
+        try:
+            self.policy.execute()
+            with transaction.atomic():
+                for sweep in sweeps:
+                    sweep.sweep()
+        finally:
+            for sweep in sweeps:
+                sweep.discard()
+
+
+class ChangeFeedSyncPolicy:
+    """
+    A synchronisation policy that records the pks of the objects created,
+    updated and deleted by the wrapped policy, and once they are committed
+    sends a chunk_synced signal per model and publishes them to the feed.
+
+    The changes are published as each unit of them is committed; within a
+    transaction (i.e. of a TransactionSyncPolicy) once it commits, and
+    otherwise (as each action commits by itself) once the wrapped policy has
+    been executed, even if it fails. If the wrapped policy
+    commits in chunks (i.e. the PartitionedSyncPolicy or the
+    ConcurrentSyncPolicy), the changes are published as each chunk is
+    committed.
+    """
+    mute = False
+
+    def __init__(self, policy, feed=None):
+        """
+        :param policy: The policy to record the changes of
+        :param feed: (Optional) The ChangeFeed to publish the changes to.
+            Default: None
+        """
+        self.policy = policy
+        self.feed = feed
+
+    def execute(self):
+        in_transaction = transaction.get_connection().in_atomic_block
+        changes = ChangeSet(self.mute, self.feed)
+        try:
+            with changes.recording():
+                if in_transaction:
+                    changes.publish_on_commit()
+                self.policy.execute()
+        finally:
+            if not in_transaction:
+                changes.publish()
+
+
+class BatchedSignalsSyncPolicy(ChangeFeedSyncPolicy):
+    """
+    A ChangeFeedSyncPolicy that also stops the per object signals (i.e.
+    post_save) being sent for the wrapped policy's changes, so that the
+    receivers can do their work in bulk (for the chunk_synced signal).
+    """
+    mute = True
+
+
 class OrderedSyncPolicy:
     """
     A synchronisation policy that performs the actions in a controlled order.
@@ -54,6 +195,8 @@ class OrderedSyncPolicy:
     This also helps with referential updates, where an update action might be
     earlier in the list than the action to create the referred to object.
     """
+    progress = None
+
     def __init__(self, actions):
         self.actions = actions
 
@@ -61,5 +204,569 @@ class OrderedSyncPolicy:
         for filter_by in ['create', 'update', 'delete']:
             filtered_actions = filter(lambda a: a.type == filter_by,
                                       self.actions)
-            for action in filtered_actions:
+            execute_actions(filtered_actions, self.progress)
+
+
+class PartitionedSyncPolicy:
+    """
+    A synchronisation policy that executes the actions in parallel partitions.
+
+    The actions are hash-partitioned by the object they target, and each
+    partition is executed on its own thread, with its own DB connection and
+    its own transaction. The target of an action is identified by its
+    external key and by its match values. Before partitioning, these keys are
+    resolved against the existing key mappings and objects, so that actions
+    whose keys would resolve to the same object (i.e. two different match
+    keys for one object) are placed in the same partition, where they are
+    executed serially and in order.
+
+    Actions whose target cannot be determined up front (i.e. they use the
+    '|' or '~' operators to match) are executed serially, after the parallel
+    partitions.
+
+    NB: As each partition commits separately, the synchronisation as a whole
+    is not atomic (so wrapping this policy in a TransactionSyncPolicy is
+    pointless). If ordered, the create, update and delete actions are
+    executed as separate phases, with all partitions finishing each phase
+    before the next is started.
+    """
+    chunk_size = 500
+    progress = None
+
+    def __init__(self, actions, partitions=4, ordered=True):
+        if partitions < 1:
+            raise ValueError('partitions({}) must be positive'.format(
+                partitions))
+        self.actions = actions
+        self.partitions = partitions
+        self.ordered = ordered
+
+    def execute(self):
+        partitions, serial = self.partition()
+        changes = current_changes()
+        counter = current_counter()
+
+        phases = ['create', 'update', 'delete'] if self.ordered else [None]
+        with ThreadPoolExecutor(max_workers=self.partitions) as executor:
+            for phase in phases:
+                futures = [executor.submit(self.execute_partition,
+                                           self.filter(partition, phase),
+                                           self.progress, changes, counter)
+                           for partition in partitions if partition]
+                # Wait for all of the partitions to finish the phase before
+                # reporting any errors
+                errors = [f.exception() for f in futures]
+                for error in errors:
+                    if error is not None:
+                        raise error
+
+                with transaction.atomic():
+                    execute_actions(self.filter(serial, phase),
+                                    self.progress)
+
+    @staticmethod
+    def filter(actions, phase):
+        if phase is None:
+            return actions
+        return [a for a in actions if a.type == phase]
+
+    @staticmethod
+    def execute_partition(actions, progress=None, changes=None,
+                          counter=None):
+        # The changes are recorded (and published) per partition, as each
+        # commits separately
+        chunk = changes.child() if changes is not None else None
+        try:
+            with chunk.recording() if chunk else nullcontext(), \
+                    counter.counting() if counter else nullcontext():
+                with transaction.atomic():
+                    PartitionedSyncPolicy.lock_for_writing()
+                    execute_actions(actions, progress)
+                    if chunk:
+                        chunk.publish_on_commit()
+        finally:
+            # Connections are per thread, so release this thread's ones
+            connections.close_all()
+
+    @staticmethod
+    def lock_for_writing():
+        """
+        SQLite has one writer at a time, and a transaction that has read
+        cannot wait to become the writer (it fails with "database is
+        locked"), so on SQLite the write lock is waited for (with a no-op
+        write) before anything is read.
+        """
+        connection = transaction.get_connection()
+        if connection.vendor != 'sqlite':
+            return
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM {} WHERE 0'.format(
+                connection.ops.quote_name(ExternalKeyMapping._meta.db_table)))
+
+    def partition(self):
+        """
+        Split the actions into the partitions.
+
+        :return: A tuple of the list of partitions (each a list of actions,
+            in their original order) and the list of actions that must be
+            executed serially
+        """
+        keys = _KeyGroups()
+        serial = []
+        keyed = []
+        for action in self.actions:
+            action_keys = self.keys_for(action)
+            if not action_keys:
+                serial.append(action)
+                continue
+            keys.union(action_keys)
+            keyed.append((action, action_keys[0]))
+
+        self.resolve_external_keys(keys)
+        self.resolve_match_keys(keys)
+
+        partitions = [[] for _ in range(self.partitions)]
+        for action, key in keyed:
+            root = keys.find(key)
+            partitions[hash(root) % self.partitions].append(action)
+        return partitions, serial
+
+    @staticmethod
+    def target_of(action):
+        return getattr(action, 'delete_action', action)
+
+    def keys_for(self, action):
+        """The keys that identify the target of the action"""
+        keys = []
+        external_key = getattr(action, 'external_key', None)
+        external_system = getattr(action, 'external_system', None)
+        if external_key and external_system is not None:
+            keys.append(('external', external_system.pk, external_key))
+
+        match_key = self.match_key_for(self.target_of(action))
+        if match_key:
+            keys.append(match_key)
+        elif hasattr(self.target_of(action), 'match_on'):
+            # The action could affect any object
+            return []
+        return keys
+
+    @staticmethod
+    def match_key_for(action):
+        selector = getattr(action, 'match_on', None)
+        if selector is None:
+            return None
+        if '|' in selector.match_on or '~' in selector.match_on:
+            return None
+        fields = tuple(sorted(set(f for f in selector.match_on if f != '&')))
+        return ('match', action.model._meta.label, fields,
+                tuple(PartitionedSyncPolicy.normalise(
+                    action.model, f, selector.fields[f]) for f in fields))
+
+    @staticmethod
+    def normalise(model, name, value):
+        """
+        The value as the database compares it (i.e. '1' and 1 are the same
+        for an integer field), or its text if it cannot be converted.
+        """
+        try:
+            field = model._meta.get_field(name)
+            value = field.get_prep_value(field.to_python(value))
+            hash(value)
+            return value
+        except Exception:
+            # i.e. a lookup across a relationship, or an invalid value
+            return str(value)
+
+    def resolve_external_keys(self, keys):
+        by_system = defaultdict(list)
+        for key in keys.all():
+            if key[0] == 'external':
+                by_system[key[1]].append(key[2])
+
+        for system_id, external_keys in by_system.items():
+            for chunk in _chunks(external_keys, self.chunk_size):
+                mappings = ExternalKeyMapping.objects.filter(
+                    external_system_id=system_id,
+                    external_key__in=chunk).values_list(
+                        'external_key', 'content_type_id', 'object_id')
+                for external_key, content_type_id, object_id in mappings:
+                    model = ContentType.objects.get_for_id(
+                        content_type_id).model_class()
+                    if model is None:
+                        continue
+                    keys.union([('external', system_id, external_key),
+                                ('object', model._meta.label, object_id)])
+
+    def resolve_match_keys(self, keys):
+        by_fields = defaultdict(list)
+        for key in keys.all():
+            if key[0] == 'match':
+                by_fields[(key[1], key[2])].append(key)
+
+        for (label, fields), match_keys in by_fields.items():
+            model = apps.get_model(label)
+            lookup = dict((key[3], key) for key in match_keys)
+            first_values = list(set(key[3][0] for key in match_keys))
+            for chunk in _chunks(first_values, self.chunk_size):
+                try:
+                    found = list(model.objects.filter(**{
+                        fields[0] + '__in': chunk}).values_list(
+                            'pk', *fields))
+                except (ValueError, ValidationError):
+                    # The values are not valid for the field, so there
+                    # are no objects to find
+                    continue
+                for found_values in found:
+                    values = tuple(self.normalise(model, f, v) for (f, v) in
+                                   zip(fields, found_values[1:]))
+                    if values in lookup:
+                        keys.union([lookup[values],
+                                    ('object', label, found_values[0])])
+
+
+class ConcurrentSyncPolicy:
+    """
+    A synchronisation policy that is safe to run at the same time as other
+    synchronisations of the same models (i.e. from other processes, for other
+    external systems).
+
+    The actions are executed in chunks, each in its own transaction. Before a
+    chunk is executed, the objects its actions could affect are locked, in
+    order of model and primary key, with SELECT ... FOR UPDATE (NOWAIT where
+    supported), so that concurrent chunks do not deadlock or interleave.
+
+    Creates are raced differently, as there is no row to lock. On PostgreSQL
+    a transaction level advisory lock is taken (in order) for the match
+    values of each create, so that concurrent creates of the same object are
+    serialised. Otherwise, a unique constraint on the match fields makes the
+    losing insert fail.
+
+    A chunk that loses a race (i.e. a row is locked, a deadlock is detected
+    or an insert conflicts) is rolled back and retried after a random
+    back-off. The retried chunk then finds the winner's changes.
+
+    NB: As each chunk commits separately, the synchronisation as a whole is
+    not atomic (so wrapping this policy in a TransactionSyncPolicy would
+    hold the locks until the end, and is pointless).
+    """
+    chunk_size = 100
+    retries = 5
+    retry_delay = 0.05
+    progress = None
+
+    def __init__(self, actions, ordered=True, chunk_size=None, retries=None,
+                 using=DEFAULT_DB_ALIAS):
+        self.actions = actions
+        self.ordered = ordered
+        if chunk_size:
+            self.chunk_size = chunk_size
+        if retries is not None:
+            self.retries = retries
+        self.using = using
+
+    def execute(self):
+        phases = ['create', 'update', 'delete'] if self.ordered else [None]
+        for phase in phases:
+            actions = PartitionedSyncPolicy.filter(self.actions, phase)
+            for chunk in _chunks(list(actions), self.chunk_size):
+                self.execute_chunk(chunk)
+
+    def execute_chunk(self, actions):
+        changes = current_changes()
+        attempt = 0
+        while True:
+            # The changes are recorded (and published) per attempt, so that
+            # those of a rolled back attempt are discarded
+            chunk = changes.child() if changes is not None else None
+            try:
+                with chunk.recording() if chunk else nullcontext():
+                    with transaction.atomic(using=self.using):
+                        self.lock(actions)
+                        execute_actions(actions)
+                        if chunk:
+                            chunk.publish_on_commit()
+                break
+            except (IntegrityError, OperationalError):
+                # i.e. NOWAIT could not lock, a deadlock or a duplicate
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                time.sleep(random.uniform(0, self.retry_delay * 2 ** attempt))
+
+        if self.progress:
+            for action in actions:
+                self.progress.executed(action.type)
+
+    def lock(self, actions):
+        self.lock_creates(actions)
+        self.lock_objects(actions)
+
+    @staticmethod
+    def create_keys(actions):
+        """The (sorted) advisory lock keys for the creates' match values"""
+        keys = set()
+        for action in actions:
+            if action.type != 'create':
+                continue
+            key = PartitionedSyncPolicy.match_key_for(
+                PartitionedSyncPolicy.target_of(action))
+            if key:
+                # A signed 32 bit value, for any bigint implementation
+                keys.add(zlib.crc32(repr(key).encode('utf-8')) - 2 ** 31)
+        return sorted(keys)
+
+    def lock_creates(self, actions):
+        connection = connections[self.using]
+        if connection.vendor != 'postgresql':
+            return
+        with connection.cursor() as cursor:
+            for key in self.create_keys(actions):
+                cursor.execute('SELECT pg_advisory_xact_lock(%s)', [key])
+
+    def lock_objects(self, actions):
+        queries = defaultdict(list)
+        external_keys = defaultdict(list)
+        for action in actions:
+            target = PartitionedSyncPolicy.target_of(action)
+            selector = getattr(target, 'match_on', None)
+            if selector is not None:
+                queries[target.model].append(selector.get_by())
+            external_key = getattr(action, 'external_key', None)
+            external_system = getattr(action, 'external_system', None)
+            if external_key and external_system is not None:
+                external_keys[external_system.pk].append(external_key)
+
+        for system_id, keys in external_keys.items():
+            object_ids = defaultdict(list)
+            for content_type_id, object_id in ExternalKeyMapping.objects.using(
+                    self.using).filter(
+                        external_system_id=system_id,
+                        external_key__in=keys).values_list(
+                            'content_type_id', 'object_id'):
+                object_ids[content_type_id].append(object_id)
+            for content_type_id, ids in object_ids.items():
+                model = ContentType.objects.get_for_id(
+                    content_type_id).model_class()
+                if model is not None:
+                    queries[model].append(Q(pk__in=ids))
+
+        nowait = connections[self.using].features.has_select_for_update_nowait
+        for model in sorted(queries, key=lambda m: m._meta.label):
+            list(model.objects.using(self.using)
+                 .filter(reduce(or_, queries[model]))
+                 .order_by('pk')
+                 .select_for_update(nowait=nowait)
+                 .values_list('pk', flat=True))
+
+
+class MergeJoinSyncPolicy:
+    """
+    A synchronisation policy that finds the objects for the create and update
+    actions with a sorted merge join, rather than with a query per action.
+
+    The actions are (externally) sorted by their match values, and the
+    existing objects are streamed from the database ordered by the same
+    fields, using keyset pagination. Walking both streams together classifies
+    each action as an insert, an update or unchanged, giving sequential
+    access on both sides and bounded memory use. Updates that do not change
+    any of the object's fields are not saved.
+
+    Only the CreateModelAction and UpdateModelAction objects that match on
+    model fields (without the '|' or '~' operators) are joined, all other
+    actions are executed as usual. The actions are always executed in phases
+    (all of the creates, then the updates and finally the deletes), as for
+    the OrderedSyncPolicy.
+
+    NB: The database may order or compare the values differently to Python
+    (i.e. for case insensitive collations), so an action whose key is not
+    found by the join is executed as usual, finding any matching object with
+    its own query. Only the actions whose objects are found are executed
+    without a query per action.
+    """
+    chunk_size = 2000
+    progress = None
+
+    def __init__(self, actions, chunk_size=None, max_in_memory=None):
+        self.actions = actions
+        if chunk_size:
+            self.chunk_size = chunk_size
+        self.max_in_memory = max_in_memory
+        self.counts = defaultdict(int)
+
+    def execute(self):
+        for phase in ['create', 'update', 'delete']:
+            groups = defaultdict(list)
+            others = []
+            for index, action in enumerate(self.actions):
+                if action.type != phase:
+                    continue
+                group = self.group_of(action)
+                if group is None:
+                    others.append(action)
+                else:
+                    groups[group].append(index)
+
+            for (model, fields), indexes in groups.items():
+                self.join(model, fields, indexes)
+            execute_actions(others, self.progress)
+
+    @staticmethod
+    def group_of(action):
+        """The (model, match fields) to join the action on, if possible"""
+        if type(action) not in (CreateModelAction, UpdateModelAction):
+            return None
+        match_on = action.match_on.match_on
+        if ObjectSelector.OPERATORS.intersection(match_on) - {'&'}:
+            return None
+        fields = []
+        for name in match_on:
+            if name == '&' or name in fields:
+                continue
+            try:
+                if not action.model._meta.get_field(name).concrete:
+                    return None
+            except Exception:
+                # i.e. a lookup across a relationship
+                return None
+            fields.append(name)
+        return (action.model, tuple(fields))
+
+    @staticmethod
+    def key_of(action, model, fields):
+        """The normalised match values of the action, or None if invalid"""
+        try:
+            key = tuple(model._meta.get_field(name).to_python(
+                action.fields[name]) for name in fields)
+        except Exception:
+            return None
+        return None if None in key else key
+
+    def join(self, model, fields, indexes):
+        sorter = ExternalSorter(lambda item: item[0], self.max_in_memory)
+        first = last = None
+        for index in indexes:
+            action = self.actions[index]
+            key = self.key_of(action, model, fields)
+            if key is None:
                 action.execute()
+                self.executed(action)
+                continue
+            sorter.add((key, index))
+            first = key if first is None or key < first else first
+            last = key if last is None or key > last else last
+        if first is None:
+            return
+
+        existing = self.stream(model, fields, first, last)
+        current = next(existing, None)
+        key = matches = None
+        for (action_key, index) in sorter:
+            if action_key != key:
+                key = action_key
+                matches = []
+                while current is not None and current[0] < key:
+                    current = next(existing, None)
+                while current is not None and current[0] == key:
+                    matches.append(current[1])
+                    current = next(existing, None)
+            matches = self.execute_action(self.actions[index], matches)
+            self.executed(self.actions[index])
+
+    def executed(self, action):
+        if self.progress:
+            self.progress.executed(action.type)
+
+    def execute_action(self, action, matches):
+        """
+        Execute the action with the objects found for its key.
+
+        :return: The objects for the key, after the action
+        """
+        if len(matches) > 1:
+            # Let the action deal with the ambiguity in its usual way
+            action.execute()
+            return matches
+
+        if not matches:
+            # Not necessarily missing, if the database's collation differs
+            self.counts['lookup'] += 1
+            obj = action.execute()
+            return [obj] if obj is not None else matches
+
+        obj = matches[0]
+        if isinstance(action, CreateModelAction):
+            self.counts['unchanged'] += 1
+            return matches
+
+        before = action.concrete_values(obj)
+        action.execute_with(obj, skip_unchanged=True)
+        if before == action.concrete_values(obj):
+            self.counts['unchanged'] += 1
+        else:
+            self.counts['update'] += 1
+        return matches
+
+    def stream(self, model, fields, first, last):
+        """
+        Produce (key, object) for the objects with keys from first to last,
+        in key order, by keyset pagination.
+        """
+        attnames = [model._meta.get_field(name).attname for name in fields]
+        queryset = model.objects.filter(**dict(
+            (name + '__isnull', False) for name in fields)).order_by(
+                *(list(fields) + ['pk']))
+        after = _keyset_from(list(fields), list(first), inclusive=True)
+        while True:
+            count = 0
+            for obj in queryset.filter(after)[:self.chunk_size].iterator(
+                    chunk_size=self.chunk_size):
+                count += 1
+                key = tuple(getattr(obj, attname) for attname in attnames)
+                if key > last:
+                    return
+                yield key, obj
+            if count < self.chunk_size:
+                return
+            after = _keyset_from(list(fields) + ['pk'],
+                                 list(key) + [obj.pk], inclusive=False)
+
+
+def _keyset_from(names, values, inclusive):
+    """The filter for the rows ordered after (or from) the values"""
+    query = Q()
+    for i, name in enumerate(names):
+        term = Q(**dict(zip(names[:i], values[:i])))
+        query |= term & Q(**{name + '__gt': values[i]})
+    if inclusive:
+        query |= Q(**dict(zip(names, values)))
+    return query
+
+
+class _KeyGroups:
+    """A union-find of the keys that identify the same object"""
+
+    def __init__(self):
+        self.parents = {}
+
+    def all(self):
+        return list(self.parents)
+
+    def find(self, key):
+        root = key
+        while self.parents.setdefault(root, root) != root:
+            root = self.parents[root]
+        # Compress the path
+        while key != root:
+            self.parents[key], key = root, self.parents[key]
+        return root
+
+    def union(self, keys):
+        roots = [self.find(key) for key in keys]
+        for root in roots[1:]:
+            self.parents[root] = roots[0]
+
+
+def _chunks(values, size):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
@@ -0,0 +1,56 @@
+"""
+NSync external key prefetching
+
+The ExternalKeyMappings refer to their objects with a GenericForeignKey, so
+finding the external keys of each object in a list costs a query per object.
+prefetch_external_keys() instead finds the keys for a whole page of objects
+with a query per model (using the (content_type, object_id) index).
+"""
+from collections import defaultdict
+
+from django.contrib.contenttypes.models import ContentType
+
+from .models import ExternalKeyMapping
+
+
+def prefetch_external_keys(objects, systems=None, to_attr='external_keys',
+                           batch_size=1000):
+    """
+    Attach the external keys of each object, as a dict of the external system
+    name to the external key. If an object has several keys in the same
+    system, the most recently mapped one is used.
+
+    :param objects: A queryset or an iterable of objects (of any models)
+    :param systems: (Optional) The ExternalSystems (or their names) to find
+        the keys of. Default: All of them
+    :param to_attr: (Optional) The attribute to attach the keys as.
+        Default: external_keys
+    :param batch_size: (Optional) The maximum number of objects per query.
+        Default: 1000
+    :return: The list of objects
+    """
+    objects = list(objects)
+    names = None
+    if systems is not None:
+        names = [s if isinstance(s, str) else s.name for s in systems]
+
+    by_content_type = defaultdict(lambda: defaultdict(list))
+    for obj in objects:
+        keys = {}
+        setattr(obj, to_attr, keys)
+        content_type = ContentType.objects.get_for_model(type(obj))
+        by_content_type[content_type.id][obj.pk].append(keys)
+
+    for content_type_id, keys_by_pk in by_content_type.items():
+        pks = list(keys_by_pk)
+        for start in range(0, len(pks), batch_size):
+            mappings = ExternalKeyMapping.objects.filter(
+                content_type_id=content_type_id,
+                object_id__in=pks[start:start + batch_size])
+            if names is not None:
+                mappings = mappings.filter(external_system__name__in=names)
+            for object_id, name, key in mappings.order_by('pk').values_list(
+                    'object_id', 'external_system__name', 'external_key'):
+                for keys in keys_by_pk[object_id]:
+                    keys[name] = key
+    return objects
@@ -0,0 +1,86 @@
+"""
+NSync profiling hooks
+
+A synchronisation can be run under a profiler, to find where its time or its
+memory goes. The commands mark the boundaries of their phases (i.e. once the
+actions are built and once they are executed), so that a memory profile can
+show what each phase allocated.
+"""
+import cProfile
+import sys
+import tracemalloc
+
+
+class Profiler:
+    """
+    Profiles a synchronisation, in one of the MODES.
+
+    In 'cpu' mode the whole run is profiled with cProfile, and the stats are
+    written to a pstats file (i.e. for pstats or snakeviz). In 'memory' mode
+    tracemalloc snapshots are taken at each phase boundary, and the memory in
+    use and the top allocation sites (compared to the previous phase) are
+    reported.
+    """
+    MODES = ('cpu', 'memory')
+    default_path = 'nsync.pstats'
+    top = 10
+
+    def __init__(self, mode, path=None, stream=None):
+        """
+        :param mode: 'cpu' or 'memory'
+        :param path: (Optional) The file to write the CPU stats to.
+            Default: nsync.pstats
+        :param stream: (Optional) The stream to report to. Default: stderr
+        """
+        if mode not in self.MODES:
+            raise ValueError('Unknown profile mode:{}'.format(mode))
+        self.mode = mode
+        self.path = path or self.default_path
+        self.stream = stream or sys.stderr
+        self.profile = None
+        self.snapshot = None
+
+    def start(self):
+        if self.mode == 'cpu':
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            tracemalloc.start()
+            self.snapshot = self.take_snapshot()
+
+    def phase(self, name):
+        """
+        Mark the end of a phase of the synchronisation.
+
+        :param name: The name of the phase that has ended
+        """
+        if self.mode != 'memory' or self.snapshot is None:
+            return
+        snapshot = self.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        self.write(
+            'Memory after {}: {:.1f} KiB in use, {:.1f} KiB peak'.format(
+                name, current / 1024.0, peak / 1024.0))
+        for stat in snapshot.compare_to(self.snapshot, 'lineno')[:self.top]:
+            self.write('  {}'.format(stat))
+        self.snapshot = snapshot
+
+    def stop(self):
+        if self.mode == 'cpu':
+            if self.profile is not None:
+                self.profile.disable()
+                self.profile.dump_stats(self.path)
+                self.write('CPU profile written to {}'.format(self.path))
+        elif self.snapshot is not None:
+            self.snapshot = None
+            tracemalloc.stop()
+
+    @staticmethod
+    def take_snapshot():
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<unknown>')))
+
+    def write(self, text):
+        self.stream.write(text + '\n')
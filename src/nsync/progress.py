@@ -0,0 +1,172 @@
+"""
+NSync progress reporting
+
+Long synchronisations can report their progress while they run. The readers
+and the policies only maintain simple counters (the rows read, and the
+actions executed by type), which a background thread samples at a regular
+interval to report the progress, the recent throughput and an estimate of
+the time remaining.
+"""
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+
+
+class ProgressReporter:
+    """
+    Reports the progress of a synchronisation at a regular interval, as a
+    line of text to a stream (i.e. stderr) and/or as a JSON status file.
+
+    While the input is read, the estimated time remaining is based on the
+    bytes of the input files consumed. Once the actions are being executed,
+    it is based on the number of actions left to execute.
+    """
+    # The number of reports the throughput is averaged over
+    window = 6
+
+    def __init__(self, interval=10.0, stream=None, status_path=None):
+        """
+        :param interval: (Optional) The seconds between reports. Default: 10
+        :param stream: (Optional) The stream to write the reports to.
+            Default: stderr, unless a status_path is provided
+        :param status_path: (Optional) The path of the JSON file to write the
+            status to. It is replaced on each report. Default: None
+        """
+        self.interval = interval
+        self.stream = stream
+        if stream is None and status_path is None:
+            self.stream = sys.stderr
+        self.status_path = status_path
+        self.readers = []
+        self.files = []
+        self.counts = defaultdict(int)
+        self.total_actions = None
+        self.lock = threading.Lock()
+        self.samples = deque(maxlen=self.window + 1)
+        self.started = time.monotonic()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def watch(self, reader, file):
+        """
+        Include an input in the progress.
+
+        :param reader: The row reader (i.e. a CsvRowReader), which counts the
+            rows read
+        :param file: The file being read, to measure the bytes consumed
+        """
+        self.readers.append(reader)
+        try:
+            self.files.append((file, os.fstat(file.fileno()).st_size))
+        except (AttributeError, OSError, ValueError):
+            # i.e. an in-memory file, which is not measured
+            pass
+
+    def observe(self, policy):
+        """Have the policy count the actions it executes"""
+        policy.progress = self
+        self.total_actions = len(policy.actions)
+
+    def executed(self, action_type, count=1):
+        with self.lock:
+            self.counts[action_type] += count
+
+    def start(self):
+        self.started = time.monotonic()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def stop(self):
+        """Stop reporting, after a final report"""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.report()
+
+    def bytes_read(self):
+        total = 0
+        for file, size in self.files:
+            if file.closed:
+                # i.e. the file was closed after it was read
+                total += size
+                continue
+            try:
+                total += min(os.lseek(file.fileno(), 0, os.SEEK_CUR), size)
+            except (OSError, ValueError):
+                total += size
+        return total
+
+    def status(self):
+        """The current progress, as a dict"""
+        now = time.monotonic()
+        with self.lock:
+            executed = dict(self.counts)
+        rows = sum(reader.rows_read for reader in self.readers)
+        bytes_read = self.bytes_read()
+        bytes_total = sum(size for _, size in self.files)
+        executed_total = sum(executed.values())
+
+        self.samples.append((now, rows, bytes_read, executed_total))
+        first = self.samples[0]
+        elapsed = now - first[0]
+
+        def rate(index):
+            return (self.samples[-1][index] - first[index]) / elapsed \
+                if elapsed > 0 else 0.0
+
+        eta = None
+        if self.total_actions is not None:
+            if rate(3) > 0:
+                eta = (self.total_actions - executed_total) / rate(3)
+        elif bytes_total and rate(2) > 0:
+            eta = (bytes_total - bytes_read) / rate(2)
+
+        return {
+            'elapsed': round(now - self.started, 1),
+            'rows_read': rows,
+            'bytes_read': bytes_read,
+            'bytes_total': bytes_total,
+            'actions_total': self.total_actions,
+            'actions_executed': executed_total,
+            'actions_executed_by_type': executed,
+            'rows_per_second': round(rate(1), 1),
+            'actions_per_second': round(rate(3), 1),
+            'eta': None if eta is None else round(eta, 1),
+        }
+
+    def report(self):
+        status = self.status()
+        if self.stream is not None:
+            self.stream.write(self.format(status) + '\n')
+            self.stream.flush()
+        if self.status_path:
+            temporary = self.status_path + '.tmp'
+            with open(temporary, 'w') as f:
+                json.dump(status, f)
+            os.replace(temporary, self.status_path)
+
+    @staticmethod
+    def format(status):
+        text = 'Read {} rows'.format(status['rows_read'])
+        if status['bytes_total']:
+            text += ' ({:.1f}%)'.format(
+                100.0 * status['bytes_read'] / status['bytes_total'])
+        text += ', {} rows/s'.format(status['rows_per_second'])
+        if status['actions_total'] is not None:
+            text += ' - Executed {} of {} actions ({}), {} actions/s'.format(
+                status['actions_executed'],
+                status['actions_total'],
+                ', '.join('{}:{}'.format(action_type, count) for
+                          action_type, count in sorted(
+                              status['actions_executed_by_type'].items())),
+                status['actions_per_second'])
+        if status['eta'] is not None:
+            text += ' - ETA {}s'.format(int(status['eta']))
+        return text
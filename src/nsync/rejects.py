@@ -0,0 +1,81 @@
+"""
+NSync rejected rows
+
+When a row cannot be synchronised (i.e. the object to update is not found,
+a referred to object does not exist, or the save fails), the row and the
+reason are written to a rejects file as it happens. The rejects file is a CSV
+file with the same columns as the input, plus a reason column, so that it can
+be corrected and synchronised again directly. For a JSON Lines input, whose
+rows can each have different keys, the rejects are written as JSON Lines.
+"""
+import csv
+import json
+import threading
+
+
+class RejectsWriter:
+    """
+    Streams the rejected rows to a CSV (or JSON Lines) file.
+
+    The file is created (or truncated) immediately, so that an empty file
+    means that no rows were rejected. The CSV header is taken from the first
+    rejected row, so a CSV file is only suitable for inputs whose rows all
+    have the same columns. The writes are buffered, and may come from
+    several threads (i.e. for the PartitionedSyncPolicy).
+
+    When the actions for a row fail one after the other (i.e. the create and
+    the update for a "cu" row), the row is only written once.
+    """
+    reason_label = 'reject_reason'
+    buffer_size = 1024 * 1024
+
+    def __init__(self, path, file_format='csv'):
+        """
+        :param path: The path of the rejects file
+        :param file_format: (Optional) 'csv' or 'jsonl'. Default: 'csv'
+        """
+        if file_format not in ('csv', 'jsonl'):
+            raise ValueError('Unsupported rejects format "{}"'.format(
+                file_format))
+        self.path = path
+        self.file_format = file_format
+        self.file = open(path, 'w', newline='', buffering=self.buffer_size)
+        self.writer = None
+        self.lock = threading.Lock()
+        self.count = 0
+        self.last_row = None
+
+    def write(self, row, reason):
+        """
+        Write a rejected row.
+
+        :param row: The input row (as a dict), or None if it is unknown
+        :param reason: The reason the row was rejected
+        """
+        with self.lock:
+            if row is not None and row is self.last_row:
+                return
+            self.last_row = row
+            values = dict(row or {})
+            values[self.reason_label] = reason
+            if self.file_format == 'jsonl':
+                self.file.write(json.dumps(values, default=str) + '\n')
+            else:
+                self.write_csv(values)
+            self.count += 1
+
+    def write_csv(self, values):
+        if self.writer is None:
+            self.writer = csv.DictWriter(
+                self.file, list(values), extrasaction='ignore')
+            self.writer.writeheader()
+        self.writer.writerow(values)
+
+    @staticmethod
+    def format_for(input_format):
+        """The rejects format for an input format (see RowReaderFinder)"""
+        return 'jsonl' if input_format == 'jsonl' else 'csv'
+
+    def close(self):
+        with self.lock:
+            self.file.close()
@@ -0,0 +1,244 @@
+"""
+NSync signals
+
+Synchronising a model sends the usual pre_save/post_save/pre_delete/
+post_delete signals for every object, which can be costly if the receivers
+do their own work per object (i.e. cache busting or search indexing).
+
+Instead, the changes made by a synchronisation can be recorded in a
+ChangeSet, optionally muting the per object signals, and a chunk_synced
+signal is then sent for each model once the changes are committed. The
+receivers can then do their work in bulk. The changes can also be published
+to a ChangeFeed (a callback and/or a JSON Lines file).
+
+The recording is per thread, so the signals of other threads (i.e. requests
+being served by the same process) are not affected. The signals' send()
+methods are only intercepted while a recording is active (in any thread), and
+are restored once none are.
+"""
+import json
+import threading
+from array import array
+
+from django.db import transaction
+from django.db.models import signals
+from django.dispatch import Signal
+
+# Sent once the changes of a chunk (i.e. a transaction) of a sync are
+# committed, for each model that was changed. The sender is the model, and
+# the arguments are the lists of 'created', 'updated' and 'deleted' pks.
+chunk_synced = Signal()
+
+_recording = threading.local()
+_active = []
+_active_lock = threading.Lock()
+
+
+def current_changes():
+    """The ChangeSet recording the changes of this thread, if any"""
+    return getattr(_recording, 'changes', None)
+
+
+class PkSet:
+    """
+    A set of primary keys, kept in an array of 64 bit integers (rather than
+    as a set of int objects) for as long as all of the keys are integers.
+    """
+    def __init__(self):
+        self.pks = array('q')
+
+    def add(self, pk):
+        if isinstance(self.pks, array):
+            try:
+                self.pks.append(pk)
+                return
+            except (TypeError, OverflowError):
+                # i.e. UUID or text keys
+                self.pks = list(self.pks)
+        self.pks.append(pk)
+
+    def __len__(self):
+        return len(self.pks)
+
+    def __iter__(self):
+        return iter(self.pks)
+
+
+class ChangeSet:
+    """
+    The primary keys of the objects created, updated and deleted, per model.
+    """
+    KINDS = ('created', 'updated', 'deleted')
+
+    def __init__(self, mute=False, feed=None):
+        """
+        :param mute: (Optional) Do not send the per object signals while
+            recording. Default: False
+        :param feed: (Optional) The ChangeFeed to also publish the changes
+            to. Default: None
+        """
+        self.mute = mute
+        self.feed = feed
+        self.changes = {}
+
+    def record(self, model, kind, pk):
+        changes = self.changes.get(model)
+        if changes is None:
+            changes = self.changes[model] = dict(
+                (k, PkSet()) for k in self.KINDS)
+        changes[kind].add(pk)
+
+    def child(self):
+        """A new, empty ChangeSet, with the same settings"""
+        return ChangeSet(self.mute, self.feed)
+
+    def recording(self):
+        """Record the changes of this thread in this ChangeSet (a context)"""
+        return _Recording(self)
+
+    def models(self):
+        """
+        The changes by model, where an object that was created then updated
+        is only reported as created, and a deleted object is only reported as
+        deleted.
+
+        :return: A dict of model to a dict of kind to the list of pks
+        """
+        result = {}
+        for model, changes in self.changes.items():
+            deleted = set(changes['deleted'])
+            created = set(changes['created']) - deleted
+            updated = set(changes['updated']) - deleted - created
+            result[model] = {'created': sorted(created),
+                             'updated': sorted(updated),
+                             'deleted': sorted(deleted)}
+        return result
+
+    def publish(self):
+        """
+        Send the chunk_synced signal for each changed model, and publish the
+        changes to the feed. The published changes are then forgotten.
+        """
+        models = self.models()
+        self.changes = {}
+        for model, changes in models.items():
+            chunk_synced.send(sender=model, **changes)
+            if self.feed is not None:
+                self.feed.publish(model, changes)
+
+    def publish_on_commit(self):
+        """Publish once the current transaction commits (or immediately)"""
+        transaction.on_commit(self.publish)
+
+
+class ChangeFeed:
+    """
+    Receives the committed changes of a synchronisation, per model and chunk,
+    so that downstream work (i.e. rebuilding caches or search indexes) can be
+    done for just the changed objects.
+
+    The changes are passed to the callback, and/or appended to a JSON Lines
+    file, as one line per model per chunk, i.e.:
+
+        {"model": "app.Model", "created": [1, 2], "updated": [], "deleted": []}
+    """
+    def __init__(self, path=None, callback=None):
+        """
+        :param path: (Optional) The file to write the changes to. Default: None
+        :param callback: (Optional) A callable, called with the model and the
+            'created', 'updated' and 'deleted' lists of pks. Default: None
+        """
+        self.path = path
+        self.callback = callback
+        self.lock = threading.Lock()
+        if path is not None:
+            # Created immediately, so that an empty file means no changes
+            open(path, 'w').close()
+
+    def publish(self, model, changes):
+        # The chunks can be committed by several threads
+        with self.lock:
+            if self.callback is not None:
+                self.callback(model, **changes)
+            if self.path is not None:
+                record = {'model': model._meta.label}
+                record.update(changes)
+                # Opened per chunk, as the chunks can be committed after the
+                # sync (i.e. if it is run within an outer transaction)
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(record, default=str) + '\n')
+
+
+class _Recording:
+    def __init__(self, changes):
+        self.changes = changes
+
+    def __enter__(self):
+        self.previous = current_changes()
+        _recording.changes = self.changes
+        with _active_lock:
+            if not _active:
+                # Django only sends the delete signals (rather than fast
+                # deleting) if the model has a receiver
+                signals.post_delete.connect(_needs_delete_signals,
+                                            dispatch_uid=__name__)
+                for (signal, kind_of) in _INTERCEPTED:
+                    _intercept(signal, kind_of)
+            _active.append(self)
+        return self.changes
+
+    def __exit__(self, *exc_info):
+        _recording.changes = self.previous
+        with _active_lock:
+            _active.remove(self)
+            if not _active:
+                for (signal, _) in _INTERCEPTED:
+                    _restore(signal)
+                signals.post_delete.disconnect(dispatch_uid=__name__)
+
+
+def _needs_delete_signals(sender, **kwargs):
+    pass
+
+
+def _intercept(signal, kind_of=None):
+    """
+    Replace the send() method of the signal, to record and/or mute it when
+    the thread is recording changes.
+    """
+    send = signal.send
+
+    def intercepted_send(sender, **named):
+        changes = current_changes()
+        if changes is None:
+            return send(sender, **named)
+        if kind_of is not None:
+            changes.record(sender, kind_of(named), named['instance'].pk)
+        return [] if changes.mute else send(sender, **named)
+
+    intercepted_send.replaced = signal.__dict__.get('send')
+    signal.send = intercepted_send
+
+
+def _restore(signal):
+    """Restore the send() method replaced by _intercept()"""
+    if not hasattr(signal.send, 'replaced'):
+        # i.e. replaced again since, so it cannot be restored
+        return
+    replaced = signal.send.replaced
+    if replaced is None:
+        del signal.send
+    else:
+        signal.send = replaced
+
+
+# The signals intercepted while recording, with how to find the kind of
+# change from the signal's arguments (if it is recorded)
+_INTERCEPTED = (
+    (signals.pre_save, None),
+    (signals.post_save,
+     lambda named: 'created' if named.get('created') else 'updated'),
+    (signals.pre_delete, None),
+    (signals.post_delete, lambda named: 'deleted'),
+    (signals.m2m_changed, None),
+)
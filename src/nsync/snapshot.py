@@ -0,0 +1,135 @@
+"""
+NSync full snapshot synchronisation
+
+When an external system provides full snapshots of its data (rather than
+explicit delete rows), the objects that are absent from the snapshot must be
+found and deleted. The external keys seen in the snapshot are recorded in the
+SnapshotKey table, so that the absent key mappings can be found with set
+based (anti-join) queries after the synchronisation.
+"""
+import logging
+import uuid
+
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Exists, OuterRef, Subquery
+
+from .logging import StyleAdapter
+from .models import ExternalKeyMapping, SnapshotKey
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+logger = StyleAdapter(logger)
+
+
+class SnapshotSweep:
+    """
+    Deletes the key mappings (and their solely referenced objects) for the
+    external keys of an external system that are absent from a snapshot.
+
+    The objects are only deleted if the absent mapping is the only mapping to
+    the object, which is the same rule as for the unforced delete actions.
+    """
+    chunk_size = 1000
+
+    def __init__(self, external_system, model):
+        self.external_system = external_system
+        self.model = model
+        self.snapshot = uuid.uuid4().hex
+        self.pending = []
+        self.seen = 0
+
+    def see(self, external_key):
+        """Record that the external key is present in the snapshot"""
+        self.pending.append(external_key)
+        self.seen += 1
+        if len(self.pending) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        SnapshotKey.objects.bulk_create(
+            [SnapshotKey(snapshot=self.snapshot, external_key=key)
+             for key in self.pending],
+            ignore_conflicts=True)
+        self.pending = []
+
+    def absent_mappings(self):
+        """The mappings of the external system, for keys not in the snapshot"""
+        return ExternalKeyMapping.objects.filter(
+            external_system=self.external_system,
+            content_type=ContentType.objects.get_for_model(self.model),
+        ).exclude(external_key__in=Subquery(
+            SnapshotKey.objects.filter(snapshot=self.snapshot).values(
+                'external_key')))
+
+    def solely_referenced_ids(self):
+        """The ids of the objects only referenced by absent mappings"""
+        other_mappings = ExternalKeyMapping.objects.filter(
+            content_type=OuterRef('content_type'),
+            object_id=OuterRef('object_id'),
+        ).exclude(pk=OuterRef('pk'))
+        return self.absent_mappings().filter(
+            ~Exists(other_mappings)).values_list('object_id', flat=True)
+
+    def sweep(self):
+        """
+        Delete the absent mappings and their solely referenced objects.
+
+        :return: The number of objects deleted
+        """
+        self.flush()
+        if not self.seen:
+            logger.warning('Snapshot for {} {} was empty, nothing was swept',
+                           self.external_system, self.model.__name__)
+            return 0
+
+        deleted = 0
+        chunk = []
+        # Stream the ids (server side cursor where supported) rather than
+        # loading all of the mappings
+        for object_id in self.solely_referenced_ids().iterator(
+                chunk_size=self.chunk_size):
+            chunk.append(object_id)
+            if len(chunk) >= self.chunk_size:
+                deleted += self.delete_objects(chunk)
+                chunk = []
+        deleted += self.delete_objects(chunk)
+
+        self.absent_mappings().delete()
+        return deleted
+
+    def delete_objects(self, object_ids):
+        if not object_ids:
+            return 0
+        # The total includes the cascaded deletes, so only count the model's
+        (_, counts) = self.model.objects.filter(pk__in=object_ids).delete()
+        return counts.get(self.model._meta.label, 0)
+
+    def discard(self):
+        """Remove the recorded keys"""
+        self.pending = []
+        SnapshotKey.objects.filter(snapshot=self.snapshot).delete()
+
+
+def sweeps_for(actions):
+    """
+    Create the sweeps for a snapshot, from the actions built for it.
+
+    The external keys of the actions that create or update objects are
+    recorded, with a sweep for each external system and model. NB: There is
+    no sweep for an external system and model without any such actions (i.e.
+    an empty snapshot does not delete everything).
+
+    :param actions: The actions built for the snapshot
+    :return: The list of SnapshotSweep objects
+    """
+    sweeps = {}
+    for action in actions:
+        external_key = getattr(action, 'external_key', None)
+        if not external_key or action.type == 'delete':
+            continue
+        target = (action.external_system.pk, action.model)
+        if target not in sweeps:
+            sweeps[target] = SnapshotSweep(action.external_system,
+                                           action.model)
+        sweeps[target].see(external_key)
+    return list(sweeps.values())
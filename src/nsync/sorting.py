@@ -0,0 +1,91 @@
+"""
+NSync external sorting
+
+Sorting helpers for inputs that are larger than memory. Items are kept in
+memory until there are too many, after which they are written to temporary
+files in sorted runs, which are merged as the items are read back.
+"""
+import heapq
+import pickle
+import tempfile
+
+
+class ExternalSorter:
+    """
+    Sorts a stream of (picklable) items, spilling to disk as required.
+
+    The sort is stable, i.e. items with equal keys are produced in the order
+    they were added.
+    """
+    max_in_memory = 100000
+
+    def __init__(self, key=None, max_in_memory=None, directory=None):
+        """
+        Create a sorter.
+
+        :param key: (Optional) The function to obtain the sort key of an item
+        :param max_in_memory: (Optional) The number of items to hold in memory
+            before spilling a sorted run to disk
+        :param directory: (Optional) The directory for the temporary files
+        """
+        self.key = key
+        if max_in_memory is not None:
+            self.max_in_memory = max_in_memory
+        self.directory = directory
+        self.items = []
+        self.runs = []
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def count(self):
+        return len(self.items) + sum(n for _, n in self.runs)
+
+    def add(self, item):
+        self.items.append(item)
+        if len(self.items) >= self.max_in_memory:
+            self.spill()
+
+    def extend(self, items):
+        for item in items:
+            self.add(item)
+
+    def spill(self):
+        """Write the items in memory to disk, as a sorted run"""
+        if not self.items:
+            return
+        self.items.sort(key=self.key)
+        run = tempfile.TemporaryFile(dir=self.directory)
+        for item in self.items:
+            pickle.dump(item, run, pickle.HIGHEST_PROTOCOL)
+        run.seek(0)
+        self.runs.append((run, len(self.items)))
+        self.items = []
+
+    @staticmethod
+    def read_run(run):
+        while True:
+            try:
+                yield pickle.load(run)
+            except EOFError:
+                return
+
+    def __iter__(self):
+        """
+        Produce the items in sorted order. The sorter is emptied by doing so.
+        """
+        self.items.sort(key=self.key)
+        runs = [self.read_run(run) for run, _ in self.runs]
+        runs.append(iter(self.items))
+        try:
+            for item in heapq.merge(*runs, key=self.key):
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        for run, _ in self.runs:
+            run.close()
+        self.runs = []
+        self.items = []
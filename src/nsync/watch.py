@@ -0,0 +1,188 @@
+"""
+NSync drop directory watcher
+
+Files that land in a directory throughout the day can be synchronised as
+they arrive by a single long-running process, rather than starting a new
+syncfiles process (with its Django start up and cold caches) for each file.
+
+The files are matched and their targets extracted in the same way as for
+syncfiles, and they are all synchronised by the same SyncEngine, so its
+RunContext (the external systems and models) and its action factories stay
+warm between the files. Once synchronised, a file is moved to the done
+directory, or to the failed directory along with a .error file. As for a
+request, the database connections that are broken or too old are closed
+before and after each file, so a dropped connection only fails one file.
+
+The directory is polled, and a file is synchronised once its size and
+modification time are unchanged between two polls. If inotify_simple is
+installed (on Linux), the watcher instead wakes up as soon as a file is
+closed after writing, or moved into the directory.
+"""
+import logging
+import os
+import time
+import traceback
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:  # pragma: no cover
+    INotify = None
+
+from django.db import close_old_connections
+
+from .logging import StyleAdapter
+from .management.commands.syncfiles import TargetExtractor
+from .management.commands.utils import RowReaderFinder
+from .rejects import RejectsWriter
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+logger = StyleAdapter(logger)
+
+
+class DirectoryWatcher:
+    """
+    Synchronises the files that arrive in a directory with a SyncEngine.
+    """
+    poll = 5.0
+
+    def __init__(self, directory, engine, pattern, done=None, failed=None,
+                 rejects_directory=None, poll=None, use_inotify=True):
+        """
+        :param directory: The directory to watch
+        :param engine: The SyncEngine to synchronise the files with
+        :param pattern: The compiled file name regex (see syncfiles)
+        :param done: (Optional) The directory to move the synchronised files
+            to. Default: <directory>/done
+        :param failed: (Optional) The directory to move the files that could
+            not be synchronised to. Default: <directory>/failed
+        :param rejects_directory: (Optional) The directory to write a rejects
+            file to for each file. Default: None
+        :param poll: (Optional) The seconds between polls. Default: 5
+        :param use_inotify: (Optional) Use inotify, if it is available.
+            Default: True
+        """
+        self.directory = directory
+        self.engine = engine
+        self.pattern = pattern
+        self.done = done or os.path.join(directory, 'done')
+        self.failed = failed or os.path.join(directory, 'failed')
+        self.rejects_directory = rejects_directory
+        if poll is not None:
+            self.poll = poll
+        self.inotify = None
+        if use_inotify and INotify is not None:
+            self.inotify = INotify()
+            self.inotify.add_watch(directory,
+                                   flags.CLOSE_WRITE | flags.MOVED_TO)
+        self.stats = {}
+        self.written = set()
+        self.processed = 0
+        self.failures = 0
+
+    def run(self, once=False):
+        """
+        Synchronise the files as they arrive, until interrupted.
+
+        :param once: (Optional) Synchronise the files that are already in the
+            directory, then return. Default: False
+        :return: Nothing
+        """
+        if once:
+            for path in self.scan(settled=False):
+                self.process(path)
+            return
+
+        while True:
+            for path in self.scan():
+                self.process(path)
+            self.wait()
+
+    def scan(self, settled=True):
+        """
+        The files to synchronise, oldest first.
+
+        :param settled: (Optional) Only the files that have finished being
+            written, i.e. that are unchanged since the previous scan (or that
+            inotify reported as written). Default: True
+        :return: The list of file paths
+        """
+        stats = {}
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('.') or not entry.is_file() or \
+                    not self.pattern.match(entry.name):
+                continue
+            stat = entry.stat()
+            stats[entry.path] = (stat.st_size, stat.st_mtime)
+
+        ready = [path for path, stat in stats.items()
+                 if not settled or path in self.written or
+                 self.stats.get(path) == stat]
+        self.stats = stats
+        self.written.intersection_update(stats)
+        return sorted(ready, key=lambda path: (stats[path][1], path))
+
+    def wait(self):
+        if self.inotify is None:
+            time.sleep(self.poll)
+            return
+        for event in self.inotify.read(timeout=int(self.poll * 1000)):
+            self.written.add(os.path.join(self.directory, event.name))
+
+    def process(self, path):
+        """
+        Synchronise a file, then move it to the done (or failed) directory.
+
+        :param path: The path of the file
+        :return: True if the file was synchronised
+        """
+        name = os.path.basename(path)
+        rejects = None
+        close_old_connections()
+        try:
+            (system, app, model) = TargetExtractor(self.pattern).extract(name)
+            context = self.engine.context
+            file_format = RowReaderFinder.find_format(name)
+            if self.rejects_directory:
+                rejects_format = RejectsWriter.format_for(file_format)
+                rejects = RejectsWriter(os.path.join(
+                    self.rejects_directory, '{}.{}'.format(
+                        os.path.splitext(name)[0], rejects_format)),
+                    rejects_format)
+
+            with open(path, RowReaderFinder.FORMATS[file_format].mode) as f:
+                self.engine.add_reader(RowReaderFinder.find(f, file_format),
+                                       context.model(app, model),
+                                       context.external_system(system),
+                                       rejects)
+                self.engine.execute()
+        except Exception:
+            self.engine.reset()
+            self.failures += 1
+            error = traceback.format_exc()
+            logger.error('Failed to synchronise {}: {}', name, error)
+            moved = self.move(path, self.failed)
+            with open(moved + '.error', 'w') as f:
+                f.write(error)
+            return False
+        finally:
+            if rejects:
+                rejects.close()
+            close_old_connections()
+
+        self.processed += 1
+        logger.info('Synchronised {}', name)
+        self.move(path, self.done)
+        return True
+
+    @staticmethod
+    def move(path, directory):
+        """Move the file to the directory, without replacing an older one"""
+        os.makedirs(directory, exist_ok=True)
+        name = os.path.basename(path)
+        target = os.path.join(directory, name)
+        if os.path.exists(target):
+            target = os.path.join(directory, '{}-{}'.format(
+                time.strftime('%Y%m%d%H%M%S'), name))
+        os.replace(path, target)
+        return target
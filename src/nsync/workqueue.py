@@ -0,0 +1,277 @@
+"""
+NSync distributed work queue
+
+A large input can be synchronised by several workers (i.e. on several hosts)
+at once. The input is split into chunks of rows, which are stored in the
+SyncChunk table, and each worker repeatedly claims a chunk, executes it with
+the normal actions and marks it as done.
+
+A chunk is claimed by taking a lease on it (a conditional update of its lease
+columns), so a chunk whose worker dies is claimed again once its lease
+expires. Where the database supports it (i.e. PostgreSQL), the candidate
+chunks are also selected with SELECT ... FOR UPDATE SKIP LOCKED, so that the
+workers do not contend for the same chunks.
+
+The chunks are executed in phases, creates, then updates and finally
+deletes, as with the OrderedSyncPolicy. The next phase of a job only starts
+once every chunk has completed the current one.
+"""
+import json
+import logging
+import os
+import socket
+import time
+from datetime import timedelta
+
+from django.apps import apps
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .logging import StyleAdapter
+from .management.commands.utils import CsvActionFactory
+from .models import SyncChunk, SyncJob
+from .policies import execute_actions
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+logger = StyleAdapter(logger)
+
+
+class LeaseLost(Exception):
+    """The lease on a chunk expired and it was claimed by another worker"""
+
+
+# The number of chunks inserted at once
+INSERT_BATCH_SIZE = 10
+
+
+def enqueue(external_system, model, rows, chunk_size=1000, source='',
+            use_upsert=False):
+    """
+    Queue the rows to be synchronised by the workers.
+
+    :param external_system: The ExternalSystem object
+    :param model: The model class to synchronise to
+    :param rows: An iterable of row dicts, in the same layout as the CSV input
+    :param chunk_size: (Optional) The number of rows per chunk. Default: 1000
+    :param source: (Optional) A description of the input (i.e. the file name)
+    :param use_upsert: (Optional) Use upserts for the forced create & update
+        rows. Default: False
+    :return: The SyncJob
+    """
+    if chunk_size < 1:
+        raise ValueError('chunk_size({}) must be positive'.format(chunk_size))
+
+    # In one transaction, so that the workers never see a partial job
+    with transaction.atomic():
+        job = SyncJob.objects.create(external_system=external_system,
+                                     model=model._meta.label,
+                                     source=source,
+                                     use_upsert=use_upsert)
+        # The chunks are inserted a few at a time as they are produced, so
+        # only those (rather than the whole input) are held in memory
+        chunks = []
+        sequence = 0
+        rows_in_chunk = []
+        for row in rows:
+            rows_in_chunk.append(row)
+            if len(rows_in_chunk) >= chunk_size:
+                chunks.append(_chunk(job, sequence, rows_in_chunk))
+                sequence += 1
+                rows_in_chunk = []
+                if len(chunks) >= INSERT_BATCH_SIZE:
+                    SyncChunk.objects.bulk_create(chunks)
+                    chunks = []
+        if rows_in_chunk:
+            chunks.append(_chunk(job, sequence, rows_in_chunk))
+            sequence += 1
+        SyncChunk.objects.bulk_create(chunks)
+
+        if not sequence:
+            job.status = SyncJob.DONE
+            job.save(update_fields=['status'])
+    return job
+
+
+def _chunk(job, sequence, rows):
+    return SyncChunk(job=job, sequence=sequence,
+                     rows=json.dumps(rows, default=str))
+
+
+class Worker:
+    """
+    Claims and executes the chunks of the pending SyncJobs.
+    """
+    # The seconds a claimed chunk is leased for
+    lease = 300
+    # The number of times a chunk is tried before its job is failed
+    max_attempts = 3
+    # The number of candidate chunks considered per claim
+    claim_window = 10
+
+    def __init__(self, name=None, lease=None, max_attempts=None):
+        """
+        :param name: (Optional) The name of the worker, recorded as the owner
+            of its leases. Default: hostname:pid
+        :param lease: (Optional) The seconds a chunk is leased for, which
+            should be longer than it takes to execute one. Default: 300
+        :param max_attempts: (Optional) The number of times a chunk is tried
+            before its job is failed. Default: 3
+        """
+        self.name = name or '{}:{}'.format(socket.gethostname(), os.getpid())
+        if lease is not None:
+            self.lease = lease
+        if max_attempts is not None:
+            self.max_attempts = max_attempts
+        self.executed = 0
+        self.failed = 0
+
+    def run(self, poll=5.0, exit_when_done=False, max_chunks=None):
+        """
+        Execute chunks until stopped.
+
+        :param poll: (Optional) The seconds to wait when there is no chunk to
+            claim. Default: 5
+        :param exit_when_done: (Optional) Return once there are no pending
+            jobs, rather than waiting for more. Default: False
+        :param max_chunks: (Optional) Return after this many chunks.
+            Default: None (no limit)
+        :return: Nothing
+        """
+        while max_chunks is None or self.executed + self.failed < max_chunks:
+            chunk = self.claim()
+            if chunk is not None:
+                self.execute(chunk)
+                continue
+            if self.advance_jobs():
+                continue
+            pending = SyncJob.objects.filter(status=SyncJob.PENDING)
+            if exit_when_done and not pending.exists():
+                return
+            time.sleep(poll)
+
+    def candidates(self):
+        """The chunks that can be claimed, in the order to claim them"""
+        chunks = SyncChunk.objects.filter(
+            job__status=SyncJob.PENDING,
+            phase=F('job__phase'),
+            attempts__lt=self.max_attempts,
+        ).filter(
+            Q(lease_expires__isnull=True) |
+            Q(lease_expires__lt=timezone.now())
+        ).order_by('job_id', 'sequence')
+
+        features = connection.features
+        if features.has_select_for_update_skip_locked:
+            # Skip the chunks being claimed by the other workers
+            of = ('self',) if features.has_select_for_update_of else ()
+            chunks = chunks.select_for_update(skip_locked=True, of=of)
+        return chunks
+
+    def claim(self):
+        """
+        Take the lease on the next available chunk.
+
+        :return: The SyncChunk, or None if there is none available
+        """
+        with transaction.atomic():
+            for chunk in self.candidates()[:self.claim_window]:
+                # Only succeeds if no other worker claimed it in the meantime
+                expires = timezone.now() + timedelta(seconds=self.lease)
+                claimed = SyncChunk.objects.filter(
+                    pk=chunk.pk,
+                    phase=chunk.phase,
+                    lease_owner=chunk.lease_owner,
+                    lease_expires=chunk.lease_expires,
+                ).update(lease_owner=self.name,
+                         lease_expires=expires,
+                         attempts=F('attempts') + 1)
+                if claimed:
+                    chunk.lease_owner = self.name
+                    chunk.lease_expires = expires
+                    chunk.attempts += 1
+                    return chunk
+        return None
+
+    def execute(self, chunk):
+        """
+        Execute the actions of the chunk's current phase, then move it on to
+        the next phase. A failure is recorded on the chunk, which is retried
+        (by any worker) up to max_attempts times.
+
+        :param chunk: A claimed SyncChunk
+        :return: True if the chunk was executed
+        """
+        job = chunk.job
+        phase = SyncJob.PHASES[chunk.phase]
+        try:
+            model = apps.get_model(job.model)
+            builder = CsvActionFactory(model, job.external_system,
+                                       use_upsert=job.use_upsert)
+            with transaction.atomic():
+                actions = []
+                for row in json.loads(chunk.rows):
+                    actions.extend(builder.from_dict(row))
+                execute_actions(a for a in actions if a.type == phase)
+
+                if not SyncChunk.objects.filter(
+                        pk=chunk.pk,
+                        phase=chunk.phase,
+                        lease_owner=self.name).update(
+                            phase=F('phase') + 1,
+                            lease_owner='',
+                            lease_expires=None,
+                            attempts=0,
+                            error=''):
+                    raise LeaseLost('Lost the lease on chunk {}'.format(chunk))
+        except Exception as e:
+            self.failed += 1
+            logger.error('Chunk {} failed in the {} phase: {}',
+                         chunk, phase, e)
+            self.release(chunk, e)
+            return False
+
+        self.executed += 1
+        return True
+
+    def release(self, chunk, error):
+        """Give up the lease on a failed chunk, recording the error"""
+        SyncChunk.objects.filter(pk=chunk.pk, lease_owner=self.name).update(
+            lease_owner='', lease_expires=None, error=str(error))
+        if chunk.attempts >= self.max_attempts:
+            SyncJob.objects.filter(pk=chunk.job_id).update(
+                status=SyncJob.FAILED)
+
+    def advance_jobs(self):
+        """
+        Move each pending job on to its next phase, once every chunk has
+        completed its current phase (the phase barrier).
+
+        :return: True if any job was moved on
+        """
+        advanced = False
+        for job in SyncJob.objects.filter(status=SyncJob.PENDING):
+            waiting = job.chunks.filter(phase__lte=job.phase)
+            if waiting.filter(attempts__gte=self.max_attempts).filter(
+                    Q(lease_expires__isnull=True) |
+                    Q(lease_expires__lt=timezone.now())).exists():
+                # i.e. a chunk whose worker died on its last attempt
+                SyncJob.objects.filter(pk=job.pk).update(
+                    status=SyncJob.FAILED)
+                continue
+            if waiting.exists():
+                continue
+
+            phase = job.phase + 1
+            status = SyncJob.DONE if phase >= len(SyncJob.PHASES) \
+                else SyncJob.PENDING
+            # Conditional, as the other workers may be advancing it too
+            if SyncJob.objects.filter(pk=job.pk, phase=job.phase,
+                                      status=SyncJob.PENDING).update(
+                                          phase=phase, status=status):
+                logger.info('Job {} moved on to the {} phase', job,
+                            SyncJob.PHASES[phase] if status ==
+                            SyncJob.PENDING else 'done')
+                advanced = True
+        return advanced
@@ -1,4 +1,5 @@
 from django.db import models
+from nsync.models import ExternalKeysMixin
 
 
 class TestPerson(models.Model):
@@ -54,3 +55,36 @@ class TestBuilder(TestPerson):
     )
 
 
+class TestProduct(models.Model):
+    nsync_load_used_fields_only = True
+
+    code = models.CharField(max_length=20, unique=True)
+    name = models.CharField(max_length=50, blank=True)
+    price = models.IntegerField(blank=True, null=True)
+
+    @property
+    def priced_name(self):
+        return '{}:{}'.format(self.name, self.price)
+
+    @priced_name.setter
+    def priced_name(self, value):
+        (self.name, price) = value.split(':')
+        self.price = int(price)
+
+    def __str__(self):
+        return '{} - {}'.format(self.code, self.name)
+
+
+class TestTag(models.Model):
+    # Compared case insensitively by SQLite, unlike by Python
+    name = models.CharField(max_length=20, db_collation='NOCASE')
+
+    def __str__(self):
+        return self.name
+
+
+class TestShop(ExternalKeysMixin):
+    name = models.CharField(max_length=50)
+
+    def __str__(self):
+        return self.name
@@ -2,8 +2,11 @@ from unittest.mock import MagicMock, patch, ANY
 
 from django.contrib.contenttypes.fields import ContentType
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import connection, transaction
 from django.db.models.query_utils import Q
+from django.db.models.signals import pre_save
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from nsync.actions import (
     CreateModelAction,
     UpdateModelAction,
@@ -15,10 +18,14 @@ from nsync.actions import (
     SyncActions,
     ActionFactory,
     ObjectSelector,
-    ModelAction)
+    ModelAction,
+    UpsertModelAction,
+    UpsertModelWithReferenceAction,
+    _loaded_fields,
+    _supports_upsert)
 from nsync.models import ExternalSystem, ExternalKeyMapping
 
-from tests.models import TestPerson, TestHouse, TestBuilder
+from tests.models import TestPerson, TestHouse, TestBuilder, TestProduct
 
 
 class TestSyncActions(TestCase):
@@ -155,6 +162,17 @@ class TestModelAction(TestCase):
         self.assertIn("MatchFields:['match_field']", result)
         self.assertIn("Fields:{'match_field': 'value'}", result)
 
+    def test_it_has_no_instance_dict(self):
+        sut = CreateModelWithReferenceAction(
+            MagicMock(), TestPerson, 'key', ['match_field'],
+            {'match_field': 'value'})
+        self.assertFalse(hasattr(sut, '__dict__'))
+
+    def test_it_shares_the_match_on_fields_between_actions(self):
+        first = ModelAction(TestPerson, ['match_field'], {'match_field': 'a'})
+        second = ModelAction(TestPerson, ['match_field'], {'match_field': 'b'})
+        self.assertIs(first.match_on.match_on, second.match_on.match_on)
+
     def test_creating_without_a_model_raises_error(self):
         with self.assertRaises(ValueError):
             ModelAction(None, None)
@@ -178,7 +196,8 @@ class TestModelAction(TestCase):
         model = MagicMock()
         found_object = ModelAction(model, ['matchfield'],
                                    {'matchfield': 'value'}).get_object()
-        self.assertEqual(found_object, model.objects.get.return_value)
+        self.assertEqual(found_object,
+                         model.objects.only.return_value.get.return_value)
 
     def test_it_attempts_to_find_with_all_matchfields(self):
         model = MagicMock()
@@ -186,9 +205,11 @@ class TestModelAction(TestCase):
             model,
             ['matchfield1', 'matchfield2'],
             {'matchfield1': 'value1', 'matchfield2': 'value2'}).get_object()
+        query = model.objects.only.return_value.get.call_args[0][0]
         self.assertEqual(str(Q(matchfield1='value1') & Q(matchfield2='value2')),
-                         str(model.objects.get.call_args[0][0]))
-        self.assertEqual(found_object, model.objects.get.return_value)
+                         str(query))
+        self.assertEqual(found_object,
+                         model.objects.only.return_value.get.return_value)
 
     def test_it_builds_OR_Q_object_if_last_token_is_pipe(self):
         model = MagicMock()
@@ -196,9 +217,11 @@ class TestModelAction(TestCase):
             model,
             ['matchfield1', 'matchfield2', '|'],
             {'matchfield1': 'value1', 'matchfield2': 'value2'}).get_object()
+        query = model.objects.only.return_value.get.call_args[0][0]
         self.assertEqual(str(Q(matchfield1='value1') | Q(matchfield2='value2')),
-                         str(model.objects.get.call_args[0][0]))
-        self.assertEqual(found_object, model.objects.get.return_value)
+                         str(query))
+        self.assertEqual(found_object,
+                         model.objects.only.return_value.get.return_value)
 
     def test_it_finds_an_object_with_alternative_options(self):
         model = MagicMock()
@@ -206,9 +229,11 @@ class TestModelAction(TestCase):
             model,
             ['matchfield1', 'matchfield2', '|'],
             {'matchfield1': 'value1', 'matchfield2': 'value2'}).get_object()
+        query = model.objects.only.return_value.get.call_args[0][0]
         self.assertEqual(str(Q(matchfield1='value1') | Q(matchfield2='value2')),
-                         str(model.objects.get.call_args[0][0]))
-        self.assertEqual(found_object, model.objects.get.return_value)
+                         str(query))
+        self.assertEqual(found_object,
+                         model.objects.only.return_value.get.return_value)
         john = TestPerson.objects.create(first_name='John', last_name='Smith')
         jill = TestPerson.objects.create(first_name='Jill', last_name='Smyth')
 
@@ -827,6 +852,59 @@ class TestUpdateModelAction(TestCase):
         john.refresh_from_db()
         self.assertEquals('Jackson', john.last_name)
 
+    def test_it_only_loads_and_saves_the_columns_it_uses(self):
+        TestProduct.objects.create(code='P1', name='Old', price=10)
+        sut = UpdateModelAction(TestProduct, ['code'],
+                                {'code': 'P1', 'name': 'New'}, True)
+        with CaptureQueriesContext(connection) as queries:
+            result = sut.execute()
+
+        self.assertEqual({'price'}, result.get_deferred_fields())
+        self.assertNotIn('price', queries[0]['sql'])
+        self.assertNotIn('price', queries[-2]['sql'])  # before the release
+        self.assertEqual(10, TestProduct.objects.get(code='P1').price)
+
+    def test_it_saves_the_columns_set_by_a_property_setter(self):
+        TestProduct.objects.create(code='P1', name='Old', price=10)
+        sut = UpdateModelAction(TestProduct, ['code'],
+                                {'code': 'P1', 'priced_name': 'New:20'}, True)
+        sut.execute()
+
+        product = TestProduct.objects.get(code='P1')
+        self.assertEqual('New', product.name)
+        self.assertEqual(20, product.price)
+
+    def test_it_saves_the_columns_set_by_a_pre_save_handler(self):
+        TestHouse.objects.create(address='Bottom', floors=1)
+
+        def count_floors(sender, instance, **kwargs):
+            instance.floors = 2
+        pre_save.connect(count_floors, sender=TestHouse)
+        self.addCleanup(pre_save.disconnect, count_floors, sender=TestHouse)
+
+        sut = UpdateModelAction(TestHouse, ['address'],
+                                {'address': 'Bottom', 'country': 'Belgium'},
+                                True)
+        sut.execute()
+
+        self.assertEqual(2, TestHouse.objects.get(address='Bottom').floors)
+
+    def test_it_loads_all_of_the_columns_unless_the_model_opts_in(self):
+        sut = UpdateModelAction(TestHouse, ['address'],
+                                {'address': 'Bottom', 'floors': 1})
+        self.assertEqual(set(), set(sut.queryset().query.deferred_loading[0]))
+
+    def test_loaded_fields_include_the_referred_to_fields(self):
+        _loaded_fields.cache_clear()
+        self.addCleanup(_loaded_fields.cache_clear)
+        sut = UpdateModelAction(
+            TestHouse, ['address'],
+            {'address': 'Bottom', 'owner=>first_name': 'A'})
+        with patch.object(TestHouse, 'nsync_load_used_fields_only', True,
+                          create=True):
+            self.assertEqual({'id', 'address', 'owner'},
+                             set(sut.queryset().query.deferred_loading[0]))
+
 
 class TestUpdateModelWithReferenceAction(TestCase):
     """
@@ -944,7 +1022,8 @@ class TestUpdateModelWithReferenceAction(TestCase):
             content_object = person,
             object_id = person.id)
 
-        with patch.object(self.update_john, 'get_object') as get_object:
+        with patch.object(UpdateModelWithReferenceAction,
+                          'get_object') as get_object:
             get_object.return_value.return_value = person
             with patch.object(person, 'delete') as delete:
                 self.update_john.execute()
@@ -1045,6 +1124,22 @@ class TestDeleteIfOnlyReferenceModelAction(TestCase):
         self.assertFalse(delete_action.execute.called)
         delete_action.execute.assert_not_called()  # Works in py3.5
 
+    def test_it_checks_the_mappings_with_one_query(self):
+        john = TestPerson.objects.create(first_name='John')
+        ExternalKeyMapping.objects.create(
+            external_system=self.external_system,
+            external_key='Person123',
+            content_type=ContentType.objects.get_for_model(TestPerson),
+            object_id=john.id)
+        delete_action = MagicMock()
+        delete_action.model = TestPerson
+        delete_action.get_object.return_value = john
+        with self.assertNumQueries(1):
+            DeleteIfOnlyReferenceModelAction(self.external_system,
+                                             'Person123',
+                                             delete_action).execute()
+        delete_action.execute.assert_called_with()
+
 
 class TestDeleteExternalReferenceAction(TestCase):
     def test_it_deletes_the_matching_external_reference(self):
@@ -1100,3 +1195,144 @@ class TestActionTypes(TestCase):
                           DeleteExternalReferenceAction(ANY, ANY).type)
 
         
+class TestUpsertModelAction(TestCase):
+    def setUp(self):
+        self.external_system = ExternalSystem.objects.create(name='System')
+        self.factory = ActionFactory(TestProduct, self.external_system,
+                                     use_upsert=True)
+
+    def build(self, code, external_key=None, flags=None, **fields):
+        fields['code'] = code
+        return self.factory.build(
+            flags or SyncActions(create=True, update=True, force=True),
+            ['code'], external_key, fields)
+
+    def test_factory_builds_an_upsert_for_forced_create_and_update(self):
+        actions = self.build('P1', name='Product')
+        self.assertEqual(1, len(actions))
+        self.assertIsInstance(actions[0], UpsertModelAction)
+        self.assertEqual('create', actions[0].type)
+
+    def test_factory_builds_an_upsert_with_reference_if_mappable(self):
+        actions = self.build('P1', 'Key1', name='Product')
+        self.assertIsInstance(actions[0], UpsertModelWithReferenceAction)
+
+    def test_factory_does_not_build_an_upsert_if_not_forced(self):
+        actions = self.build('P1', flags=SyncActions(create=True,
+                                                     update=True))
+        self.assertFalse(any(isinstance(a, UpsertModelAction)
+                             for a in actions))
+
+    def test_factory_does_not_build_an_upsert_if_not_enabled(self):
+        self.factory.use_upsert = False
+        self.assertEqual(2, len(self.build('P1')))
+
+    def test_it_is_only_supported_for_unique_plain_fields(self):
+        self.assertTrue(UpsertModelAction.supports(
+            TestProduct, ['code'], ['code', 'name']))
+        self.assertFalse(UpsertModelAction.supports(
+            TestProduct, ['name'], ['code', 'name']))
+        self.assertFalse(UpsertModelAction.supports(
+            TestProduct, ['code', 'name', '|'], ['code', 'name']))
+        self.assertFalse(UpsertModelAction.supports(
+            TestProduct, ['code'], ['code', 'missing']))
+        self.assertFalse(UpsertModelAction.supports(
+            TestHouse, ['address'], ['address', 'owner']))
+
+    def test_it_is_not_supported_without_the_database_features(self):
+        _supports_upsert.cache_clear()
+        self.addCleanup(_supports_upsert.cache_clear)
+        features = connection.features
+        with patch.object(features, 'supports_update_conflicts_with_target',
+                          False):
+            self.assertFalse(UpsertModelAction.supports(
+                TestProduct, ['code'], ['code', 'name']))
+            self.assertTrue(UpsertModelAction.supports(
+                TestProduct, ['code'], ['code']))
+            self.assertEqual(2, len(self.build('P2', name='Product')))
+
+    def test_it_creates_and_updates_in_one_statement(self):
+        TestProduct.objects.create(code='P1', name='Old', price=5)
+        actions = self.build('P1', name='New', price='') + \
+            self.build('P2', name='Other', price='10')
+
+        # The statement, within its savepoint
+        with self.assertNumQueries(3):
+            UpsertModelAction.execute_batch(actions)
+
+        p1 = TestProduct.objects.get(code='P1')
+        self.assertEqual('New', p1.name)
+        self.assertIsNone(p1.price)
+        self.assertEqual(10, TestProduct.objects.get(code='P2').price)
+
+    def test_the_last_action_for_an_object_in_a_batch_wins(self):
+        actions = self.build('P1', name='First') + \
+            self.build('P1', name='Second')
+        UpsertModelAction.execute_batch(actions)
+        self.assertEqual('Second', TestProduct.objects.get(code='P1').name)
+
+    def test_it_creates_and_updates_the_references(self):
+        existing = TestProduct.objects.create(code='P1')
+        ExternalKeyMapping.objects.create(
+            external_system=self.external_system, external_key='Key1',
+            content_type=ContentType.objects.get_for_model(TestProduct),
+            object_id=existing.id)
+
+        actions = self.build('P1', 'Key1', name='One') + \
+            self.build('P2', 'Key2', name='Two')
+        UpsertModelWithReferenceAction.execute_batch(actions)
+
+        self.assertEqual(2, ExternalKeyMapping.objects.count())
+        for key, code in [('Key1', 'P1'), ('Key2', 'P2')]:
+            mapping = ExternalKeyMapping.objects.get(external_key=key)
+            self.assertEqual(TestProduct.objects.get(code=code),
+                             mapping.content_object)
+
+    def mapped_state(self):
+        return (sorted(TestProduct.objects.values_list('code', 'name')),
+                sorted((m.external_key, m.content_object.code)
+                       for m in ExternalKeyMapping.objects.all()))
+
+    def assert_matches_the_actions_per_row(self, rows):
+        self.factory.use_upsert = False
+        with transaction.atomic():
+            for (code, key, name) in rows:
+                for action in self.build(code, key, name=name):
+                    action.execute()
+            expected = self.mapped_state()
+            transaction.set_rollback(True)
+
+        self.factory.use_upsert = True
+        actions = []
+        for (code, key, name) in rows:
+            actions.extend(self.build(code, key, name=name))
+        UpsertModelWithReferenceAction.execute_batch(actions)
+
+        self.assertEqual(expected, self.mapped_state())
+
+    def test_a_repeated_external_key_matches_the_actions_per_row(self):
+        TestProduct.objects.create(code='P4', name='Existing')
+        self.assert_matches_the_actions_per_row([
+            ('P1', 'Key1', 'One'), ('P2', 'Key1', 'Two'),
+            ('P3', 'Key2', 'Three'), ('P4', 'Key1', 'Four'),
+            ('P3', 'Key3', 'Five')])
+
+    def test_the_relinking_actions_are_executed_in_order(self):
+        self.assert_matches_the_actions_per_row([
+            ('P3', 'Key2', 'One'), ('P3', 'Key3', 'Two'),
+            ('P3', 'Key3', 'Three'), ('P1', 'Key2', 'Four')])
+
+    def test_it_updates_the_linked_object_if_the_reference_differs(self):
+        linked = TestProduct.objects.create(code='P1')
+        ExternalKeyMapping.objects.create(
+            external_system=self.external_system, external_key='Key1',
+            content_type=ContentType.objects.get_for_model(TestProduct),
+            object_id=linked.id)
+
+        UpsertModelWithReferenceAction.execute_batch(
+            self.build('P1-renamed', 'Key1', name='Renamed'))
+
+        linked.refresh_from_db()
+        self.assertEqual('P1-renamed', linked.code)
+        self.assertEqual('Renamed', linked.name)
+        self.assertEqual(1, TestProduct.objects.count())
@@ -0,0 +1,161 @@
+import asyncio
+import time
+from unittest.mock import patch
+
+from asgiref.sync import async_to_sync
+from django.test import TestCase
+import nsync
+from nsync.models import ExternalKeyMapping, ExternalSystem
+
+from tests.models import TestHouse
+
+
+async def as_async_iterable(rows):
+    for row in rows:
+        yield row
+
+
+class TestSyncAsync(TestCase):
+    def sync(self, rows, **kwargs):
+        return async_to_sync(nsync.sync_async)(
+            TestHouse, 'TestSystem', as_async_iterable(rows), **kwargs)
+
+    def test_it_synchronises_the_rows(self):
+        TestHouse.objects.create(address='House1')
+
+        count = self.sync([
+            {'action_flags': 'u*', 'match_on': 'address',
+             'address': 'House1', 'country': 'Australia'},
+            {'external_key': 'House2Key', 'action_flags': 'c',
+             'match_on': 'address', 'address': 'House2'},
+        ])
+
+        self.assertEqual(2, count)
+        self.assertEqual('Australia',
+                         TestHouse.objects.get(address='House1').country)
+        self.assertTrue(TestHouse.objects.filter(address='House2').exists())
+        self.assertTrue(ExternalSystem.objects.filter(
+            name='TestSystem').exists())
+        self.assertEqual(1, ExternalKeyMapping.objects.count())
+
+    def test_it_accepts_plain_iterables(self):
+        async_to_sync(nsync.sync_async)(TestHouse, 'TestSystem', [
+            {'action_flags': 'c', 'match_on': 'address',
+             'address': 'House1'}])
+        self.assertEqual(1, TestHouse.objects.count())
+
+    def test_it_executes_the_rows_in_batches(self):
+        rows = [{'action_flags': 'c', 'match_on': 'address',
+                 'address': 'House{}'.format(i)} for i in range(5)]
+
+        with patch('nsync.asynchronous.sync_batch') as sync_batch:
+            self.sync(rows, batch_size=2)
+
+        self.assertEqual([2, 2, 1], [len(c[0][2])
+                                     for c in sync_batch.call_args_list])
+
+    def test_it_is_a_coroutine_function(self):
+        self.assertTrue(asyncio.iscoroutinefunction(nsync.sync_async))
+
+    def test_it_executes_the_batches_with_one_engine(self):
+        rows = [{'action_flags': 'c', 'match_on': 'address',
+                 'address': 'House{}'.format(i)} for i in range(3)]
+
+        with patch('nsync.asynchronous.sync_batch') as sync_batch:
+            self.sync(rows, batch_size=1)
+
+        engines = set(id(c[1]['engine']) for c in sync_batch.call_args_list)
+        self.assertEqual(3, sync_batch.call_count)
+        self.assertEqual(1, len(engines))
+
+    def test_it_closes_the_rows_if_a_batch_fails(self):
+        closed = []
+
+        async def rows():
+            try:
+                for i in range(10):
+                    yield {'action_flags': 'c', 'match_on': 'address',
+                           'address': 'House{}'.format(i)}
+                    await asyncio.sleep(0)
+            finally:
+                closed.append(True)
+
+        async def run():
+            try:
+                await nsync.sync_async(TestHouse, 'TestSystem', rows(),
+                                       batch_size=1, max_pending=1)
+            except ValueError:
+                # Closed by the sync, not when the event loop is shut down
+                return list(closed)
+
+        with patch('nsync.asynchronous.sync_batch',
+                   side_effect=ValueError('Bad batch')):
+            self.assertEqual([True], async_to_sync(run)())
+
+    def test_it_executes_a_partial_batch_after_max_wait(self):
+        executed = []
+
+        async def slow_rows():
+            yield {'action_flags': 'c', 'match_on': 'address',
+                   'address': 'House1'}
+            # The next row is only produced once the first was executed
+            for _ in range(100):
+                if executed:
+                    break
+                await asyncio.sleep(0.01)
+            yield {'action_flags': 'c', 'match_on': 'address',
+                   'address': 'House2'}
+
+        with patch('nsync.asynchronous.sync_batch',
+                   side_effect=lambda *args, **kwargs: executed.append(
+                       args[2])) as sync_batch:
+            async_to_sync(nsync.sync_async)(
+                TestHouse, 'TestSystem', slow_rows(), batch_size=10,
+                max_wait=0.05)
+
+        self.assertEqual([1, 1], [len(c[0][2])
+                                  for c in sync_batch.call_args_list])
+
+    def test_the_event_loop_is_not_blocked_by_a_batch(self):
+        ticks = []
+        ticks_during_batch = []
+
+        async def tick():
+            for _ in range(20):
+                ticks.append(None)
+                await asyncio.sleep(0.01)
+
+        def slow_batch(*args, **kwargs):
+            before = len(ticks)
+            time.sleep(0.1)
+            ticks_during_batch.append(len(ticks) - before)
+
+        async def run():
+            await asyncio.gather(tick(), nsync.sync_async(
+                TestHouse, 'TestSystem', as_async_iterable([
+                    {'action_flags': 'c', 'match_on': 'address',
+                     'address': 'House1'}])))
+
+        with patch('nsync.asynchronous.sync_batch', side_effect=slow_batch):
+            async_to_sync(run)()
+
+        self.assertGreater(ticks_during_batch[0], 0)
+
+    def test_it_does_not_modify_the_provided_rows(self):
+        row = {'action_flags': 'c', 'match_on': 'address',
+               'address': 'House1'}
+        self.sync([row])
+        self.assertIn('action_flags', row)
+
+    def test_it_raises_the_error_from_a_failed_batch(self):
+        rows = [{'action_flags': 'c', 'match_on': 'address',
+                 'address': 'House{}'.format(i)} for i in range(10)]
+
+        with patch('nsync.asynchronous.sync_batch',
+                   side_effect=ValueError('Bad batch')):
+            with self.assertRaises(ValueError):
+                self.sync(rows, batch_size=1, max_pending=1)
+
+    def test_it_raises_an_error_for_invalid_batch_size(self):
+        with self.assertRaises(ValueError):
+            self.sync([], batch_size=0)
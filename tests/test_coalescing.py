@@ -0,0 +1,173 @@
+import tempfile
+
+from django.core.management import call_command
+from django.test import TestCase
+from nsync.coalescing import RowCoalescer
+from nsync.management.commands.utils import CsvActionFactory
+from nsync.models import ExternalSystem
+
+from tests.models import TestHouse, TestPerson
+
+
+class TestRowCoalescer(TestCase):
+    def setUp(self):
+        self.external_system = ExternalSystem.objects.create(name='System')
+        self.factory = CsvActionFactory(TestHouse, self.external_system)
+
+    def row(self, external_key, address, flags='cu', match_on='address',
+            **fields):
+        fields.update({'external_key': external_key, 'action_flags': flags,
+                       'match_on': match_on, 'address': address})
+        return fields
+
+    def coalesce(self, rows, factory=None, **kwargs):
+        sut = RowCoalescer(**kwargs)
+        for row in rows:
+            sut.add(factory or self.factory, row)
+        return [row for _, row in sut]
+
+    def test_it_keeps_the_last_row_for_an_external_key(self):
+        rows = [self.row('Key1', 'House1'),
+                self.row('Key2', 'House2'),
+                self.row('Key1', 'House1b')]
+        self.assertEqual(rows[1:], self.coalesce(rows))
+
+    def test_it_keeps_the_last_row_for_the_same_match_values(self):
+        rows = [self.row('', 'House1', country='Belgium'),
+                self.row('', 'House2'),
+                self.row('', 'House1', country='Australia')]
+        self.assertEqual(rows[1:], self.coalesce(rows))
+
+    def test_a_row_is_merged_by_either_key(self):
+        rows = [self.row('', 'House1', country='Belgium'),
+                self.row('Key1', 'House1')]
+        self.assertEqual([self.row('Key1', 'House1', country='Belgium')],
+                         self.coalesce(rows))
+
+    def test_it_merges_the_action_flags(self):
+        rows = [self.row('Key1', 'House1', flags='c'),
+                self.row('Key1', 'House1', flags='u*')]
+        self.assertEqual([self.row('Key1', 'House1', flags='cu*')],
+                         self.coalesce(rows))
+
+    def test_the_later_non_empty_values_override_the_earlier_values(self):
+        rows = [self.row('Key1', 'House1', country='Belgium', floors='2'),
+                self.row('Key1', 'House1b', country='', built='1990')]
+        self.assertEqual([self.row('Key1', 'House1b', country='Belgium',
+                                   floors='2', built='1990')],
+                         self.coalesce(rows))
+
+    def test_it_keeps_the_rows_of_different_external_keys(self):
+        rows = [self.row('Key1', 'House1'),
+                self.row('Key2', 'House1'),
+                self.row('Key2', 'House2')]
+        self.assertEqual([rows[0], rows[2]], self.coalesce(rows))
+
+    def test_it_does_not_merge_a_delete_with_a_create_or_update(self):
+        rows = [self.row('Key1', 'House1', flags='d'),
+                self.row('Key1', 'House1', flags='u'),
+                self.row('Key1', 'House1', flags='d*'),
+                self.row('Key1', 'House1', flags='d')]
+        self.assertEqual([rows[0], rows[1], self.row('Key1', 'House1',
+                                                     flags='d*')],
+                         self.coalesce(rows))
+
+    def test_it_does_not_coalesce_different_models_or_systems(self):
+        other_system = CsvActionFactory(
+            TestHouse, ExternalSystem.objects.create(name='Other'))
+        other_model = CsvActionFactory(TestPerson, self.external_system)
+        sut = RowCoalescer()
+        rows = [self.row('Key1', 'House1'),
+                self.row('Key1', 'House2'),
+                {'external_key': 'Key1', 'action_flags': 'c',
+                 'match_on': 'first_name', 'first_name': 'House1'}]
+        sut.add(self.factory, rows[0])
+        sut.add(other_system, rows[1])
+        sut.add(other_model, rows[2])
+        self.assertEqual(3, len(list(sut)))
+
+    def test_the_same_match_values_coalesce_across_systems(self):
+        other_system = CsvActionFactory(
+            TestHouse, ExternalSystem.objects.create(name='Other'))
+        sut = RowCoalescer()
+        sut.add(self.factory, self.row('', 'House1'))
+        sut.add(other_system, self.row('', 'House1'))
+        self.assertEqual([other_system], [f for f, _ in sut])
+
+    def test_an_external_key_is_not_merged_across_systems(self):
+        other_system = CsvActionFactory(
+            TestHouse, ExternalSystem.objects.create(name='Other'))
+        sut = RowCoalescer()
+        sut.add(self.factory, self.row('Key1', 'House1'))
+        sut.add(other_system, self.row('', 'House1'))
+        self.assertEqual([self.factory, other_system], [f for f, _ in sut])
+
+    def test_rows_matching_with_operators_are_only_coalesced_by_key(self):
+        rows = [self.row('', 'House1', match_on='address country |',
+                         country='A'),
+                self.row('', 'House1', match_on='address country |',
+                         country='A')]
+        self.assertEqual(rows, self.coalesce(rows))
+
+    def test_it_produces_the_same_result_when_spilling_to_disk(self):
+        rows = [self.row('Key{}'.format(i % 7), 'House{}'.format(i % 5))
+                for i in range(50)]
+        self.assertEqual(self.coalesce(rows),
+                         self.coalesce(rows, max_in_memory=4))
+
+    def test_it_builds_the_actions_for_the_surviving_rows(self):
+        sut = RowCoalescer()
+        sut.add(self.factory, self.row('Key1', 'House1', flags='c'))
+        sut.add(self.factory, self.row('Key1', 'House2', flags='c'))
+        actions = list(sut.actions())
+        self.assertEqual(1, len(actions))
+        self.assertEqual('House2', actions[0].fields['address'])
+
+
+class TestCoalescingCommands(TestCase):
+    def write(self, lines, prefix='TestSystem_tests_TestHouse_'):
+        csv_file_obj = tempfile.NamedTemporaryFile(mode='w', prefix=prefix,
+                                                   suffix='.csv')
+        csv_file_obj.writelines(lines)
+        csv_file_obj.seek(0)
+        return csv_file_obj
+
+    def test_superseded_rows_are_not_executed(self):
+        csv_file_obj = self.write([
+            'external_key,action_flags,match_on,address,country\n',
+            'Key1,c,address,House1,Belgium\n',
+            'Key1,c,address,House1b,Australia\n',
+        ])
+
+        call_command('syncfiles', csv_file_obj.name, coalesce=True)
+
+        self.assertEqual(['House1b'], list(
+            TestHouse.objects.values_list('address', flat=True)))
+
+    def test_a_create_followed_by_an_update_creates_the_object(self):
+        csv_file_obj = self.write([
+            'external_key,action_flags,match_on,address,country\n',
+            'Key1,c,address,A1,\n',
+            'Key1,u,address,A2,X\n',
+        ])
+
+        call_command('syncfile', 'TestSystem', 'tests', 'TestHouse',
+                     csv_file_obj.name, coalesce=True)
+
+        self.assertEqual([('A2', 'X')], list(
+            TestHouse.objects.values_list('address', 'country')))
+
+    def test_the_columns_of_the_earlier_files_are_kept(self):
+        first = self.write([
+            'external_key,action_flags,match_on,address,country\n',
+            'Key1,cu,address,House1,Belgium\n',
+        ])
+        second = self.write([
+            'external_key,action_flags,match_on,address,floors\n',
+            'Key1,cu,address,House1,3\n',
+        ])
+
+        call_command('syncfiles', first.name, second.name, coalesce=True)
+
+        self.assertEqual([('House1', 'Belgium', 3)], list(
+            TestHouse.objects.values_list('address', 'country', 'floors')))
@@ -1,3 +1,5 @@
+import csv
+import json
 import tempfile
 from unittest.mock import MagicMock, patch
 
@@ -8,7 +10,7 @@ from django.test import TestCase
 from nsync.management.commands.syncfile import SyncFileAction
 from nsync.models import ExternalKeyMapping, ExternalSystem
 
-from tests.models import TestHouse
+from tests.models import TestHouse, TestPerson, TestProduct
 
 
 class TestSyncFileCommand(TestCase):
@@ -17,9 +19,14 @@ class TestSyncFileCommand(TestCase):
             call_command('syncfile', 'systemName', 'tests', 'TestPerson',
                          'file')
 
+    def test_command_raises_error_for_conflicting_policies(self):
+        with self.assertRaises(CommandError):
+            call_command('syncfile', 'systemName', 'tests', 'TestPerson',
+                         'file', partitions=2, merge_join=True)
+
 
 class TestSyncFileAction(TestCase):
-    @patch('nsync.management.commands.syncfile.CsvActionFactory')
+    @patch('nsync.engine.CsvActionFactory')
     @patch('csv.DictReader')
     def test_data_flow(self, DictReader, CsvActionFactory):
         file = MagicMock()
@@ -33,14 +40,15 @@ class TestSyncFileAction(TestCase):
         CsvActionFactory.return_value.from_dict.return_value = [action_mock]
         SyncFileAction.sync(external_system_mock, model_mock, file, False)
         DictReader.assert_called_with(file)
-        CsvActionFactory.assert_called_with(model_mock, external_system_mock)
+        CsvActionFactory.assert_called_with(model_mock, external_system_mock,
+                                            use_upsert=False)
 
         CsvActionFactory.return_value.from_dict.assert_called_with(row)
         action_mock.execute.assert_called_once_with()
 
-    @patch('nsync.management.commands.syncfile.TransactionSyncPolicy')
-    @patch('nsync.management.commands.syncfile.BasicSyncPolicy')
-    @patch('nsync.management.commands.syncfile.CsvActionFactory')
+    @patch('nsync.engine.TransactionSyncPolicy')
+    @patch('nsync.engine.BasicSyncPolicy')
+    @patch('nsync.engine.CsvActionFactory')
     def test_it_wraps_the_basic_policy_in_a_transaction_policy_if_configured(
             self, CsvActionFactory,
             BasicSyncPolicy, TransactionSyncPolicy):
@@ -49,6 +57,24 @@ class TestSyncFileAction(TestCase):
         TransactionSyncPolicy.return_value.execute.assert_called_once_with()
 
 
+    @patch('nsync.management.commands.syncfile.SyncEngine')
+    def test_the_command_passes_each_option_to_the_engine(self, SyncEngine):
+        SyncEngine.conflicting_policies.return_value = None
+        csv_file_obj = tempfile.NamedTemporaryFile(mode='w')
+        csv_file_obj.writelines(['action_flags,match_on,address\n'])
+        csv_file_obj.seek(0)
+
+        call_command('syncfile', 'TestSystem', 'tests', 'TestHouse',
+                     csv_file_obj.name, coalesce=True, merge_join=True)
+
+        kwargs = SyncEngine.call_args[1]
+        self.assertTrue(kwargs['coalesce'])
+        self.assertTrue(kwargs['merge_join'])
+        self.assertFalse(kwargs['upsert'])
+        self.assertFalse(kwargs['snapshot'])
+        self.assertFalse(kwargs['concurrent'])
+
+
 class TestSyncSingleFileIntegrationTests(TestCase):
     def test_create_and_update(self):
         house1 = TestHouse.objects.create(address='House1')
@@ -192,3 +218,95 @@ class TestSyncSingleFileIntegrationTests(TestCase):
             external_key='House3Key').exists())
         self.assertTrue(ExternalKeyMapping.objects.filter(
             external_key='House4Key').exists())
+
+    def test_create_and_update_from_json_lines(self):
+        TestHouse.objects.create(address='House1', country='Belgium')
+
+        jsonl_file_obj = tempfile.NamedTemporaryFile(mode='w',
+                                                     suffix='.jsonl')
+        jsonl_file_obj.writelines([
+            '{"action_flags": "u*", "match_on": ["address"], '
+            '"address": "House1", "country": "Australia"}\n',
+            '{"action_flags": "c", "match_on": "address", '
+            '"address": "House2", "floors": 2}\n',
+        ])
+        jsonl_file_obj.seek(0)
+
+        call_command('syncfile', 'TestSystem', 'tests', 'TestHouse',
+                     jsonl_file_obj.name)
+
+        self.assertEqual('Australia',
+                         TestHouse.objects.get(address='House1').country)
+        self.assertEqual(2, TestHouse.objects.get(address='House2').floors)
+
+    def test_forced_create_and_update_as_upserts(self):
+        TestProduct.objects.create(code='P1', name='Old')
+
+        csv_file_obj = tempfile.NamedTemporaryFile(mode='w')
+        csv_file_obj.writelines([
+            'external_key,action_flags,match_on,code,name\n',
+            'Key1,cu*,code,P1,New\n',
+            'Key2,cu*,code,P2,Other\n',
+        ])
+        csv_file_obj.seek(0)
+
+        call_command('syncfile', 'TestSystem', 'tests', 'TestProduct',
+                     csv_file_obj.name, upsert=True)
+
+        self.assertEqual(['New', 'Other'], list(
+            TestProduct.objects.order_by('code').values_list('name',
+                                                             flat=True)))
+        self.assertEqual(2, ExternalKeyMapping.objects.count())
+
+    def test_failed_rows_are_written_to_the_rejects_file(self):
+        csv_file_obj = tempfile.NamedTemporaryFile(mode='w')
+        csv_file_obj.writelines([
+            'action_flags,match_on,address,owner=>first_name\n',
+            'c,address,House1,\n',
+            'u*,address,House2,\n',
+            'cu,address,House3,Nobody\n',
+        ])
+        csv_file_obj.seek(0)
+        rejects_file_obj = tempfile.NamedTemporaryFile(mode='r',
+                                                       suffix='.csv')
+
+        call_command('syncfile', 'TestSystem', 'tests', 'TestHouse',
+                     csv_file_obj.name, rejects=rejects_file_obj.name)
+
+        rejects = list(csv.DictReader(rejects_file_obj))
+        self.assertEqual(['House2', 'House3'],
+                         [row['address'] for row in rejects])
+        self.assertEqual('No object found to update',
+                         rejects[0]['reject_reason'])
+        self.assertIn('Could not find TestPerson', rejects[1]['reject_reason'])
+        self.assertEqual('cu', rejects[1]['action_flags'])
+
+        # The rejects can be synchronised again, once corrected
+        TestPerson.objects.create(first_name='Nobody')
+        call_command('syncfile', 'TestSystem', 'tests', 'TestHouse',
+                     rejects_file_obj.name)
+        self.assertEqual('Nobody', TestHouse.objects.get(
+            address='House3').owner.first_name)
+
+    def test_the_rejects_of_a_json_lines_file_keep_all_of_their_keys(self):
+        jsonl_file_obj = tempfile.NamedTemporaryFile(mode='w',
+                                                     suffix='.jsonl')
+        jsonl_file_obj.writelines([
+            '{"action_flags": "u*", "match_on": "address", '
+            '"address": "House1", "floors": 2}\n',
+            '{"action_flags": "u*", "match_on": "address", '
+            '"address": "House2", "country": "Australia"}\n',
+        ])
+        jsonl_file_obj.seek(0)
+        rejects_file_obj = tempfile.NamedTemporaryFile(mode='r',
+                                                       suffix='.jsonl')
+
+        call_command('syncfile', 'TestSystem', 'tests', 'TestHouse',
+                     jsonl_file_obj.name, rejects=rejects_file_obj.name)
+
+        rejects = [json.loads(line) for line in rejects_file_obj]
+        self.assertEqual([2, None], [row.get('floors') for row in rejects])
+        self.assertEqual([None, 'Australia'],
+                         [row.get('country') for row in rejects])
+        self.assertEqual(['No object found to update'] * 2,
+                         [row['reject_reason'] for row in rejects])
@@ -44,7 +44,7 @@ class TestTestableCommand(TestCase):
             'as_transaction': ''
         }
 
-    @patch('nsync.management.commands.syncfiles.BasicSyncPolicy')
+    @patch('nsync.engine.BasicSyncPolicy')
     def test_it_uses_the_basic_policy_if_smart_ordering_is_false(self, Policy):
         self.defaults['smart_ordering'] = False
         actions_list = MagicMock()
@@ -56,7 +56,7 @@ class TestTestableCommand(TestCase):
             Policy.assert_called_with(actions_list)
             Policy.return_value.execute.assert_called_once_with()
 
-    @patch('nsync.management.commands.syncfiles.OrderedSyncPolicy')
+    @patch('nsync.engine.OrderedSyncPolicy')
     def test_it_uses_the_ordered_policy_if_smart_ordering_is_true(self,
                                                                   Policy):
         self.defaults['smart_ordering'] = True
@@ -69,8 +69,8 @@ class TestTestableCommand(TestCase):
             Policy.assert_called_with(actions_list)
             Policy.return_value.execute.assert_called_once_with()
 
-    @patch('nsync.management.commands.syncfiles.TransactionSyncPolicy')
-    @patch('nsync.management.commands.syncfiles.BasicSyncPolicy')
+    @patch('nsync.engine.TransactionSyncPolicy')
+    @patch('nsync.engine.BasicSyncPolicy')
     def test_it_wraps_the_basic_policy_in_a_transaction_policy_if_configured(
             self, BasicSyncPolicy, TransactionSyncPolicy):
         self.defaults['smart_ordering'] = False
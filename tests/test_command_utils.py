@@ -1,4 +1,6 @@
-from unittest.mock import MagicMock, patch
+import io
+from unittest import skipIf
+from unittest.mock import ANY, MagicMock, patch
 
 from django.core.management.base import CommandError
 from django.test import TestCase
@@ -9,7 +11,12 @@ from nsync.management.commands.utils import (
     SupportedFileChecker,
     CsvSyncActionsDecoder,
     CsvSyncActionsEncoder,
-    CsvActionFactory)
+    CsvActionFactory,
+    CsvRowReader,
+    JsonLinesRowReader,
+    ColumnarRowReader,
+    RowReaderFinder,
+    pyarrow)
 
 
 class TestExternalSystemHelper(TestCase):
@@ -85,6 +92,10 @@ class TestCsvSyncActionsDecoder(TestCase):
         self.assertFalse(result.delete)
         self.assertFalse(result.force)
 
+    def test_it_shares_the_sync_actions_for_the_same_flags(self):
+        self.assertIs(CsvSyncActionsDecoder.decode('cu'),
+                      CsvSyncActionsDecoder.decode('cu'))
+
 
 class TestCsvActionFactory(TestCase):
     def setUp(self):
@@ -123,3 +134,122 @@ class TestCsvActionFactory(TestCase):
     def test_it_raises_an_error_if_the_match_field_key_is_not_in_values(self):
         with self.assertRaises(KeyError):
             self.sut.from_dict({'action_flags': ''})
+
+    def test_from_dict_accepts_typed_match_on_and_external_key(self):
+        with patch.object(self.sut, 'build') as build_method:
+            self.sut.from_dict({
+                'action_flags': 'cu',
+                'match_on': ['field1', 'field2'],
+                'external_key': 1234,
+                'field1': 1,
+                'field2': None})
+            build_method.assert_called_with(
+                ANY, ['field1', 'field2'], '1234',
+                {'field1': 1, 'field2': None})
+
+    def test_from_columns_builds_each_row(self):
+        with patch.object(self.sut, 'build') as build_method:
+            build_method.return_value = ['action']
+            result = self.sut.from_columns({
+                'action_flags': ['c', 'u*'],
+                'match_on': ['field', 'field'],
+                'external_key': ['key1', None],
+                'field': [1, 2]})
+            self.assertEqual(['action', 'action'], result)
+            self.assertEqual(2, build_method.call_count)
+            first, second = build_method.call_args_list
+            self.assertTrue(first[0][0].create)
+            self.assertEqual((['field'], 'key1', {'field': 1}),
+                             first[0][1:])
+            self.assertTrue(second[0][0].update)
+            self.assertTrue(second[0][0].force)
+            self.assertEqual((['field'], None, {'field': 2}), second[0][1:])
+
+    @patch('nsync.management.commands.utils.CsvSyncActionsDecoder')
+    def test_from_columns_decodes_flags_once_per_distinct_value(
+            self, ActionDecoder):
+        with patch.object(self.sut, 'build', return_value=[]):
+            self.sut.from_columns({
+                'action_flags': ['c', 'c', 'c'],
+                'match_on': ['field', 'field', 'field'],
+                'field': [1, 2, 3]})
+            ActionDecoder.decode.assert_called_once_with('c')
+
+    def test_actions_record_their_input_row_for_rejects(self):
+        rejects = MagicMock()
+        sut = CsvActionFactory(self.model, rejects=rejects)
+        with patch.object(sut, 'build') as build_method:
+            action = MagicMock()
+            build_method.return_value = [action]
+            sut.from_dict({
+                'action_flags': 'u',
+                'match_on': ['field1', 'field2'],
+                'field1': 1,
+                'field2': 2,
+                'reject_reason': 'From a previous rejects file'})
+            build_method.assert_called_with(
+                ANY, ['field1', 'field2'], None, {'field1': 1, 'field2': 2})
+            self.assertEqual(rejects, action.rejects)
+            self.assertEqual({'action_flags': 'u', 'match_on': 'field1 field2',
+                              'field1': 1, 'field2': 2}, action.row)
+
+
+class TestRowReaders(TestCase):
+    def test_csv_reader_produces_rows(self):
+        f = io.StringIO('action_flags,match_on,field\nc,field,value\n')
+        self.assertEqual([{'action_flags': 'c', 'match_on': 'field',
+                           'field': 'value'}],
+                         list(CsvRowReader(f).rows()))
+
+    def test_json_lines_reader_produces_typed_rows_and_skips_blanks(self):
+        f = io.StringIO(
+            '{"action_flags": "c", "match_on": "field", "field": 1}\n'
+            '\n'
+            '{"action_flags": "u", "match_on": "field", "field": null}\n')
+        self.assertEqual([
+            {'action_flags': 'c', 'match_on': 'field', 'field': 1},
+            {'action_flags': 'u', 'match_on': 'field', 'field': None}],
+            list(JsonLinesRowReader(f).rows()))
+
+    def test_reader_passes_rows_to_the_factory(self):
+        f = io.StringIO('{"action_flags": "c", "match_on": "field"}\n')
+        factory = MagicMock()
+        factory.from_dict.return_value = ['action']
+        self.assertEqual(['action'],
+                         list(JsonLinesRowReader(f).actions(factory)))
+
+    def test_finder_uses_the_file_extension(self):
+        self.assertEqual('csv', RowReaderFinder.find_format('a.csv'))
+        self.assertEqual('jsonl', RowReaderFinder.find_format('a.jsonl'))
+        self.assertEqual('jsonl', RowReaderFinder.find_format('a.ndjson'))
+        self.assertEqual('parquet', RowReaderFinder.find_format('a.parquet'))
+        self.assertEqual('arrow', RowReaderFinder.find_format('a.feather'))
+        self.assertEqual('csv', RowReaderFinder.find_format('a.txt'))
+
+    def test_finder_prefers_the_requested_format(self):
+        self.assertEqual('jsonl', RowReaderFinder.find_format('a.csv',
+                                                              'jsonl'))
+
+    def test_finder_raises_error_for_unknown_format(self):
+        with self.assertRaises(CommandError):
+            RowReaderFinder.find_format('a.csv', 'xml')
+
+    @skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_columnar_reader_passes_batches_to_the_factory(self):
+        import pyarrow.parquet
+        table = pyarrow.table({'action_flags': ['c', 'u'],
+                               'match_on': ['field', 'field'],
+                               'field': [1, 2]})
+        f = io.BytesIO()
+        pyarrow.parquet.write_table(table, f)
+        f.seek(0)
+        factory = MagicMock()
+        factory.from_columns.return_value = ['action']
+
+        result = list(ColumnarRowReader(f).actions(factory))
+
+        self.assertEqual(['action'], result)
+        factory.from_columns.assert_called_once_with({
+            'action_flags': ['c', 'u'],
+            'match_on': ['field', 'field'],
+            'field': [1, 2]})
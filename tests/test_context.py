@@ -0,0 +1,21 @@
+from django.test import TestCase
+from nsync.context import RunContext
+from nsync.models import ExternalSystem
+
+from tests.models import TestHouse
+
+
+class TestRunContext(TestCase):
+    def setUp(self):
+        self.context = RunContext()
+
+    def test_it_finds_each_external_system_once(self):
+        external_system = self.context.external_system('TestSystem')
+        with self.assertNumQueries(0):
+            self.assertIs(external_system,
+                          self.context.external_system('TestSystem'))
+        self.assertEqual(1, ExternalSystem.objects.count())
+
+    def test_it_finds_each_model_once(self):
+        self.assertIs(TestHouse, self.context.model('tests', 'TestHouse'))
+        self.assertIn(('tests', 'TestHouse'), self.context.models)
@@ -0,0 +1,143 @@
+import os
+import shutil
+import tempfile
+
+from django.core.management import call_command
+from django.test import TestCase
+from nsync.delta import DeltaFilter
+from nsync.management.commands.utils import CsvActionFactory
+from nsync.models import ExternalKeyMapping, ExternalSystem
+
+from tests.models import TestHouse
+
+
+class DeltaTestMixin:
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.external_system = ExternalSystem.objects.create(name='System')
+
+
+class TestDeltaFilter(DeltaTestMixin, TestCase):
+    def setUp(self):
+        super(TestDeltaFilter, self).setUp()
+        self.factory = CsvActionFactory(TestHouse, self.external_system)
+
+    def row(self, external_key, address, country=''):
+        return {'external_key': external_key, 'action_flags': 'cu',
+                'match_on': 'address', 'address': address,
+                'country': country}
+
+    def run_delta(self, rows, commit=True, **kwargs):
+        sut = DeltaFilter.for_factory(self.directory, self.factory, **kwargs)
+        sut.add_all(dict(row) for row in rows)
+        result = list(sut.rows())
+        if commit:
+            sut.commit()
+        else:
+            sut.discard()
+        return result
+
+    def test_all_rows_are_passed_on_the_first_run(self):
+        rows = [self.row('Key2', 'House2'), self.row('Key1', 'House1')]
+        self.assertEqual(rows, self.run_delta(rows))
+        self.assertTrue(os.path.exists(os.path.join(
+            self.directory, 'System_tests.TestHouse.jsonl')))
+
+    def test_the_digest_of_a_factory_without_a_system_is_named_by_model(self):
+        self.factory = CsvActionFactory(TestHouse)
+        rows = [self.row('', 'House1')]
+        self.assertEqual(rows, self.run_delta(rows))
+        self.assertTrue(os.path.exists(os.path.join(
+            self.directory, 'tests.TestHouse.jsonl')))
+
+    def test_only_the_new_changed_and_disappeared_rows_are_passed_on(self):
+        self.run_delta([self.row('Key1', 'House1'),
+                        self.row('Key2', 'House2'),
+                        self.row('Key3', 'House3')])
+
+        result = self.run_delta([self.row('Key4', 'House4'),
+                                 self.row('Key1', 'House1'),
+                                 self.row('Key3', 'House3', 'Australia')])
+
+        self.assertEqual([
+            self.row('Key4', 'House4'),
+            self.row('Key3', 'House3', 'Australia'),
+            {'external_key': 'Key2', 'action_flags': 'd',
+             'match_on': 'address', 'address': 'House2'}], result)
+
+    def test_rows_without_external_keys_are_keyed_by_match_values(self):
+        self.run_delta([self.row('', 'House1'), self.row('', 'House2')])
+        result = self.run_delta([self.row('', 'House1', 'Australia'),
+                                 self.row('', 'House2')])
+        self.assertEqual([self.row('', 'House1', 'Australia')], result)
+
+    def test_it_produces_the_same_result_when_spilling_to_disk(self):
+        first = [self.row('Key{}'.format(i), 'House{}'.format(i))
+                 for i in range(0, 30, 2)]
+        second = [self.row('Key{}'.format(i), 'House{}'.format(i), 'X')
+                  for i in range(0, 30, 3)]
+        self.run_delta(first)
+        in_memory = self.run_delta(second, commit=False)
+        spilled = self.run_delta(second, max_in_memory=4)
+        self.assertEqual(in_memory, spilled)
+
+    def test_the_previous_digest_is_kept_if_discarded(self):
+        self.run_delta([self.row('Key1', 'House1')])
+        self.run_delta([self.row('Key1', 'House1', 'X')], commit=False)
+        self.assertEqual([self.row('Key1', 'House1', 'X')],
+                         self.run_delta([self.row('Key1', 'House1', 'X')]))
+
+    def test_the_rejected_keys_keep_their_previous_digest(self):
+        self.run_delta([self.row('Key1', 'House1'),
+                        self.row('Key2', 'House2'),
+                        self.row('Key3', 'House3')])
+
+        sut = DeltaFilter.for_factory(self.directory, self.factory)
+        sut.add_all([self.row('Key1', 'House1', 'X'),
+                     self.row('Key2', 'House2', 'X')])
+        for row in sut.rows():
+            if row['external_key'] != 'Key2':
+                action = self.factory.from_dict(dict(row))[0]
+                action.rejects.write(action.row, 'Failed')
+        sut.commit()
+
+        self.assertEqual([
+            self.row('Key1', 'House1', 'X'),
+            {'external_key': 'Key3', 'action_flags': 'd',
+             'match_on': 'address', 'address': 'House3'}],
+            self.run_delta([self.row('Key1', 'House1', 'X'),
+                            self.row('Key2', 'House2', 'X')]))
+
+
+class TestDeltaCommands(DeltaTestMixin, TestCase):
+    def sync(self, lines):
+        csv_file_obj = tempfile.NamedTemporaryFile(mode='w')
+        csv_file_obj.writelines(
+            ['external_key,action_flags,match_on,address,country\n'] + lines)
+        csv_file_obj.seek(0)
+        call_command('syncfile', 'System', 'tests', 'TestHouse',
+                     csv_file_obj.name, delta_state=self.directory)
+
+    def test_syncfile_only_syncs_the_delta(self):
+        self.sync(['Key1,cu*,address,House1,Belgium\n',
+                   'Key2,cu*,address,House2,Belgium\n'])
+        self.assertEqual(2, TestHouse.objects.count())
+
+        # Unchanged rows are not synchronised
+        TestHouse.objects.filter(address='House1').update(country='Edited')
+
+        self.sync(['Key1,cu*,address,House1,Belgium\n'])
+
+        self.assertEqual(['House1'], list(
+            TestHouse.objects.values_list('address', flat=True)))
+        self.assertEqual('Edited', TestHouse.objects.get().country)
+        self.assertEqual(1, ExternalKeyMapping.objects.count())
+
+    def test_syncfile_syncs_the_rejected_rows_again(self):
+        self.sync(['Key1,u*,address,House1,Belgium\n'])
+        TestHouse.objects.create(address='House1')
+
+        self.sync(['Key1,u*,address,House1,Belgium\n'])
+
+        self.assertEqual('Belgium', TestHouse.objects.get().country)
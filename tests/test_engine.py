@@ -0,0 +1,125 @@
+import logging
+import tempfile
+from unittest.mock import MagicMock
+
+from django.test import TestCase
+from nsync.engine import SyncEngine
+from nsync.logging import WarningCounter
+from nsync.models import ExternalKeyMapping, ExternalSystem
+
+from tests.models import TestHouse, TestPerson
+from tests.test_utils import MockLoggingHandler
+
+
+class TestSyncEngine(TestCase):
+    def test_it_synchronises_the_rows(self):
+        TestHouse.objects.create(address='House1')
+        engine = SyncEngine(TestHouse, 'TestSystem')
+
+        count = engine.sync_rows([
+            {'action_flags': 'u*', 'match_on': 'address',
+             'address': 'House1', 'country': 'Australia'},
+            {'external_key': 'House2Key', 'action_flags': 'c',
+             'match_on': 'address', 'address': 'House2'},
+        ])
+
+        self.assertEqual(2, count)
+        self.assertEqual('Australia',
+                         TestHouse.objects.get(address='House1').country)
+        self.assertEqual(1, ExternalKeyMapping.objects.count())
+        self.assertTrue(ExternalSystem.objects.filter(
+            name='TestSystem').exists())
+
+    def test_it_reuses_the_factories_between_calls(self):
+        engine = SyncEngine(TestHouse, 'TestSystem')
+        engine.sync_rows([{'action_flags': 'c', 'match_on': 'address',
+                           'address': 'House1'}])
+        factory = engine.factory()
+        engine.sync_rows([{'action_flags': 'c', 'match_on': 'address',
+                           'address': 'House2'}])
+
+        self.assertIs(factory, engine.factory())
+        self.assertEqual(1, len(engine.factories))
+        self.assertEqual(2, TestHouse.objects.count())
+
+    def test_it_keeps_one_factory_per_target_for_the_rejects(self):
+        engine = SyncEngine(TestHouse, 'TestSystem')
+        (first, second) = (MagicMock(), MagicMock())
+        engine.add_rows([{'action_flags': 'c', 'match_on': 'address',
+                          'address': 'House1'}], rejects=first)
+        engine.add_rows([{'action_flags': 'c', 'match_on': 'address',
+                          'address': 'House2'}], rejects=second)
+
+        self.assertEqual(1, len(engine.factories))
+        self.assertEqual([first, second],
+                         [action.rejects for action in engine.actions])
+
+    def test_each_run_logs_the_first_examples_of_its_warnings(self):
+        handler = MockLoggingHandler(level='DEBUG')
+        logger = logging.getLogger('nsync.actions')
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        engine = SyncEngine(TestHouse, 'TestSystem')
+        rows = [{'action_flags': 'cu', 'match_on': 'address',
+                 'address': 'House{}'.format(i),
+                 'owner=>first_name': 'Nobody'}
+                for i in range(WarningCounter.example_limit + 5)]
+
+        engine.sync_rows(rows)
+        first_run = len(handler.messages['warning'])
+        engine.sync_rows(rows)
+
+        # The examples, and the summary of the rest
+        self.assertEqual(WarningCounter.example_limit + 1, first_run)
+        self.assertEqual(2 * first_run, len(handler.messages['warning']))
+
+    def test_it_does_not_modify_the_rows(self):
+        row = {'action_flags': 'c', 'match_on': 'address',
+               'address': 'House1'}
+        SyncEngine(TestHouse).sync_rows([row])
+        self.assertIn('action_flags', row)
+
+    def test_it_synchronises_the_rows_for_other_targets(self):
+        engine = SyncEngine(ordered=True)
+        engine.add_rows([{'action_flags': 'c', 'match_on': 'address',
+                          'address': 'House1'}], TestHouse)
+        engine.add_rows([{'action_flags': 'c', 'match_on': 'first_name',
+                          'first_name': 'Jill', 'last_name': 'Jones'}],
+                        TestPerson)
+        self.assertEqual(2, engine.execute())
+        self.assertEqual(1, TestHouse.objects.count())
+        self.assertEqual(1, TestPerson.objects.count())
+
+    def test_execute_forgets_the_executed_rows(self):
+        engine = SyncEngine(TestHouse)
+        engine.add_rows([{'action_flags': 'c', 'match_on': 'address',
+                          'address': 'House1'}])
+        engine.execute()
+        self.assertEqual(0, engine.execute())
+
+    def test_it_only_synchronises_the_changes_of_a_delta(self):
+        with tempfile.TemporaryDirectory() as state:
+            engine = SyncEngine(TestHouse, 'TestSystem', delta_state=state)
+            row = {'external_key': 'House1Key', 'action_flags': 'cu*',
+                   'match_on': 'address', 'address': 'House1'}
+            self.assertEqual(2, engine.sync_rows([row]))
+            self.assertEqual(0, engine.sync_rows([row]))
+
+    def test_it_profiles_the_phases(self):
+        profiler = MagicMock()
+        SyncEngine(TestHouse, profiler=profiler).sync_rows([])
+        self.assertEqual(['building the actions', 'executing the actions'],
+                         [c[0][0] for c in profiler.phase.call_args_list])
+
+    def test_a_snapshot_cannot_be_a_delta(self):
+        with self.assertRaises(ValueError):
+            SyncEngine(TestHouse, snapshot=True, delta_state='state')
+
+    def test_conflicting_policies_cannot_be_combined(self):
+        with self.assertRaises(ValueError):
+            SyncEngine(TestHouse, partitions=2, concurrent=True)
+        with self.assertRaises(ValueError):
+            SyncEngine(TestHouse, partitions=2, merge_join=True)
+        with self.assertRaises(ValueError):
+            SyncEngine(TestHouse, concurrent=True, merge_join=True)
+        SyncEngine(TestHouse, partitions=2, ordered=True)
@@ -0,0 +1,64 @@
+import logging
+from unittest.mock import MagicMock
+
+from django.test import TestCase
+from nsync.logging import StyleAdapter, WarningCounter, current_counter
+
+from tests.test_utils import MockLoggingHandler
+
+
+class TestStyleAdapter(TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger('tests.test_logging')
+        self.handler = MockLoggingHandler(level='DEBUG')
+        self.logger.addHandler(self.handler)
+        self.addCleanup(self.logger.removeHandler, self.handler)
+        self.sut = StyleAdapter(self.logger)
+        self.counter = WarningCounter()
+
+    def test_it_does_not_format_disabled_messages(self):
+        self.logger.setLevel(logging.INFO)
+        self.addCleanup(self.logger.setLevel, logging.NOTSET)
+        obj = MagicMock()
+        self.sut.debug('{}', obj)
+        obj.__str__.assert_not_called()
+
+    def test_it_only_logs_the_first_examples_of_each_warning(self):
+        with self.counter.counting():
+            for i in range(WarningCounter.example_limit + 5):
+                self.sut.warning('Could not find {}', i)
+            self.sut.warning('Something else {}', 1)
+
+        self.assertEqual(WarningCounter.example_limit + 1,
+                         len(self.handler.messages['warning']))
+        self.assertEqual('Could not find 0',
+                         self.handler.messages['warning'][0])
+        self.assertEqual('Something else 1',
+                         self.handler.messages['warning'][-1])
+
+    def test_it_logs_every_warning_when_not_counting(self):
+        with self.counter.counting():
+            pass
+        for i in range(WarningCounter.example_limit + 5):
+            self.sut.warning('Could not find {}', i)
+
+        self.assertIsNone(current_counter())
+        self.assertEqual(WarningCounter.example_limit + 5,
+                         len(self.handler.messages['warning']))
+        self.assertEqual({}, dict(self.counter.summarise()))
+
+    def test_summarise_reports_and_resets_the_counts(self):
+        with self.counter.counting():
+            for i in range(WarningCounter.example_limit + 5):
+                self.sut.warning('Could not find {}', i)
+        self.handler.reset()
+
+        counts = self.counter.summarise()
+
+        self.assertEqual(
+            {('tests.test_logging', 'Could not find {}'):
+                WarningCounter.example_limit + 5}, dict(counts))
+        self.assertEqual(1, len(self.handler.messages['warning']))
+        self.assertIn('15 warnings like "Could not find {}"',
+                      self.handler.messages['warning'][0])
+        self.assertEqual({}, dict(self.counter.summarise()))
@@ -1,8 +1,13 @@
+from unittest.mock import patch
+
 from django.contrib.contenttypes.fields import ContentType
 from django.test import TestCase
-from nsync.models import ExternalSystem, ExternalKeyMapping
+from nsync.models import (
+    ExternalSystem,
+    ExternalKeyMapping,
+    ExternalKeyMappingManager)
 
-from tests.models import TestPerson
+from tests.models import TestHouse, TestPerson
 
 
 class TestExternalSystem(TestCase):
@@ -36,3 +41,51 @@ class TestExternalKeyMapping(TestCase):
         self.assertIn('Person123', result)
         self.assertIn(content_type.model_class().__name__, result)
         self.assertIn(str(john.id), result)
+
+
+class TestExternalKeyMappingManager(TestCase):
+    def setUp(self):
+        self.external_system = ExternalSystem.objects.create(name='CRM')
+        self.people = [TestPerson.objects.create(first_name=str(i))
+                       for i in range(3)]
+        self.house = TestHouse.objects.create(address='House1')
+        for i, person in enumerate(self.people):
+            self.map(person, 'P{}'.format(i))
+        self.map(self.house, 'H0')
+
+    def map(self, obj, key, external_system=None):
+        ExternalKeyMapping.objects.create(
+            external_system=external_system or self.external_system,
+            external_key=key,
+            content_type=ContentType.objects.get_for_model(obj),
+            object_id=obj.pk)
+
+    def test_resolve_many_finds_the_objects_of_the_keys(self):
+        with self.assertNumQueries(3):
+            resolved = ExternalKeyMapping.objects.resolve_many(
+                self.external_system, ['P0', 'P2', 'H0', 'Unknown'])
+        self.assertEqual({'P0': self.people[0], 'P2': self.people[2],
+                          'H0': self.house}, resolved)
+
+    def test_resolve_many_can_be_limited_to_a_model(self):
+        resolved = ExternalKeyMapping.objects.resolve_many(
+            'CRM', ['P1', 'H0'], model=TestHouse)
+        self.assertEqual({'H0': self.house}, resolved)
+
+    def test_resolve_many_only_resolves_the_keys_of_the_system(self):
+        other = ExternalSystem.objects.create(name='ERP')
+        self.map(self.house, 'E0', other)
+        self.assertEqual({}, ExternalKeyMapping.objects.resolve_many(
+            self.external_system, ['E0']))
+
+    def test_resolve_many_ignores_mappings_to_deleted_objects(self):
+        self.people[1].delete()
+        self.assertEqual({}, ExternalKeyMapping.objects.resolve_many(
+            self.external_system, ['P1']))
+
+    @patch.object(ExternalKeyMappingManager, 'resolve_batch_size', 2)
+    def test_resolve_many_finds_the_mappings_in_batches(self):
+        with self.assertNumQueries(3):
+            resolved = ExternalKeyMapping.objects.resolve_many(
+                self.external_system, ['P0', 'P1', 'P2', 'P0'])
+        self.assertEqual(['P0', 'P1', 'P2'], sorted(resolved))
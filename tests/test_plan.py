@@ -0,0 +1,216 @@
+import io
+import json
+import os
+import tempfile
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from nsync.management.commands.utils import CsvActionFactory
+from nsync.models import ExternalKeyMapping, ExternalSystem
+from nsync.plan import PlanRowReader, PlanWriter, compile_plan
+
+from tests.models import TestHouse, TestPerson
+
+
+class TestPlanWriter(TestCase):
+    def setUp(self):
+        self.factory = CsvActionFactory(TestHouse,
+                                        ExternalSystem(name='TestSystem'))
+
+    def compile(self, rows, chunk_size=None):
+        f = io.BytesIO()
+        writer = PlanWriter(f, self.factory, chunk_size=chunk_size)
+        writer.add_all(rows)
+        writer.close()
+        f.seek(0)
+        return writer, PlanRowReader(f)
+
+    def test_it_round_trips_the_typed_columns(self):
+        rows = [
+            {'action_flags': 'C', 'match_on': 'address',
+             'external_key': 1, 'address': 'House1', 'floors': 2,
+             'country': None},
+            {'action_flags': 'cu*', 'match_on': ['address', 'country'],
+             'external_key': 'K2', 'address': 'Hoüse2', 'floors': None,
+             'country': 'Australia'},
+        ]
+        (writer, reader) = self.compile(rows)
+
+        self.assertEqual([], writer.errors)
+        self.assertEqual([
+            {'action_flags': 'c', 'match_on': ('address',),
+             'external_key': 1, 'address': 'House1', 'floors': 2,
+             'country': None},
+            {'action_flags': 'cu*', 'match_on': ('address', 'country'),
+             'external_key': 'K2', 'address': 'Hoüse2', 'floors': None,
+             'country': 'Australia'},
+        ], list(reader.rows()))
+        self.assertEqual(2, reader.rows_read)
+
+    def test_it_keeps_the_types_of_equal_values(self):
+        values = [1, True, 1.0, '1', None] * 4
+        (writer, reader) = self.compile(
+            [{'action_flags': 'c', 'match_on': 'address', 'address': value}
+             for value in values])
+
+        read = [row['address'] for row in reader.rows()]
+        self.assertEqual(values, read)
+        self.assertEqual([type(value) for value in values],
+                         [type(value) for value in read])
+
+    def test_it_dictionary_encodes_the_repeated_values(self):
+        (writer, reader) = self.compile(
+            [{'action_flags': 'c', 'match_on': 'address',
+              'address': 'House{}'.format(i), 'country': 'Australia'}
+             for i in range(100)])
+
+        columns = dict((column['name'], column)
+                       for column in reader.footer['chunks'][0]['columns'])
+        self.assertEqual('dict', columns['country']['type'])
+        self.assertEqual(['Australia'],
+                         reader.dictionary(columns['country']))
+        self.assertEqual('str', columns['address']['type'])
+
+    def test_the_footer_does_not_hold_the_values(self):
+        (writer, reader) = self.compile(
+            [{'action_flags': 'c', 'match_on': 'address',
+              'address': 'House{}'.format(i % 50)} for i in range(1000)])
+
+        columns = dict((column['name'], column)
+                       for column in reader.footer['chunks'][0]['columns'])
+        self.assertEqual('dict', columns['address']['type'])
+        self.assertNotIn('House1', json.dumps(reader.footer))
+        self.assertEqual(50, len(set(row['address']
+                                     for row in reader.rows())))
+
+    def test_it_splits_the_rows_into_chunks(self):
+        (writer, reader) = self.compile(
+            [{'action_flags': 'c', 'match_on': 'address',
+              'address': 'House{}'.format(i)} for i in range(5)]
+            + [{'action_flags': 'c', 'match_on': 'address', 'floors': 1,
+                'address': 'House5'}],
+            chunk_size=2)
+
+        self.assertEqual([2, 2, 1, 1], [chunk['rows'] for chunk in
+                                        reader.footer['chunks']])
+        self.assertEqual(['House{}'.format(i) for i in range(6)],
+                         [row['address'] for row in reader.rows()])
+
+    def test_it_records_the_invalid_rows(self):
+        (writer, reader) = self.compile([
+            {'action_flags': 'cd', 'match_on': 'address', 'address': 'A'},
+            {'action_flags': 'c', 'match_on': 'country', 'address': 'B'},
+            {'action_flags': 'c', 'match_on': 'address', 'address': 'C'},
+        ])
+
+        self.assertEqual([1, 2], [row for (row, error) in writer.errors])
+        self.assertEqual(1, reader.footer['rows'])
+
+    def test_it_resolves_the_columns_to_the_fields(self):
+        (writer, reader) = self.compile([
+            {'action_flags': 'c', 'match_on': 'address', 'address': 'A',
+             'owner=>first_name': 'Jill', 'colour': 'red'}])
+
+        self.assertEqual({'address': 'address', 'owner=>first_name': 'owner',
+                          'colour': None}, reader.footer['fields'])
+        self.assertEqual(['colour'], writer.unknown_columns)
+
+    def test_check_raises_an_error_if_the_model_differs(self):
+        (writer, reader) = self.compile([
+            {'action_flags': 'c', 'match_on': 'address', 'address': 'A'}])
+
+        reader.check(TestHouse, 'TestSystem')
+        with self.assertRaises(ValueError):
+            reader.check(TestPerson, 'TestSystem')
+        with self.assertRaises(ValueError):
+            reader.check(TestHouse, 'OtherSystem')
+
+    def test_close_releases_the_memory_map(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'houses.nsplan')
+        compile_plan([{'action_flags': 'c', 'match_on': 'address',
+                       'address': 'A'}], path, self.factory)
+
+        with open(path, 'rb') as f:
+            reader = PlanRowReader(f)
+            self.assertEqual(1, len(list(reader.rows())))
+            reader.close()
+            self.assertTrue(reader.buffer.closed)
+
+    def test_it_raises_an_error_for_other_files(self):
+        with self.assertRaises(ValueError):
+            PlanRowReader(io.BytesIO(b'action_flags,match_on\n'))
+        with self.assertRaises(ValueError):
+            PlanRowReader(io.BytesIO(b''))
+
+    def test_it_raises_an_error_for_an_incomplete_plan(self):
+        f = io.BytesIO()
+        writer = PlanWriter(f, self.factory)
+        writer.add({'action_flags': 'c', 'match_on': 'address',
+                    'address': 'A'})
+        f.seek(0)
+        with self.assertRaises(ValueError):
+            PlanRowReader(f)
+
+
+class TestCompileCommand(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.plan = os.path.join(self.directory.name, 'houses.nsplan')
+
+    def write(self, lines):
+        path = os.path.join(self.directory.name, 'houses.csv')
+        with open(path, 'w') as f:
+            f.writelines(lines)
+        return path
+
+    def test_the_compiled_plan_is_synchronised_by_syncfile(self):
+        TestHouse.objects.create(address='House2', country='Belgium')
+        path = self.write([
+            'action_flags,match_on,external_key,address,country\n',
+            'c,address,1,House1,Australia\n',
+            'u*,address,2,House2,Australia\n',
+        ])
+
+        call_command('nsync_compile', 'TestSystem', 'tests', 'TestHouse',
+                     path, self.plan, stdout=io.StringIO())
+        os.remove(path)
+        self.assertFalse(ExternalSystem.objects.exists())
+
+        call_command('syncfile', 'TestSystem', 'tests', 'TestHouse',
+                     self.plan, plan=True)
+
+        self.assertEqual(['Australia', 'Australia'], list(
+            TestHouse.objects.order_by('address').values_list(
+                'country', flat=True)))
+        self.assertEqual(['1', '2'], list(
+            ExternalKeyMapping.objects.order_by('external_key').values_list(
+                'external_key', flat=True)))
+
+    def test_it_does_not_write_a_plan_for_invalid_rows(self):
+        path = self.write([
+            'action_flags,match_on,address\n',
+            'cd,address,House1\n',
+        ])
+
+        with self.assertRaises(CommandError):
+            call_command('nsync_compile', 'TestSystem', 'tests', 'TestHouse',
+                         path, self.plan, stderr=io.StringIO())
+        self.assertFalse(os.path.exists(self.plan))
+        self.assertEqual(['houses.csv'], os.listdir(self.directory.name))
+
+    def test_syncfile_raises_an_error_if_the_plan_is_for_another_model(self):
+        path = self.write([
+            'action_flags,match_on,address\n',
+            'c,address,House1\n',
+        ])
+        call_command('nsync_compile', 'TestSystem', 'tests', 'TestHouse',
+                     path, self.plan, stdout=io.StringIO())
+
+        with self.assertRaises(CommandError):
+            call_command('syncfile', 'TestSystem', 'tests', 'TestPerson',
+                         self.plan, plan=True)
+        self.assertFalse(TestHouse.objects.exists())
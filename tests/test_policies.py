@@ -1,7 +1,31 @@
-from unittest.mock import MagicMock, call
+import os
+import shutil
+import tempfile
+from unittest.mock import ANY, MagicMock, call, patch
 
-from django.test import TestCase
-from nsync.policies import BasicSyncPolicy, OrderedSyncPolicy
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.db import IntegrityError, connection, connections
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from nsync.actions import (
+    ActionFactory,
+    CreateModelAction,
+    DeleteModelAction,
+    UpdateModelAction)
+from nsync.management.commands.utils import CsvSyncActionsDecoder
+from nsync.models import ExternalKeyMapping, ExternalSystem
+from nsync.policies import (
+    BasicSyncPolicy,
+    ChangeFeedSyncPolicy,
+    ConcurrentSyncPolicy,
+    MergeJoinSyncPolicy,
+    OrderedSyncPolicy,
+    PartitionedSyncPolicy,
+    execute_actions)
+from nsync.signals import ChangeFeed
+
+from tests.models import TestHouse, TestProduct, TestTag
 
 
 class TestBasicSyncPolicy(TestCase):
@@ -37,3 +61,333 @@ class TestOrderedSyncPolicy(TestCase):
             call.create.execute(),
             call.update.execute(),
             call.delete.execute()])
+
+
+class TestPartitionedSyncPolicy(TransactionTestCase):
+    def setUp(self):
+        self.external_system = ExternalSystem.objects.create(name='System')
+        self.factory = ActionFactory(TestHouse, self.external_system)
+
+    def build(self, flags, external_key, address, match_on='address',
+              **fields):
+        fields['address'] = address
+        return self.factory.build(CsvSyncActionsDecoder.decode(flags),
+                                  match_on.split(), external_key, fields)
+
+    def test_it_raises_an_error_if_partitions_is_not_positive(self):
+        with self.assertRaises(ValueError):
+            PartitionedSyncPolicy([], partitions=0)
+
+    def test_actions_for_the_same_row_are_in_the_same_partition(self):
+        actions = []
+        for i in range(20):
+            actions.extend(self.build('cu', 'Key{}'.format(i),
+                                      'House{}'.format(i)))
+
+        partitions, serial = PartitionedSyncPolicy(
+            actions, partitions=4).partition()
+
+        self.assertEqual([], serial)
+        self.assertEqual(40, sum(len(p) for p in partitions))
+        for partition in partitions:
+            for action in partition:
+                self.assertTrue(all(
+                    a in partition for a in actions
+                    if a.external_key == action.external_key))
+
+    def test_keys_resolving_to_the_same_object_are_in_one_partition(self):
+        house = TestHouse.objects.create(address='House1')
+        ExternalKeyMapping.objects.create(
+            content_type=ContentType.objects.get_for_model(TestHouse),
+            external_system=self.external_system,
+            external_key='Key1',
+            object_id=house.id)
+
+        for i in range(10):
+            # The external key links to the object, the other row matches it
+            by_key = self.build('u*', 'Key1', 'Renamed{}'.format(i))
+            by_match = self.build('u*', 'Other{}'.format(i), 'House1')
+
+            partitions, _ = PartitionedSyncPolicy(
+                by_key + by_match, partitions=8).partition()
+
+            self.assertIn(sorted(map(id, by_key + by_match)),
+                          [sorted(map(id, p)) for p in partitions])
+
+    def test_equal_match_values_of_other_types_are_in_one_partition(self):
+        as_text = self.build('u*', None, 'Renamed', match_on='floors',
+                             floors='2')
+        as_integer = self.build('u*', None, 'Other', match_on='floors',
+                                floors=2)
+
+        partitions, _ = PartitionedSyncPolicy(
+            as_text + as_integer, partitions=8).partition()
+
+        self.assertEqual((2,),
+                         PartitionedSyncPolicy.match_key_for(as_text[0])[3])
+        self.assertIn(sorted(map(id, as_text + as_integer)),
+                      [sorted(map(id, p)) for p in partitions])
+
+    def test_actions_with_unpredictable_targets_are_executed_serially(self):
+        actions = self.build('u*', None, 'House1',
+                             match_on='address country |',
+                             country='Australia')
+        partitions, serial = PartitionedSyncPolicy(actions).partition()
+        self.assertEqual(actions, serial)
+
+    def test_it_executes_all_of_the_actions(self):
+        TestHouse.objects.create(address='House0', country='Belgium')
+        actions = []
+        for i in range(10):
+            actions.extend(self.build('cu*', 'Key{}'.format(i),
+                                      'House{}'.format(i),
+                                      country='Australia'))
+
+        # The in-memory test database cannot take concurrent writers, so this
+        # only checks the execution on the worker thread (see
+        # TestPartitionedSyncPolicyOnWal for the parallel execution)
+        PartitionedSyncPolicy(actions, partitions=1).execute()
+
+        self.assertEqual(10, TestHouse.objects.filter(
+            country='Australia').count())
+        self.assertEqual(10, ExternalKeyMapping.objects.count())
+
+    def test_it_raises_errors_from_the_partitions(self):
+        action = MagicMock()
+        action.type = 'create'
+        action.match_on = None
+        action.external_key = 'Key1'
+        action.external_system = self.external_system
+        action.execute.side_effect = ValueError('Failed')
+
+        with self.assertRaises(ValueError):
+            PartitionedSyncPolicy([action], partitions=2).execute()
+
+
+class TestPartitionedSyncPolicyOnWal(TransactionTestCase):
+    """
+    Executes the partitions in parallel on a file based SQLite database in
+    WAL mode, as the in-memory test database cannot take concurrent writers.
+    """
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.use_database(os.path.join(directory, 'wal.sqlite3'))
+        call_command('migrate', run_syncdb=True, verbosity=0)
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
+        # The ids of the content types differ from the test database's
+        ContentType.objects.clear_cache()
+        self.addCleanup(ContentType.objects.clear_cache)
+
+    def use_database(self, name):
+        """Use the database file (on every thread) for the test"""
+        original = connections['default']
+        connections.settings['default'] = dict(
+            original.settings_dict, NAME=name)
+        connections['default'] = connections.create_connection('default')
+
+        def restore():
+            connections['default'].close()
+            connections.settings['default'] = original.settings_dict
+            connections['default'] = original
+        self.addCleanup(restore)
+
+    def test_it_executes_the_partitions_in_parallel(self):
+        external_system = ExternalSystem.objects.create(name='System')
+        factory = ActionFactory(TestHouse, external_system)
+        for i in range(0, 40, 2):
+            TestHouse.objects.create(address='House{}'.format(i),
+                                     country='Belgium')
+        actions = []
+        for i in range(40):
+            actions.extend(factory.build(
+                CsvSyncActionsDecoder.decode('cu*'), ['address'],
+                'Key{}'.format(i), {'address': 'House{}'.format(i),
+                                    'country': 'Australia'}))
+
+        PartitionedSyncPolicy(actions, partitions=4).execute()
+
+        self.assertEqual(40, TestHouse.objects.count())
+        self.assertEqual(40, TestHouse.objects.filter(
+            country='Australia').count())
+        self.assertEqual(40, ExternalKeyMapping.objects.count())
+
+
+class TestExecuteActions(TestCase):
+    def test_it_batches_consecutive_actions_with_the_same_batch_key(self):
+        calls = []
+
+        class Batchable:
+            def __init__(self, batch_key):
+                self.batch_key = batch_key
+
+            @classmethod
+            def execute_batch(cls, actions):
+                calls.append([a.batch_key for a in actions])
+
+        plain = MagicMock()
+        plain.execute.side_effect = lambda: calls.append('plain')
+
+        execute_actions([Batchable(1), Batchable(1), Batchable(2), plain,
+                         Batchable(2)])
+
+        self.assertEqual([[1, 1], [2], 'plain', [2]], calls)
+
+
+class TestMergeJoinSyncPolicy(TestCase):
+    def setUp(self):
+        for i in range(5):
+            TestProduct.objects.create(code='P{}'.format(i), name='Old')
+
+    def test_it_creates_updates_and_skips_unchanged_objects(self):
+        actions = [
+            UpdateModelAction(TestProduct, ['code'],
+                              {'code': 'P3', 'name': 'New'}, True),
+            CreateModelAction(TestProduct, ['code'],
+                              {'code': 'P9', 'name': 'Nine'}),
+            CreateModelAction(TestProduct, ['code'],
+                              {'code': 'P1', 'name': 'Ignored'}),
+            UpdateModelAction(TestProduct, ['code'],
+                              {'code': 'P0', 'name': 'Old'}, True),
+            UpdateModelAction(TestProduct, ['code'],
+                              {'code': 'P7', 'name': 'Missing'}, True),
+        ]
+        policy = MergeJoinSyncPolicy(actions, chunk_size=2)
+        policy.execute()
+
+        self.assertEqual(
+            {'P0': 'Old', 'P1': 'Old', 'P2': 'Old', 'P3': 'New', 'P4': 'Old',
+             'P9': 'Nine'},
+            dict(TestProduct.objects.values_list('code', 'name')))
+        self.assertEqual({'lookup': 2, 'update': 1, 'unchanged': 2},
+                         dict(policy.counts))
+
+    def test_it_only_creates_one_object_for_repeated_keys(self):
+        actions = [
+            CreateModelAction(TestProduct, ['code'],
+                              {'code': 'P8', 'name': 'First'}),
+            CreateModelAction(TestProduct, ['code'],
+                              {'code': 'P8', 'name': 'Second'}),
+        ]
+        MergeJoinSyncPolicy(actions).execute()
+        self.assertEqual('First', TestProduct.objects.get(code='P8').name)
+
+    def test_it_finds_the_objects_of_a_case_insensitive_collation(self):
+        TestTag.objects.create(name='b')
+        TestTag.objects.create(name='C')
+        actions = [CreateModelAction(TestTag, ['name'], {'name': name})
+                   for name in ['b', 'C', 'B']]
+        MergeJoinSyncPolicy(actions).execute()
+
+        self.assertEqual(['b', 'C'], list(
+            TestTag.objects.order_by('pk').values_list('name', flat=True)))
+
+    def test_it_uses_one_query_per_page_for_the_existing_objects(self):
+        actions = [UpdateModelAction(TestProduct, ['code'],
+                                     {'code': 'P{}'.format(i), 'name': 'Old'},
+                                     True)
+                   for i in reversed(range(5))]
+        with self.assertNumQueries(3):
+            MergeJoinSyncPolicy(actions, chunk_size=2).execute()
+
+    def test_it_executes_other_actions_as_usual(self):
+        delete_action = MagicMock(spec=DeleteModelAction)
+        delete_action.type = 'delete'
+        operator_action = UpdateModelAction(
+            TestProduct, ['code', 'name', '|'],
+            {'code': 'P2', 'name': 'Changed'}, True)
+
+        MergeJoinSyncPolicy([delete_action, operator_action]).execute()
+
+        delete_action.execute.assert_called_once_with()
+        self.assertEqual('Changed', TestProduct.objects.get(code='P2').name)
+
+    def test_group_of_rejects_lookups_across_relationships(self):
+        action = UpdateModelAction(TestHouse, ['owner__first_name'],
+                                   {'owner__first_name': 'A'})
+        self.assertIsNone(MergeJoinSyncPolicy.group_of(action))
+
+
+class TestConcurrentSyncPolicy(TestCase):
+    def make_action(self, type='update'):
+        action = MagicMock(spec=['execute', 'type'])
+        action.type = type
+        return action
+
+    def test_it_executes_the_actions_in_chunks_after_locking(self):
+        house = TestHouse.objects.create(address='House1')
+        actions = [
+            UpdateModelAction(TestHouse, ['address'],
+                              {'address': 'House1', 'country': 'Australia'},
+                              True),
+            CreateModelAction(TestHouse, ['address'], {'address': 'House2'}),
+            CreateModelAction(TestHouse, ['address'], {'address': 'House3'}),
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            ConcurrentSyncPolicy(actions, chunk_size=2).execute()
+
+        house.refresh_from_db()
+        self.assertEqual('Australia', house.country)
+        self.assertEqual(3, TestHouse.objects.count())
+        lock_queries = [q['sql'] for q in queries
+                        if 'ORDER BY "tests_testhouse"."id"' in q['sql']]
+        self.assertEqual(2, len(lock_queries))
+
+    @patch('nsync.policies.time.sleep')
+    def test_it_retries_a_chunk_that_loses_a_race(self, sleep):
+        winner = self.make_action()
+        loser = self.make_action()
+        loser.execute.side_effect = [IntegrityError('duplicate'), None]
+
+        ConcurrentSyncPolicy([winner, loser]).execute()
+
+        self.assertEqual(2, winner.execute.call_count)
+        self.assertEqual(2, loser.execute.call_count)
+        sleep.assert_called_once_with(ANY)
+
+    @patch('nsync.policies.time.sleep')
+    def test_it_only_publishes_the_changes_of_the_committed_attempt(self,
+                                                                     sleep):
+        published = []
+        feed = ChangeFeed(callback=lambda model, **changes:
+                          published.append(changes))
+        create = CreateModelAction(TestHouse, ['address'],
+                                   {'address': 'House1'})
+        def lose_the_first_race():
+            # The object created by the first attempt is rolled back
+            if loser.execute.call_count == 1:
+                TestHouse.objects.create(address='Phantom')
+                raise IntegrityError('duplicate')
+
+        loser = self.make_action('create')
+        loser.execute.side_effect = lose_the_first_race
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ChangeFeedSyncPolicy(ConcurrentSyncPolicy([create, loser]),
+                                 feed).execute()
+
+        house = TestHouse.objects.get()
+        self.assertEqual([{'created': [house.pk], 'updated': [],
+                           'deleted': []}], published)
+
+    @patch('nsync.policies.time.sleep')
+    def test_it_raises_the_error_once_out_of_retries(self, sleep):
+        action = self.make_action()
+        action.execute.side_effect = IntegrityError('duplicate')
+        with self.assertRaises(IntegrityError):
+            ConcurrentSyncPolicy([action], retries=2).execute()
+        self.assertEqual(3, action.execute.call_count)
+
+    def test_create_keys_are_sorted_and_only_for_creates(self):
+        actions = [
+            CreateModelAction(TestHouse, ['address'], {'address': 'B'}),
+            CreateModelAction(TestHouse, ['address'], {'address': 'A'}),
+            CreateModelAction(TestHouse, ['address'], {'address': 'A'}),
+            UpdateModelAction(TestHouse, ['address'], {'address': 'C'}),
+        ]
+        keys = ConcurrentSyncPolicy.create_keys(actions)
+        self.assertEqual(2, len(keys))
+        self.assertEqual(sorted(keys), keys)
+        self.assertEqual(keys, ConcurrentSyncPolicy.create_keys(
+            list(reversed(actions))))
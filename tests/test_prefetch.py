@@ -0,0 +1,86 @@
+from django.contrib.contenttypes.models import ContentType
+from django.test import TestCase
+from nsync.models import ExternalKeyMapping, ExternalSystem
+from nsync.prefetch import prefetch_external_keys
+
+from tests.models import TestHouse, TestPerson, TestShop
+
+
+class TestPrefetchExternalKeys(TestCase):
+    def setUp(self):
+        self.crm = ExternalSystem.objects.create(name='CRM')
+        self.erp = ExternalSystem.objects.create(name='ERP')
+
+    def map(self, obj, external_system, external_key):
+        ExternalKeyMapping.objects.create(
+            external_system=external_system,
+            external_key=external_key,
+            content_type=ContentType.objects.get_for_model(obj),
+            object_id=obj.pk)
+
+    def test_it_attaches_the_keys_of_the_objects(self):
+        house1 = TestHouse.objects.create(address='House1')
+        house2 = TestHouse.objects.create(address='House2')
+        house3 = TestHouse.objects.create(address='House3')
+        self.map(house1, self.crm, 'C1')
+        self.map(house1, self.erp, 'E1')
+        self.map(house2, self.crm, 'C2')
+
+        with self.assertNumQueries(2):
+            houses = prefetch_external_keys(
+                TestHouse.objects.order_by('pk'))
+
+        self.assertEqual([{'CRM': 'C1', 'ERP': 'E1'}, {'CRM': 'C2'}, {}],
+                         [h.external_keys for h in houses])
+        self.assertEqual(house3, houses[2])
+
+    def test_it_only_finds_the_keys_of_the_systems(self):
+        house = TestHouse.objects.create(address='House1')
+        self.map(house, self.crm, 'C1')
+        self.map(house, self.erp, 'E1')
+
+        prefetch_external_keys([house], systems=[self.erp])
+        self.assertEqual({'ERP': 'E1'}, house.external_keys)
+        prefetch_external_keys([house], systems=['CRM'], to_attr='keys')
+        self.assertEqual({'CRM': 'C1'}, house.keys)
+
+    def test_it_does_not_mix_up_the_models(self):
+        house = TestHouse.objects.create(address='House1')
+        person = TestPerson.objects.create(first_name='Jill')
+        self.assertEqual(house.pk, person.pk)
+        self.map(house, self.crm, 'House')
+        self.map(person, self.crm, 'Person')
+
+        with self.assertNumQueries(2):
+            prefetch_external_keys([house, person], batch_size=1)
+        self.assertEqual({'CRM': 'House'}, house.external_keys)
+        self.assertEqual({'CRM': 'Person'}, person.external_keys)
+
+
+class TestExternalKeysMixin(TestCase):
+    def setUp(self):
+        self.crm = ExternalSystem.objects.create(name='CRM')
+        self.shop = TestShop.objects.create(name='Shop1')
+        ExternalKeyMapping.objects.create(
+            external_system=self.crm,
+            external_key='S1',
+            content_type=ContentType.objects.get_for_model(TestShop),
+            content_object=self.shop)
+
+    def test_it_provides_the_external_keys(self):
+        shop = TestShop.objects.get()
+        self.assertEqual({'CRM': 'S1'}, shop.external_keys)
+
+    def test_the_keys_can_be_prefetched(self):
+        with self.assertNumQueries(3):
+            shops = list(TestShop.objects.prefetch_related(
+                'external_key_mappings__external_system'))
+            self.assertEqual({'CRM': 'S1'}, shops[0].external_keys)
+
+        with self.assertNumQueries(2):
+            shops = prefetch_external_keys(TestShop.objects.all())
+        self.assertEqual({'CRM': 'S1'}, shops[0].external_keys)
+
+    def test_the_mappings_can_be_queried_from_the_model(self):
+        self.assertEqual(self.shop, TestShop.objects.get(
+            external_key_mappings__external_key='S1'))
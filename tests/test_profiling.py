@@ -0,0 +1,48 @@
+import io
+import os
+import pstats
+import tempfile
+
+from django.core.management import call_command
+from django.test import TestCase
+from nsync.profiling import Profiler
+
+
+class TestProfiler(TestCase):
+    def setUp(self):
+        self.csv_file_obj = tempfile.NamedTemporaryFile(mode='w')
+        self.csv_file_obj.writelines([
+            'action_flags,match_on,address\n',
+            'c,address,House1\n',
+            'c,address,House2\n',
+        ])
+        self.csv_file_obj.seek(0)
+
+    def test_it_raises_an_error_for_an_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            Profiler('disk')
+
+    def test_cpu_mode_writes_a_pstats_file(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'run.pstats')
+        stderr = io.StringIO()
+
+        call_command('syncfile', 'TestSystem', 'tests', 'TestHouse',
+                     self.csv_file_obj.name, profile='cpu',
+                     profile_file=path, stderr=stderr)
+
+        stats = pstats.Stats(path)
+        self.assertTrue(any(function == 'execute_actions' for
+                            (_, _, function) in stats.stats))
+        self.assertIn('CPU profile written to', stderr.getvalue())
+
+    def test_memory_mode_reports_each_phase(self):
+        stderr = io.StringIO()
+
+        call_command('syncfile', 'TestSystem', 'tests', 'TestHouse',
+                     self.csv_file_obj.name, profile='memory',
+                     stderr=stderr)
+
+        report = stderr.getvalue()
+        self.assertIn('Memory after building the actions', report)
+        self.assertIn('Memory after executing the actions', report)
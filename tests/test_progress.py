@@ -0,0 +1,63 @@
+import io
+import json
+import tempfile
+from unittest.mock import MagicMock
+
+from django.core.management import call_command
+from django.test import TestCase
+from nsync.management.commands.utils import CsvRowReader
+from nsync.policies import BasicSyncPolicy
+from nsync.progress import ProgressReporter
+
+
+class TestProgressReporter(TestCase):
+    def test_it_reports_the_rows_read_and_bytes_consumed(self):
+        csv_file_obj = tempfile.NamedTemporaryFile(mode='w+')
+        csv_file_obj.writelines(['action_flags,match_on,field\n',
+                                 'c,field,1\n', 'c,field,2\n'])
+        csv_file_obj.seek(0)
+        reader = CsvRowReader(csv_file_obj)
+        sut = ProgressReporter(stream=io.StringIO())
+        sut.watch(reader, csv_file_obj)
+
+        rows = list(reader.rows())
+        status = sut.status()
+
+        self.assertEqual(2, len(rows))
+        self.assertEqual(2, status['rows_read'])
+        self.assertEqual(status['bytes_total'], status['bytes_read'])
+        self.assertIsNone(status['actions_total'])
+
+    def test_it_counts_the_actions_executed_by_the_policy(self):
+        actions = [MagicMock(type='create'), MagicMock(type='create'),
+                   MagicMock(type='delete')]
+        policy = BasicSyncPolicy(actions)
+        sut = ProgressReporter(stream=io.StringIO())
+        sut.observe(policy)
+
+        policy.execute()
+        status = sut.status()
+
+        self.assertEqual(3, status['actions_total'])
+        self.assertEqual(3, status['actions_executed'])
+        self.assertEqual({'create': 2, 'delete': 1},
+                         status['actions_executed_by_type'])
+        self.assertIn('Executed 3 of 3 actions (create:2, delete:1)',
+                      sut.format(status))
+
+    def test_the_command_writes_the_final_status_file(self):
+        csv_file_obj = tempfile.NamedTemporaryFile(mode='w')
+        csv_file_obj.writelines([
+            'action_flags,match_on,address\n',
+            'c,address,House1\n',
+            'c,address,House2\n',
+        ])
+        csv_file_obj.seek(0)
+        status_file_obj = tempfile.NamedTemporaryFile(mode='r')
+
+        call_command('syncfile', 'TestSystem', 'tests', 'TestHouse',
+                     csv_file_obj.name, progress_file=status_file_obj.name)
+
+        status = json.load(open(status_file_obj.name))
+        self.assertEqual(2, status['rows_read'])
+        self.assertEqual({'create': 2}, status['actions_executed_by_type'])
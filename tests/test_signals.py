@@ -0,0 +1,209 @@
+import json
+import tempfile
+import threading
+from array import array
+from unittest.mock import MagicMock
+
+from django.core.management import call_command
+from django.db.models.signals import post_save
+from django.test import TestCase, TransactionTestCase
+from nsync.management.commands.utils import CsvActionFactory
+from nsync.policies import (
+    BasicSyncPolicy,
+    BatchedSignalsSyncPolicy,
+    ChangeFeedSyncPolicy)
+from nsync.signals import (
+    ChangeFeed,
+    ChangeSet,
+    PkSet,
+    chunk_synced,
+    current_changes)
+
+from tests.models import TestHouse, TestProduct
+
+
+class TestChangeSet(TestCase):
+    def setUp(self):
+        self.receiver = MagicMock()
+        post_save.connect(self.receiver, sender=TestHouse)
+        self.addCleanup(post_save.disconnect, self.receiver,
+                        sender=TestHouse)
+
+    def test_it_records_and_mutes_the_signals_of_this_thread(self):
+        changes = ChangeSet(mute=True)
+        with changes.recording():
+            house = TestHouse.objects.create(address='House1')
+            house.floors = 2
+            house.save()
+            other = TestHouse.objects.create(address='House2')
+            other_pk = other.pk
+            other.delete()
+
+        self.receiver.assert_not_called()
+        self.assertIsNone(current_changes())
+        self.assertEqual(
+            {TestHouse: {'created': [house.pk], 'updated': [],
+                         'deleted': [other_pk]}},
+            changes.models())
+
+    def test_it_does_not_affect_other_threads(self):
+        changes = ChangeSet(mute=True)
+        with changes.recording():
+            thread = threading.Thread(target=post_save.send, kwargs={
+                'sender': TestHouse, 'instance': MagicMock(), 'created': True})
+            thread.start()
+            thread.join()
+
+        self.assertEqual(1, self.receiver.call_count)
+        self.assertEqual({}, changes.models())
+
+    def test_the_signals_are_only_intercepted_while_recording(self):
+        self.assertNotIn('send', post_save.__dict__)
+        with ChangeSet().recording():
+            with ChangeSet().recording():
+                self.assertIn('send', post_save.__dict__)
+            self.assertIn('send', post_save.__dict__)
+        self.assertNotIn('send', post_save.__dict__)
+
+    def test_it_sends_the_signals_if_not_muted(self):
+        with ChangeSet().recording():
+            TestHouse.objects.create(address='House1')
+        self.assertEqual(1, self.receiver.call_count)
+
+
+class TestBatchedSignalsSyncPolicy(TestCase):
+    def test_it_sends_chunk_synced_once_committed(self):
+        receiver = MagicMock()
+        chunk_synced.connect(receiver)
+        self.addCleanup(chunk_synced.disconnect, receiver)
+        action = MagicMock(type='create')
+        action.execute.side_effect = lambda: TestHouse.objects.create(
+            address='House1')
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            BatchedSignalsSyncPolicy(BasicSyncPolicy([action])).execute()
+            receiver.assert_not_called()
+        for callback in callbacks:
+            callback()
+
+        house = TestHouse.objects.get(address='House1')
+        receiver.assert_called_once_with(
+            signal=chunk_synced, sender=TestHouse, created=[house.pk],
+            updated=[], deleted=[])
+
+    def test_the_command_batches_the_signals(self):
+        TestHouse.objects.create(address='House1')
+        receiver = MagicMock()
+        post_save.connect(receiver, sender=TestHouse)
+        self.addCleanup(post_save.disconnect, receiver, sender=TestHouse)
+        chunk_receiver = MagicMock()
+        chunk_synced.connect(chunk_receiver)
+        self.addCleanup(chunk_synced.disconnect, chunk_receiver)
+
+        csv_file_obj = tempfile.NamedTemporaryFile(mode='w')
+        csv_file_obj.writelines([
+            'action_flags,match_on,address,floors\n',
+            'u*,address,House1,3\n',
+            'c,address,House2,1\n',
+        ])
+        csv_file_obj.seek(0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('syncfile', 'TestSystem', 'tests', 'TestHouse',
+                         csv_file_obj.name, batch_signals=True)
+
+        receiver.assert_not_called()
+        chunk_receiver.assert_called_once_with(
+            signal=chunk_synced, sender=TestHouse,
+            created=[TestHouse.objects.get(address='House2').pk],
+            updated=[TestHouse.objects.get(address='House1').pk],
+            deleted=[])
+
+
+class TestChangeFeed(TestCase):
+    def test_pk_set_falls_back_to_a_list_for_other_keys(self):
+        sut = PkSet()
+        sut.add(1)
+        self.assertIsInstance(sut.pks, array)
+        sut.add('key')
+        self.assertEqual([1, 'key'], list(sut))
+
+    def test_the_command_writes_the_changes_file(self):
+        TestHouse.objects.create(address='House1')
+        TestHouse.objects.create(address='House2')
+        changes_file_obj = tempfile.NamedTemporaryFile(mode='r')
+        csv_file_obj = tempfile.NamedTemporaryFile(mode='w')
+        csv_file_obj.writelines([
+            'action_flags,match_on,address,floors\n',
+            'u*,address,House1,3\n',
+            'd*,address,House2,\n',
+            'c,address,House3,1\n',
+        ])
+        csv_file_obj.seek(0)
+        pks = dict(TestHouse.objects.values_list('address', 'pk'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('syncfile', 'TestSystem', 'tests', 'TestHouse',
+                         csv_file_obj.name,
+                         changes_file=changes_file_obj.name)
+
+        changes = [json.loads(line) for line in changes_file_obj]
+        self.assertEqual([{
+            'model': 'tests.TestHouse',
+            'created': [TestHouse.objects.get(address='House3').pk],
+            'updated': [pks['House1']],
+            'deleted': [pks['House2']]}], changes)
+
+    def test_a_callback_receives_the_upserted_changes(self):
+        TestProduct.objects.create(code='P1', name='Old')
+        callback = MagicMock()
+        rows = [{'action_flags': 'cu*', 'match_on': 'code', 'code': 'P1',
+                 'name': 'New'},
+                {'action_flags': 'cu*', 'match_on': 'code', 'code': 'P2',
+                 'name': 'Other'}]
+        builder = CsvActionFactory(TestProduct, use_upsert=True)
+        actions = [a for row in rows for a in builder.from_dict(row)]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ChangeFeedSyncPolicy(BasicSyncPolicy(actions),
+                                 ChangeFeed(callback=callback)).execute()
+
+        pks = dict(TestProduct.objects.values_list('code', 'pk'))
+        callback.assert_called_once_with(
+            TestProduct, created=[pks['P2']], updated=[pks['P1']], deleted=[])
+
+
+class TestChangeFeedSyncPolicy(TransactionTestCase):
+    def test_it_publishes_each_commit_without_a_transaction(self):
+        callback = MagicMock()
+        create = MagicMock(type='create')
+        create.execute.side_effect = lambda: TestHouse.objects.create(
+            address='House1')
+        failing = MagicMock(type='create')
+        failing.execute.side_effect = ValueError('Failed')
+
+        with self.assertRaises(ValueError):
+            ChangeFeedSyncPolicy(BasicSyncPolicy([create, failing]),
+                                 ChangeFeed(callback=callback)).execute()
+
+        # The committed change is published, despite the later failure
+        callback.assert_called_once_with(
+            TestHouse, created=[TestHouse.objects.get().pk], updated=[],
+            deleted=[])
+
+    def test_it_publishes_once_without_a_transaction(self):
+        callback = MagicMock()
+        actions = []
+        for address in ['House1', 'House2', 'House3']:
+            action = MagicMock(type='create')
+            action.execute.side_effect = \
+                lambda address=address: TestHouse.objects.create(
+                    address=address)
+            actions.append(action)
+
+        ChangeFeedSyncPolicy(BasicSyncPolicy(actions),
+                             ChangeFeed(callback=callback)).execute()
+
+        callback.assert_called_once_with(
+            TestHouse, created=sorted(TestHouse.objects.values_list(
+                'pk', flat=True)), updated=[], deleted=[])
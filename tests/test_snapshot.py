@@ -0,0 +1,152 @@
+import tempfile
+from unittest.mock import MagicMock
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.test import TestCase
+from nsync.actions import ActionFactory, SyncActions
+from nsync.models import ExternalKeyMapping, ExternalSystem, SnapshotKey
+from nsync.policies import SnapshotSyncPolicy
+from nsync.snapshot import SnapshotSweep, sweeps_for
+
+from tests.models import TestHouse, TestPerson
+
+
+class SnapshotTestMixin:
+    def setUp(self):
+        self.external_system = ExternalSystem.objects.create(name='System')
+        self.other_system = ExternalSystem.objects.create(name='Other')
+
+    def create_mapped_house(self, external_key, address, *systems):
+        house = TestHouse.objects.create(address=address)
+        for system in systems or [self.external_system]:
+            ExternalKeyMapping.objects.create(
+                content_type=ContentType.objects.get_for_model(TestHouse),
+                external_system=system,
+                external_key=external_key,
+                object_id=house.id)
+        return house
+
+
+class TestSnapshotSweep(SnapshotTestMixin, TestCase):
+    def test_it_deletes_absent_mappings_and_their_sole_objects(self):
+        self.create_mapped_house('Key1', 'House1')
+        self.create_mapped_house('Key2', 'House2')
+        self.create_mapped_house('Key3', 'House3', self.external_system,
+                                 self.other_system)
+
+        sut = SnapshotSweep(self.external_system, TestHouse)
+        sut.see('Key1')
+        self.assertEqual(1, sut.sweep())
+
+        self.assertEqual(['House1', 'House3'], list(
+            TestHouse.objects.order_by('address').values_list(
+                'address', flat=True)))
+        self.assertEqual(
+            [('Key1', 'System'), ('Key3', 'Other')],
+            list(ExternalKeyMapping.objects.order_by(
+                'external_key').values_list(
+                    'external_key', 'external_system__name')))
+
+    def test_it_does_not_touch_other_models(self):
+        person = TestPerson.objects.create(first_name='Person')
+        ExternalKeyMapping.objects.create(
+            content_type=ContentType.objects.get_for_model(TestPerson),
+            external_system=self.external_system,
+            external_key='Person1',
+            object_id=person.id)
+        self.create_mapped_house('Key1', 'House1')
+
+        sut = SnapshotSweep(self.external_system, TestHouse)
+        sut.see('Key1')
+        sut.sweep()
+
+        self.assertTrue(TestPerson.objects.filter(id=person.id).exists())
+
+    def test_it_does_not_sweep_an_empty_snapshot(self):
+        self.create_mapped_house('Key1', 'House1')
+        self.assertEqual(0, SnapshotSweep(self.external_system,
+                                          TestHouse).sweep())
+        self.assertEqual(1, TestHouse.objects.count())
+
+    def test_it_streams_in_chunks(self):
+        for i in range(5):
+            self.create_mapped_house('Key{}'.format(i), 'House{}'.format(i))
+
+        sut = SnapshotSweep(self.external_system, TestHouse)
+        sut.chunk_size = 2
+        sut.see('Key0')
+        self.assertEqual(4, sut.sweep())
+        self.assertEqual(1, TestHouse.objects.count())
+
+    def test_discard_removes_the_recorded_keys(self):
+        sut = SnapshotSweep(self.external_system, TestHouse)
+        sut.see('Key1')
+        sut.flush()
+        self.assertEqual(1, SnapshotKey.objects.count())
+        sut.discard()
+        self.assertEqual(0, SnapshotKey.objects.count())
+
+    def test_sweeps_are_created_for_the_created_and_updated_keys(self):
+        factory = ActionFactory(TestHouse, self.external_system)
+        actions = factory.build(SyncActions(create=True, update=True),
+                                ['address'], 'Key1', {'address': 'House1'})
+        actions += factory.build(SyncActions(delete=True),
+                                 ['address'], 'Key2', {'address': 'House2'})
+
+        sweeps = sweeps_for(actions)
+
+        self.assertEqual(1, len(sweeps))
+        self.assertEqual(['Key1', 'Key1'], sweeps[0].pending)
+
+
+class TestSnapshotSyncPolicy(SnapshotTestMixin, TestCase):
+    def build(self, external_key, address):
+        return ActionFactory(TestHouse, self.external_system).build(
+            SyncActions(create=True, update=True), ['address'], external_key,
+            {'address': address})
+
+    def test_it_sweeps_the_absent_keys_after_the_policy(self):
+        self.create_mapped_house('Key1', 'House1')
+        self.create_mapped_house('Key2', 'House2')
+        policy = MagicMock()
+
+        SnapshotSyncPolicy(policy, self.build('Key1', 'House1')).execute()
+
+        policy.execute.assert_called_once_with()
+        self.assertEqual(['House1'], list(
+            TestHouse.objects.values_list('address', flat=True)))
+        self.assertEqual(0, SnapshotKey.objects.count())
+
+    def test_the_keys_are_discarded_if_it_fails(self):
+        self.create_mapped_house('Key2', 'House2')
+        policy = MagicMock()
+        policy.execute.side_effect = ValueError('Failed')
+
+        with self.assertRaises(ValueError):
+            SnapshotSyncPolicy(policy, self.build('Key1', 'House1')).execute()
+
+        self.assertEqual(0, SnapshotKey.objects.count())
+        self.assertEqual(1, TestHouse.objects.count())
+
+
+class TestSnapshotCommands(SnapshotTestMixin, TestCase):
+    def test_syncfile_sweeps_the_absent_records(self):
+        self.create_mapped_house('Key1', 'House1')
+        self.create_mapped_house('Key2', 'House2')
+
+        csv_file_obj = tempfile.NamedTemporaryFile(mode='w')
+        csv_file_obj.writelines([
+            'external_key,action_flags,match_on,address\n',
+            'Key1,cu,address,House1\n',
+            'Key3,cu,address,House3\n',
+        ])
+        csv_file_obj.seek(0)
+
+        call_command('syncfile', 'System', 'tests', 'TestHouse',
+                     csv_file_obj.name, snapshot=True)
+
+        self.assertEqual(['House1', 'House3'], list(
+            TestHouse.objects.order_by('address').values_list(
+                'address', flat=True)))
+        self.assertEqual(0, SnapshotKey.objects.count())
@@ -0,0 +1,29 @@
+from django.test import TestCase
+from nsync.sorting import ExternalSorter
+
+
+class TestExternalSorter(TestCase):
+    def test_it_sorts_in_memory(self):
+        sut = ExternalSorter()
+        sut.extend([3, 1, 2])
+        self.assertEqual([1, 2, 3], list(sut))
+        self.assertEqual([], sut.runs)
+
+    def test_it_spills_sorted_runs_to_disk(self):
+        sut = ExternalSorter(max_in_memory=3)
+        sut.extend([9, 4, 7, 1, 8, 2, 6, 3, 5, 0])
+        self.assertEqual(3, len(sut.runs))
+        self.assertEqual(10, len(sut))
+        self.assertEqual(list(range(10)), list(sut))
+
+    def test_it_sorts_stably_by_key(self):
+        sut = ExternalSorter(key=lambda item: item[0], max_in_memory=2)
+        sut.extend([(2, 'a'), (1, 'b'), (2, 'c'), (1, 'd'), (2, 'e')])
+        self.assertEqual([(1, 'b'), (1, 'd'), (2, 'a'), (2, 'c'), (2, 'e')],
+                         list(sut))
+
+    def test_it_is_empty_after_iterating(self):
+        sut = ExternalSorter(max_in_memory=2)
+        sut.extend([3, 2, 1])
+        list(sut)
+        self.assertEqual(0, len(sut))
@@ -0,0 +1,102 @@
+import os
+import re
+import tempfile
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from nsync.engine import SyncEngine
+from nsync.management.commands.syncfiles import DEFAULT_FILE_REGEX
+from nsync.watch import DirectoryWatcher
+
+from tests.models import TestHouse
+
+
+class TestDirectoryWatcher(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.engine = SyncEngine(ordered=True)
+        self.watcher = DirectoryWatcher(self.directory.name, self.engine,
+                                        re.compile(DEFAULT_FILE_REGEX),
+                                        use_inotify=False)
+
+    def write(self, name, lines):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w') as f:
+            f.writelines(lines)
+        return path
+
+    def test_it_synchronises_the_files_and_moves_them_to_done(self):
+        self.write('TestSystem_tests_TestHouse_1.csv', [
+            'action_flags,match_on,address\n',
+            'c,address,House1\n',
+        ])
+        self.write('TestSystem_tests_TestHouse_2.csv', [
+            'action_flags,match_on,address\n',
+            'c,address,House2\n',
+        ])
+
+        self.watcher.run(once=True)
+
+        self.assertEqual(2, TestHouse.objects.count())
+        self.assertEqual(2, self.watcher.processed)
+        self.assertEqual(sorted(['TestSystem_tests_TestHouse_1.csv',
+                                 'TestSystem_tests_TestHouse_2.csv']),
+                         sorted(os.listdir(self.watcher.done)))
+        # The same context is used for both files
+        self.assertEqual(1, len(self.engine.context.external_systems))
+
+    def test_it_moves_the_files_that_fail_with_their_error(self):
+        self.write('TestSystem_tests_TestHouse_1.csv', [
+            'match_on,address\n',
+            'address,House1\n',
+        ])
+
+        self.watcher.run(once=True)
+
+        self.assertEqual(1, self.watcher.failures)
+        self.assertEqual(sorted(['TestSystem_tests_TestHouse_1.csv',
+                                 'TestSystem_tests_TestHouse_1.csv.error']),
+                         sorted(os.listdir(self.watcher.failed)))
+
+    def test_it_closes_the_old_connections_around_each_file(self):
+        path = self.write('TestSystem_tests_TestHouse_1.csv', [
+            'action_flags,match_on,address\n',
+            'c,address,House1\n',
+        ])
+
+        with patch('nsync.watch.close_old_connections') as close:
+            self.watcher.process(path)
+            self.watcher.process(self.write(
+                'TestSystem_tests_TestHouse_2.csv', ['match_on\n']))
+
+        self.assertEqual(4, close.call_count)
+
+    def test_it_ignores_the_files_that_do_not_match(self):
+        self.write('notes.txt', ['Hello\n'])
+        self.watcher.run(once=True)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.directory.name, 'notes.txt')))
+
+    def test_a_file_is_ready_once_it_is_unchanged(self):
+        path = self.write('TestSystem_tests_TestHouse_1.csv', [
+            'action_flags,match_on,address\n',
+        ])
+        self.assertEqual([], self.watcher.scan())
+        self.assertEqual([path], self.watcher.scan())
+
+    def test_move_does_not_replace_an_older_file(self):
+        os.makedirs(self.watcher.done)
+        self.write('done/a.csv', ['old'])
+        path = self.write('a.csv', ['new'])
+        moved = DirectoryWatcher.move(path, self.watcher.done)
+        self.assertNotEqual(os.path.join(self.watcher.done, 'a.csv'), moved)
+        self.assertEqual(2, len(os.listdir(self.watcher.done)))
+
+
+class TestWatchCommand(TestCase):
+    def test_command_raises_error_if_directory_does_not_exist(self):
+        with self.assertRaises(CommandError):
+            call_command('nsync_watch', 'does_not_exist', once=True)
@@ -0,0 +1,120 @@
+import json
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.utils import timezone
+from django.test import TestCase
+from nsync.models import ExternalSystem, SyncChunk, SyncJob
+from nsync.workqueue import Worker, enqueue
+
+from tests.models import TestHouse
+
+
+class TestWorkQueue(TestCase):
+    def setUp(self):
+        self.external_system = ExternalSystem.objects.create(
+            name='TestSystem')
+
+    def enqueue(self, rows, chunk_size=2):
+        return enqueue(self.external_system, TestHouse, rows, chunk_size)
+
+    def test_enqueue_splits_the_rows_into_chunks(self):
+        rows = [{'action_flags': 'c', 'match_on': 'address',
+                 'address': 'House{}'.format(i)} for i in range(5)]
+        job = self.enqueue(rows)
+
+        self.assertEqual('tests.TestHouse', job.model)
+        chunks = job.chunks.order_by('sequence')
+        self.assertEqual([0, 1, 2], [c.sequence for c in chunks])
+        self.assertEqual(rows[4:], json.loads(chunks[2].rows))
+
+    def test_enqueue_inserts_the_chunks_as_they_are_produced(self):
+        inserted = []
+
+        def rows():
+            for i in range(30):
+                inserted.append(SyncChunk.objects.count())
+                yield {'action_flags': 'c', 'match_on': 'address',
+                       'address': 'House{}'.format(i)}
+
+        with patch('nsync.workqueue.INSERT_BATCH_SIZE', 4):
+            job = self.enqueue(rows(), chunk_size=2)
+
+        self.assertEqual(4, inserted[8])
+        self.assertEqual(12, inserted[-1])
+        self.assertEqual(list(range(15)), list(
+            job.chunks.order_by('sequence').values_list('sequence',
+                                                        flat=True)))
+
+    def test_enqueue_of_no_rows_is_done(self):
+        self.assertEqual(SyncJob.DONE, self.enqueue([]).status)
+
+    def test_worker_executes_the_job_in_phases(self):
+        TestHouse.objects.create(address='Old')
+        # The delete comes before the create of the update's target, so
+        # the phases matter
+        job = self.enqueue([
+            {'action_flags': 'd*', 'match_on': 'address', 'address': 'Old'},
+            {'action_flags': 'u*', 'match_on': 'address',
+             'address': 'New', 'country': 'Australia'},
+            {'action_flags': 'c', 'match_on': 'address', 'address': 'New'},
+        ])
+
+        worker = Worker('worker1')
+        worker.run(poll=0, exit_when_done=True)
+
+        job.refresh_from_db()
+        self.assertEqual(SyncJob.DONE, job.status)
+        self.assertEqual(6, worker.executed)
+        self.assertEqual(['New'], [h.address for h in TestHouse.objects.all()])
+        self.assertEqual('Australia', TestHouse.objects.get().country)
+
+    def test_a_phase_waits_for_every_chunk(self):
+        job = self.enqueue([
+            {'action_flags': 'c', 'match_on': 'address', 'address': 'A'},
+            {'action_flags': 'c', 'match_on': 'address', 'address': 'B'},
+        ], chunk_size=1)
+        first = Worker('worker1').claim()
+
+        worker = Worker('worker2')
+        second = worker.claim()
+        worker.execute(second)
+
+        # The first chunk is still leased, so nothing is left to claim
+        self.assertIsNone(worker.claim())
+        self.assertFalse(worker.advance_jobs())
+        self.assertNotEqual(first.pk, second.pk)
+
+        Worker('worker1').execute(first)
+        self.assertTrue(worker.advance_jobs())
+        job.refresh_from_db()
+        self.assertEqual(1, job.phase)
+
+    def test_an_expired_lease_can_be_claimed(self):
+        self.enqueue([{'action_flags': 'c', 'match_on': 'address',
+                       'address': 'A'}])
+        chunk = Worker('worker1').claim()
+        SyncChunk.objects.filter(pk=chunk.pk).update(
+            lease_expires=timezone.now() - timedelta(seconds=1))
+
+        claimed = Worker('worker2').claim()
+        self.assertEqual(chunk.pk, claimed.pk)
+        self.assertEqual('worker2', claimed.lease_owner)
+        self.assertEqual(2, claimed.attempts)
+
+        # The first worker's work is rolled back, as it lost the lease
+        self.assertFalse(Worker('worker1').execute(chunk))
+        self.assertFalse(TestHouse.objects.exists())
+
+    def test_a_failing_chunk_fails_the_job(self):
+        job = self.enqueue([{'action_flags': 'c', 'match_on': 'address',
+                             'address': 'A'}])
+        worker = Worker('worker1', max_attempts=2)
+        with patch('nsync.workqueue.execute_actions',
+                   side_effect=RuntimeError('Broken')):
+            worker.run(poll=0, exit_when_done=True)
+
+        job.refresh_from_db()
+        self.assertEqual(SyncJob.FAILED, job.status)
+        self.assertEqual(2, worker.failed)
+        self.assertEqual('Broken', job.chunks.get().error)